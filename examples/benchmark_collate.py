@@ -0,0 +1,75 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Micro-benchmark of collating batches of token ids into padded tensors with
+``parlai.core.collate``, compared against filling the tensor one element at a
+time (as the seq2seq agent used to) or one row at a time (as drqa used to).
+Requires pytorch.
+
+For example:
+`python examples/benchmark_collate.py -bs 128 --max-len 100`
+"""
+from parlai.core.collate import Collator, pad_sequences
+
+import argparse
+import random
+import time
+import torch
+
+
+def per_element(seqs):
+    xs = torch.LongTensor(len(seqs), max(len(x) for x in seqs)).fill_(0)
+    for i, x in enumerate(seqs):
+        offset = xs.size(1) - len(x)
+        for j, idx in enumerate(x):
+            xs[i][j + offset] = idx
+    return xs
+
+
+def per_row(seqs):
+    seqs = [torch.LongTensor(x) for x in seqs]
+    xs = torch.LongTensor(len(seqs), max(x.size(0) for x in seqs)).fill_(0)
+    mask = torch.ByteTensor(len(seqs), xs.size(1)).fill_(1)
+    for i, x in enumerate(seqs):
+        xs[i, xs.size(1) - x.size(0):].copy_(x)
+        mask[i, xs.size(1) - x.size(0):].fill_(0)
+    return xs
+
+
+def vectorized(seqs):
+    return torch.from_numpy(pad_sequences(seqs, left=True)[0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-bs', '--batchsize', default=128, type=int)
+    parser.add_argument('--max-len', default=100, type=int)
+    parser.add_argument('-n', '--num-batches', default=50, type=int)
+    opt = vars(parser.parse_args())
+    random.seed(42)
+
+    batches = [[[random.randrange(1, 30000)
+                 for _ in range(random.randint(1, opt['max_len']))]
+                for _ in range(opt['batchsize'])]
+               for _ in range(opt['num_batches'])]
+    collator = Collator()
+
+    def buffered(seqs):
+        return torch.from_numpy(collator.pad('xs', seqs, left=True)[0])
+
+    expected = [per_element(b) for b in batches[:3]]
+    for name, fn in [('per element', per_element), ('per row', per_row),
+                     ('pad_sequences', vectorized), ('Collator', buffered)]:
+        for b, e in zip(batches, expected):
+            assert fn(b).equal(e)
+        start = time.time()
+        for b in batches:
+            fn(b)
+        elapsed = (time.time() - start) / len(batches)
+        print('{:>14}: {:8.3f} ms/batch'.format(name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
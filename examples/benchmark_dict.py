@@ -0,0 +1,69 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Benchmarks the dictionary tokenizers and the token id cache on the text of
+a task: times ``txt2vec`` over every string of the data for a few epochs with
+the nltk and the regular expression tokenizers, with and without the cache.
+
+For example:
+`python examples/benchmark_dict.py -t babi:task10k:1`
+or
+`python examples/benchmark_dict.py -t squad --num-epochs 2`
+"""
+from parlai.core.dict import DictionaryAgent
+from parlai.core.params import ParlaiParser
+from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
+from parlai.core.worlds import create_task
+
+import copy
+import time
+
+
+def load_texts(opt):
+    """Returns the text and labels of one epoch of the task."""
+    ordered_opt = copy.deepcopy(opt)
+    ordered_opt['datatype'] = opt['datatype'].split(':')[0] + ':ordered'
+    ordered_opt['numthreads'] = 1
+    ordered_opt['batchsize'] = 1
+    agent = RepeatLabelAgent(ordered_opt)
+    world = create_task(ordered_opt, agent)
+    texts = []
+    for _ in world:
+        world.parley()
+        obs = world.get_acts()[0]
+        texts.append(obs.get('text', ''))
+        texts.extend(obs.get('labels', ()))
+    return texts
+
+
+def main():
+    # Get command line arguments
+    parser = ParlaiParser()
+    DictionaryAgent.add_cmdline_args(parser)
+    parser.add_argument('--num-epochs', default=3, type=int)
+    opt = parser.parse_args()
+    texts = load_texts(opt)
+    print('[ {} strings, {} distinct ]'.format(len(texts), len(set(texts))))
+
+    for tokenizer in ['nltk', 're']:
+        for cache_size in [0, opt['dict_cache_size']]:
+            dict_opt = copy.deepcopy(opt)
+            dict_opt['dict_tokenizer'] = tokenizer
+            dict_opt['dict_cache_size'] = cache_size
+            dictionary = DictionaryAgent(dict_opt)
+            for text in texts:
+                dictionary.add_to_dict(dictionary.tokenize(text))
+            start = time.time()
+            for _ in range(opt['num_epochs']):
+                for text in texts:
+                    dictionary.txt2vec(text)
+            elapsed = time.time() - start
+            print('tokenizer: {:>4}  cache size: {:>8}  words: {:>8}  '
+                  'time: {:>8.2f}s'.format(tokenizer, cache_size,
+                                           len(dictionary), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Micro-benchmark of the drqa preprocessing which follows tokenization: the
+token features built by ``vectorize`` and the answer span search done for
+training, compared against the original token by token implementations
+(and checked to give the same results). Requires pytorch and spaCy.
+
+For example:
+`python examples/benchmark_drqa_features.py -t squad -n 5000`
+"""
+from parlai.core.params import ParlaiParser
+from parlai.agents.drqa import config
+from parlai.agents.drqa.drqa import DrqaAgent
+from parlai.agents.drqa.utils import build_feature_dict, vectorize, find_spans
+from parlai.agents.repeat_label.repeat_label import RepeatLabelAgent
+from parlai.core.worlds import create_task
+
+from collections import Counter
+import copy
+import time
+import torch
+
+
+def loop_vectorize(opt, ex, word_dict, feature_dict):
+    document = torch.LongTensor([word_dict[w] for w in ex['document']])
+    question = torch.LongTensor([word_dict[w] for w in ex['question']])
+    features = torch.zeros(len(ex['document']), len(feature_dict))
+    if opt['use_in_question']:
+        q_words_cased = set([w for w in ex['question']])
+        q_words_uncased = set([w.lower() for w in ex['question']])
+        for i in range(len(ex['document'])):
+            if ex['document'][i] in q_words_cased:
+                features[i][feature_dict['in_question']] = 1.0
+            if ex['document'][i].lower() in q_words_uncased:
+                features[i][feature_dict['in_question_uncased']] = 1.0
+    if opt['use_tf']:
+        counter = Counter([w.lower() for w in ex['document']])
+        l = len(ex['document'])
+        for i, w in enumerate(ex['document']):
+            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
+    if opt['use_time'] > 0:
+        sent_idx = 0
+        for i, w in reversed(list(enumerate(ex['document']))):
+            if w in {'.', '?', '!'}:
+                sent_idx = sent_idx + 1
+            else:
+                sent_idx = max(sent_idx, 1)
+            if sent_idx < opt['use_time']:
+                features[i][feature_dict['time=T%d' % sent_idx]] = 1.0
+            else:
+                features[i][feature_dict['time>=T%d' % opt['use_time']]] = 1.0
+    return document, features, question
+
+
+def loop_spans(document, answers):
+    def _positions(d, l):
+        for i in range(len(d)):
+            for j in range(i, min(len(d) - 1, i + len(l))):
+                if l == d[i:j + 1]:
+                    yield(i, j)
+    spans = []
+    for answer in answers:
+        spans.extend(_positions(document, answer))
+    return spans
+
+
+def load_examples(opt, word_dict):
+    """Returns the first ``num_examples`` training examples of the task,
+    tokenized.
+    """
+    ordered_opt = copy.deepcopy(opt)
+    ordered_opt['datatype'] = 'train:ordered'
+    ordered_opt['numthreads'] = 1
+    ordered_opt['batchsize'] = 1
+    agent = RepeatLabelAgent(ordered_opt)
+    world = create_task(ordered_opt, agent)
+    examples = []
+    for _ in range(opt['num_examples']):
+        world.parley()
+        obs = world.get_acts()[0]
+        fields = obs['text'].strip().split('\n')
+        examples.append({
+            'document': word_dict.tokenize(' '.join(fields[:-1])),
+            'question': word_dict.tokenize(fields[-1]),
+            'answers': [word_dict.tokenize(a) for a in obs['labels']],
+            'target': None,
+        })
+        if world.epoch_done():
+            break
+    return examples
+
+
+def main():
+    # Get command line arguments
+    parser = ParlaiParser()
+    DrqaAgent.add_cmdline_args(parser)
+    parser.add_argument('-n', '--num-examples', default=5000, type=int)
+    parser.set_defaults(task='squad')
+    opt = parser.parse_args()
+    config.set_defaults(opt)
+    feature_dict = build_feature_dict(opt)
+    word_dict = DrqaAgent.dictionary_class()(opt)
+    examples = load_examples(opt, word_dict)
+    print('[ {} examples ]'.format(len(examples)))
+
+    for ex in examples:
+        for new, old in zip(vectorize(opt, ex, word_dict, feature_dict),
+                            loop_vectorize(opt, ex, word_dict, feature_dict)):
+            assert new.equal(old)
+        assert (find_spans(ex['document'], ex['answers']) ==
+                loop_spans(ex['document'], ex['answers']))
+
+    for name, fn in [
+            ('loop vectorize', lambda ex: loop_vectorize(opt, ex, word_dict,
+                                                         feature_dict)),
+            ('vectorize', lambda ex: vectorize(opt, ex, word_dict,
+                                               feature_dict)),
+            ('loop spans', lambda ex: loop_spans(ex['document'],
+                                                 ex['answers'])),
+            ('find_spans', lambda ex: find_spans(ex['document'],
+                                                 ex['answers']))]:
+        start = time.time()
+        for ex in examples:
+            fn(ex)
+        elapsed = (time.time() - start) / len(examples)
+        print('{:>14}: {:8.3f} ms/example'.format(name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
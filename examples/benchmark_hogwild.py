@@ -0,0 +1,58 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Measures how many examples per second a model processes on a task when
+run with increasing numbers of hogwild threads (processes).
+
+For example:
+`python examples/benchmark_hogwild.py -t babi:task10k:1 -m repeat_label --max-threads 8`
+or, for a model which trains its (shared memory) parameters in every thread:
+`python examples/benchmark_hogwild.py -t babi:task10k:1 -m seq2seq --max-threads 8 -n 2000`
+"""
+from parlai.core.params import ParlaiParser
+from parlai.core.agents import create_agent
+from parlai.core.worlds import create_task
+
+import copy
+import time
+
+
+def benchmark(opt, numthreads):
+    """Returns the number of examples processed and the seconds taken to
+    process them with the given number of threads.
+    """
+    opt = copy.deepcopy(opt)
+    opt['numthreads'] = numthreads
+    agent = create_agent(opt)
+    world = create_task(opt, agent)
+    start = time.time()
+    for _ in range(opt['num_examples']):
+        world.parley()
+    world.synchronize()
+    elapsed = time.time() - start
+    total = world.report()['total']
+    world.shutdown()
+    return total, elapsed
+
+
+def main():
+    # Get command line arguments
+    parser = ParlaiParser(True, True)
+    parser.add_argument('-n', '--num-examples', default=10000, type=int)
+    parser.add_argument('--max-threads', default=8, type=int,
+                        help='benchmark 1, 2, 4, ... up to this many threads')
+    parser.set_defaults(datatype='train', model='repeat_label')
+    opt = parser.parse_args()
+
+    numthreads = 1
+    while numthreads <= opt['max_threads']:
+        total, elapsed = benchmark(opt, numthreads)
+        print('numthreads: {:>3}  exs: {:>8}  time: {:>8.2f}s  exs/sec: {:>10.1f}'
+              .format(numthreads, total, elapsed, total / elapsed))
+        numthreads *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Micro-benchmark of the answer normalization and scoring used by
+``parlai.core.metrics``, compared against the original implementation which
+normalized every guess and label from scratch.
+
+For example:
+`python examples/benchmark_metrics.py -n 100000 --num-labels 5000 -bs 32`
+
+It also compares ``Metrics.update`` per example with ``Metrics.batch_update``
+on batches of ``--batchsize`` examples.
+"""
+from parlai.core.metrics import Metrics, _exact_match, _f1_score
+from collections import Counter
+
+import argparse
+import random
+import re
+import string
+import time
+
+
+def _reference_normalize_answer(s):
+    def remove_articles(text):
+        return re.sub(r'\b(a|an|the)\b', ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def _reference_exact_match(guess, answers):
+    guess = _reference_normalize_answer(guess)
+    for a in answers:
+        if guess == _reference_normalize_answer(a):
+            return True
+    return False
+
+
+def _reference_f1_score(guess, answers):
+    def _score(g_tokens, a_tokens):
+        common = Counter(g_tokens) & Counter(a_tokens)
+        num_same = sum(common.values())
+        if num_same == 0:
+            return 0
+        precision = 1.0 * num_same / len(g_tokens)
+        recall = 1.0 * num_same / len(a_tokens)
+        return (2 * precision * recall) / (precision + recall)
+
+    g_tokens = _reference_normalize_answer(guess).split()
+    return max(_score(g_tokens, _reference_normalize_answer(a).split())
+               for a in answers)
+
+
+def random_answer(words):
+    return ' '.join(random.choice(words)
+                    for _ in range(random.randint(1, 8))) + random.choice('.,!?')
+
+
+def timed(fn, examples):
+    start = time.time()
+    for guess, answers in examples:
+        fn(guess, answers)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num-examples', default=100000, type=int)
+    parser.add_argument('--num-labels', default=5000, type=int,
+                        help='number of distinct label sets, which repeat')
+    parser.add_argument('-bs', '--batchsize', default=32, type=int)
+    opt = vars(parser.parse_args())
+    random.seed(42)
+
+    words = ['The', 'a', 'An', 'cat', "dog's", 'sat', 'on', 'mat', 'Paris',
+             'in', '1984', 'river', 'bank', 'of', 'France', 'king', 'queen']
+    label_sets = [[random_answer(words) for _ in range(3)]
+                  for _ in range(opt['num_labels'])]
+    examples = [(random_answer(words), random.choice(label_sets))
+                for _ in range(opt['num_examples'])]
+
+    for name, ref, new in [('exact match', _reference_exact_match, _exact_match),
+                           ('f1', _reference_f1_score, _f1_score)]:
+        assert all(ref(g, a) == new(g, a) for g, a in examples[:1000])
+        t_ref = timed(ref, examples)
+        t_new = timed(new, examples)
+        print('{:>12}: reference {:.2f}s  cached {:.2f}s  speedup {:.1f}x'
+              .format(name, t_ref, t_new, t_ref / t_new))
+
+    # shared metrics, as with hogwild, where each write goes to shared memory
+    metrics = Metrics({'numthreads': 2})
+    observations = [{'text': g} for g, _ in examples]
+    labels = [a for _, a in examples]
+    start = time.time()
+    for obs, lbls in zip(observations, labels):
+        metrics.update(obs, lbls)
+    t_single = time.time() - start
+    single = metrics.report()
+    metrics.clear()
+    bs = opt['batchsize']
+    start = time.time()
+    for i in range(0, len(examples), bs):
+        metrics.batch_update(observations[i:i + bs], labels[i:i + bs])
+    t_batch = time.time() - start
+    assert metrics.report() == single
+    print('{:>12}: update {:.2f}s  batch_update {:.2f}s'
+          .format('metrics', t_single, t_batch))
+
+
+if __name__ == '__main__':
+    main()
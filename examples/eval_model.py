@@ -10,12 +10,19 @@ For example:
 `python examples/eval_model.py -t "babi:Task1k:2" -m "repeat_label"`
 or
 `python examples/eval_model.py -t "#CornellMovie" -m "ir_baseline" -mp "-lp 0.5"`
+or, to compare greedy and beam search decoding:
+`python examples/eval_model.py -t "babi:Task1k:2" -m "seq2seq" -mf /tmp/model --beam-size 5`
+
+Once done, the final metrics (with the beam size, for models that have one)
+are reported along with the number of examples evaluated per second. Use
+`--time-only True` to skip the per-example reports while timing.
 """
 from parlai.core.params import ParlaiParser
 from parlai.core.agents import create_agent
 from parlai.core.worlds import create_task
 
 import random
+import time
 
 def main():
     random.seed(42)
@@ -24,6 +31,9 @@ def main():
     parser = ParlaiParser(True, True)
     parser.add_argument('-n', '--num-examples', default=100000000)
     parser.add_argument('-d', '--display-examples', type='bool', default=False)
+    parser.add_argument('--time-only', type='bool', default=False,
+                        help='skip the per-example reports, so that the ' +
+                        'timing measures the model rather than the printing')
     parser.set_defaults(datatype='valid')
     opt = parser.parse_args()
     # Create model and assign it to the specified task
@@ -31,15 +41,29 @@ def main():
     world = create_task(opt, agent)
 
     # Show some example dialogs:
+    start = time.time()
     for k in range(int(opt['num_examples'])):
         world.parley()
-        print("---")
+        if not opt['time_only']:
+            print("---")
         if opt['display_examples']:
             print(world.display() + "\n~~")
-        print(world.report())
+        if not opt['time_only']:
+            print(world.report())
         if world.epoch_done():
             print("EPOCH DONE")
             break
+    elapsed = time.time() - start
+    report = world.report()
+    if opt.get('beam_size') is not None:
+        # the quality of the decoding depends on the beam size
+        print('beam size {}: {}'.format(opt['beam_size'], report))
+    else:
+        print(report)
+    # (not every world reports a total)
+    total = report.get('total', 0)
+    print('{} exs in {:.2f}s, {:.1f} exs/sec'.format(
+        total, elapsed, total / max(elapsed, 1e-9)))
     world.shutdown()
 
 if __name__ == '__main__':
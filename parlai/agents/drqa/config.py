@@ -47,6 +47,9 @@ def add_cmdline_args(parser):
                         help='Metric for choosing best valid model')
     agent.add_argument('--max_len', type=int, default=15,
                         help='The max span allowed during decoding')
+    agent.add_argument('--top_spans', type=int, default=1,
+                        help='Number of best spans to predict, sent as '
+                             'text_candidates when more than 1')
     agent.add_argument('--rnn_padding', type='bool', default=False)
     agent.add_argument('--display_iter', type=int, default=10,
                         help='Print train error after every \
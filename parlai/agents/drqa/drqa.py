@@ -25,6 +25,7 @@ import os
 import numpy as np
 import logging
 import copy
+from collections import OrderedDict
 try:
     import spacy
 except ModuleNotFoundError:
@@ -33,16 +34,29 @@ except ModuleNotFoundError:
     )
 
 from parlai.core.agents import Agent
+from parlai.core.collate import Collator
 from parlai.core.dict import DictionaryAgent
+from parlai.core.worlds import limit_hogwild_threads
 from . import config
-from .utils import build_feature_dict, vectorize, batchify, normalize_text
+from .utils import build_feature_dict, vectorize, batchify
+from .utils import find_spans, EmbeddingStore
 from .model import DocReaderModel
 
 # ------------------------------------------------------------------------------
 # Dictionary.
 # ------------------------------------------------------------------------------
 
-NLP = spacy.load('en')
+# The spaCy pipeline takes seconds and a lot of memory to load, so it is only
+# loaded once something needs to be tokenized (see get_nlp()).
+NLP = None
+
+
+def get_nlp():
+    global NLP
+    if NLP is None:
+        NLP = spacy.load('en')
+    return NLP
+
 
 class SimpleDictionaryAgent(DictionaryAgent):
     """Override DictionaryAgent to use spaCy tokenizer."""
@@ -54,30 +68,61 @@ class SimpleDictionaryAgent(DictionaryAgent):
             '--pretrained_words', type='bool', default=True,
             help='Use only words found in provided embedding_file'
         )
+        group.add_argument(
+            '--tokenize_cache_size', type=int, default=1000,
+            help='Number of recently seen documents to keep the tokens of '
+                 '(SQuAD repeats each paragraph for every question)'
+        )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # document text => tokens and their character offsets
+        self.tokenize_cache = OrderedDict()
+        self.tokenize_cache_size = self.opt.get('tokenize_cache_size', 1000)
 
-        # Index words in embedding file
+        # Index words in embedding file (through its binary copy, which is
+        # built the first time)
         if self.opt['pretrained_words'] and self.opt.get('embedding_file'):
             print('[ Indexing words with embeddings... ]')
-            self.embedding_words = set()
-            with open(self.opt['embedding_file']) as f:
-                for line in f:
-                    w = normalize_text(line.rstrip().split(' ')[0])
-                    self.embedding_words.add(w)
+            self.embedding_words = EmbeddingStore(self.opt['embedding_file'])
             print('[ Num words in set = %d ]' %
                   len(self.embedding_words))
         else:
             self.embedding_words = None
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['tokenize_cache'] = OrderedDict()
+        return state
+
     def tokenize(self, text, **kwargs):
-        tokens = NLP.tokenizer(text)
-        return [t.text for t in tokens]
+        return self.tokenize_with_spans(text)[0]
 
     def span_tokenize(self, text):
-        tokens = NLP.tokenizer(text)
-        return [(t.idx, t.idx + len(t.text)) for t in tokens]
+        return self.tokenize_with_spans(text)[1]
+
+    def tokenize_with_spans(self, text, cache=False, key=None):
+        """Returns the tokens of the text and their (start, end) character
+        offsets, from a single pass of the tokenizer. If ``cache`` is set, the
+        results for the last ``tokenize_cache_size`` texts tokenized this way
+        are kept, and must not be modified. They are kept by ``key`` if given
+        (e.g. the ``context_id`` of the text), or else by the text itself.
+        """
+        if key is None:
+            key = text
+        if cache:
+            result = self.tokenize_cache.get(key)
+            if result is not None:
+                self.tokenize_cache.move_to_end(key)
+                return result
+        tokens = get_nlp().tokenizer(text)
+        result = ([t.text for t in tokens],
+                  [(t.idx, t.idx + len(t.text)) for t in tokens])
+        if cache and self.tokenize_cache_size > 0:
+            self.tokenize_cache[key] = result
+            if len(self.tokenize_cache) > self.tokenize_cache_size:
+                self.tokenize_cache.popitem(last=False)
+        return result
 
     def add_to_dict(self, tokens):
         """Builds dictionary from the list of provided tokens.
@@ -92,6 +137,7 @@ class SimpleDictionaryAgent(DictionaryAgent):
                 index = len(self.tok2ind)
                 self.tok2ind[token] = index
                 self.ind2tok[index] = token
+                self.clear_cache()
 
 
 # ------------------------------------------------------------------------------
@@ -111,24 +157,30 @@ class DrqaAgent(Agent):
         return SimpleDictionaryAgent
 
     def __init__(self, opt, shared=None):
-        if opt['numthreads'] >1:
-            raise RuntimeError("numthreads > 1 not supported for this model.")
-
-        # Load dict.
-        if not shared:
-            word_dict = DrqaAgent.dictionary_class()(opt)
         # All agents keep track of the episode (for multiple questions)
         self.episode_done = True
+        self.id = self.__class__.__name__
 
-        # Only create an empty dummy class when sharing
         if shared is not None:
+            # Use the same dicts and network as the original agent. The network
+            # parameters are in shared memory, so that hogwild copies of this
+            # agent all train the same model (without locking), while each
+            # does its own tokenization and feature construction.
             self.is_shared = True
+            self.opt = opt
+            self.word_dict = shared['word_dict']
+            self.feature_dict = shared['feature_dict']
+            self.model = DocReaderModel(self.opt, self.word_dict,
+                                        self.feature_dict,
+                                        shared=shared['model'])
+            limit_hogwild_threads(self.opt)
+            self.n_examples = 0
+            self.collator = Collator()
             return
 
         # Set up params/logging/dicts
         self.is_shared = False
-        self.id = self.__class__.__name__
-        self.word_dict = word_dict
+        self.word_dict = DrqaAgent.dictionary_class()(opt)
         self.opt = copy.deepcopy(opt)
         config.set_defaults(self.opt)
 
@@ -141,10 +193,22 @@ class DrqaAgent(Agent):
                 self._init_from_scratch()
         self.opt['cuda'] = not self.opt['no_cuda'] and torch.cuda.is_available()
         if self.opt['cuda']:
+            if self.opt['numthreads'] > 1:
+                raise RuntimeError('numthreads > 1 is only supported on CPU, '
+                                   'use --no_cuda.')
             print('[ Using CUDA (GPU %d) ]' % opt['gpu'])
             torch.cuda.set_device(opt['gpu'])
             self.model.cuda()
         self.n_examples = 0
+        self.collator = Collator()
+
+    def share(self):
+        """Share the dicts and the network, see ``DocReaderModel.share``."""
+        shared = super().share()
+        shared['word_dict'] = self.word_dict
+        shared['feature_dict'] = self.feature_dict
+        shared['model'] = self.model.share(self.opt['numthreads'] > 1)
+        return shared
 
     def _init_from_scratch(self):
         self.feature_dict = build_feature_dict(self.opt)
@@ -175,22 +239,22 @@ class DrqaAgent(Agent):
             dialogue = self.observation['text'].split('\n')[:-1]
             dialogue.extend(observation['text'].split('\n'))
             observation['text'] = '\n'.join(dialogue)
+            # the document is not just the context anymore
+            observation.pop('context_id', None)
         self.observation = observation
         self.episode_done = observation['episode_done']
         return observation
 
     def act(self):
         """Update or predict on a single example (batchsize = 1)."""
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
         reply = {'id': self.getID()}
 
         ex = self._build_ex(self.observation)
         if ex is None:
             return reply
         batch = batchify(
-            [ex], null=self.word_dict[self.word_dict.null_token], cuda=self.opt['cuda']
+            [ex], null=self.word_dict[self.word_dict.null_token],
+            cuda=self.opt['cuda'], collator=self.collator
         )
 
         # Either train or predict
@@ -198,7 +262,7 @@ class DrqaAgent(Agent):
             self.n_examples += 1
             self.model.update(batch)
         else:
-            reply['text'] = self.model.predict(batch)[0]
+            self._set_prediction(reply, self.model.predict(batch)[0])
 
         return reply
 
@@ -206,9 +270,6 @@ class DrqaAgent(Agent):
         """Update or predict on a batch of examples.
         More efficient than act().
         """
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
         batchsize = len(observations)
         batch_reply = [{'id': self.getID()} for _ in range(batchsize)]
 
@@ -223,17 +284,20 @@ class DrqaAgent(Agent):
 
         # Else, use what we have (hopefully everything).
         batch = batchify(
-            examples, null=self.word_dict[self.word_dict.null_token], cuda=self.opt['cuda']
+            examples, null=self.word_dict[self.word_dict.null_token],
+            cuda=self.opt['cuda'], collator=self.collator
         )
 
-        # Either train or predict
-        if 'labels' in observations[0]:
+        # Either train or predict (observations without text, e.g. from
+        # teachers with no example in a smaller batch, are not valid)
+        if 'labels' in observations[valid_inds[0]]:
             self.n_examples += len(examples)
             self.model.update(batch)
         else:
             predictions = self.model.predict(batch)
             for i in range(len(predictions)):
-                batch_reply[valid_inds[i]]['text'] = predictions[i]
+                self._set_prediction(batch_reply[valid_inds[i]],
+                                     predictions[i])
 
         return batch_reply
 
@@ -248,6 +312,14 @@ class DrqaAgent(Agent):
     # Helper functions.
     # --------------------------------------------------------------------------
 
+    def _set_prediction(self, reply, spans):
+        """Replies with the best predicted span, and all of them as text
+        candidates if more than one was asked for.
+        """
+        reply['text'] = spans[0]
+        if self.opt.get('top_spans', 1) > 1:
+            reply['text_candidates'] = spans
+
     def _build_ex(self, ex):
         """Find the token span of the answer in the context for this example.
         If a token span cannot be found, return None. Otherwise, torchify.
@@ -265,7 +337,9 @@ class DrqaAgent(Agent):
             raise RuntimeError('Invalid input. Is task a QA task?')
 
         document, question = ' '.join(fields[:-1]), fields[-1]
-        inputs['document'] = self.word_dict.tokenize(document)
+        # documents are repeated for each of their questions, so keep them
+        inputs['document'], spans = self.word_dict.tokenize_with_spans(
+            document, cache=True, key=ex.get('context_id'))
         inputs['question'] = self.word_dict.tokenize(question)
         inputs['target'] = None
 
@@ -281,20 +355,14 @@ class DrqaAgent(Agent):
         inputs = vectorize(self.opt, inputs, self.word_dict, self.feature_dict)
 
         # Return inputs with original text + spans (keep for prediction)
-        return inputs + (document, self.word_dict.span_tokenize(document))
+        return inputs + (document, spans)
 
     def _find_target(self, document, labels):
         """Find the start/end token span for all labels in document.
         Return a random one for training.
         """
-        def _positions(d, l):
-            for i in range(len(d)):
-                for j in range(i, min(len(d) - 1, i + len(l))):
-                    if l == d[i:j + 1]:
-                        yield(i, j)
-        targets = []
-        for label in labels:
-            targets.extend(_positions(document, self.word_dict.tokenize(label)))
+        targets = find_spans(document, [self.word_dict.tokenize(label)
+                                        for label in labels])
         if len(targets) == 0:
             return
         return targets[np.random.choice(len(targets))]
@@ -136,6 +136,48 @@ class StackedBRNN(nn.Module):
         return output
 
 
+class PartialEmbedding(nn.Module):
+    """Word embeddings of which only the first num_tuned rows are trained.
+    * the rows below num_tuned are an nn.Embedding (with gradients)
+    * the other rows are a fixed buffer, which the optimizer never touches
+
+    Updates (and the optimizer state) thus scale with num_tuned instead of
+    with the size of the vocabulary.
+    """
+    def __init__(self, num_embeddings, embedding_dim, num_tuned,
+                 padding_idx=None):
+        super(PartialEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.num_tuned = min(num_tuned, num_embeddings)
+        self.tuned = nn.Embedding(self.num_tuned, embedding_dim,
+                                  padding_idx=padding_idx)
+        self.register_buffer('fixed', torch.Tensor(
+            num_embeddings - self.num_tuned, embedding_dim).normal_(0, 1))
+
+    def load(self, embeddings):
+        """Uses the rows of the (num_embeddings * embedding_dim) embeddings,
+        keeping the fixed rows as a view instead of copying them.
+        """
+        self.num_embeddings = embeddings.size(0)
+        self.num_tuned = min(self.num_tuned, self.num_embeddings)
+        self.tuned.weight.data = embeddings[:self.num_tuned].clone()
+        self.fixed = embeddings[self.num_tuned:]
+
+    def forward(self, x):
+        """
+        x = batch * len
+        """
+        if self.fixed.size(0) == 0:
+            return self.tuned(x)
+        tuned = self.tuned(x.clamp(max=self.num_tuned - 1))
+        fixed_idx = (x - self.num_tuned).clamp(min=0)
+        fixed = Variable(self.fixed).index_select(
+            0, fixed_idx.view(-1)).view_as(tuned)
+        is_tuned = x.lt(self.num_tuned).unsqueeze(2).type_as(tuned)
+        return is_tuned * tuned + (1 - is_tuned) * fixed
+
+
 class SeqAttnMatch(nn.Module):
     """Given sequences X and Y, match sequence Y to each element in X.
     * o_i = sum(alpha_j * y_j) for i in X
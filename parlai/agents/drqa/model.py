@@ -6,11 +6,10 @@
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-import numpy as np
 import logging
 
 from torch.autograd import Variable
-from .utils import load_embeddings, AverageMeter
+from .utils import load_embeddings, decode_spans, AverageMeter
 from .rnn_reader import RnnDocReader
 
 logger = logging.getLogger('DrQA')
@@ -19,9 +18,13 @@ logger = logging.getLogger('DrQA')
 class DocReaderModel(object):
     """High level model that handles intializing the underlying network
     architecture, saving, updating examples, and predicting examples.
+
+    If ``shared`` is set (see ``share()``), the network of another model is
+    used instead of building a new one, with its own optimizer and gradients.
     """
 
-    def __init__(self, opt, word_dict, feature_dict, state_dict=None):
+    def __init__(self, opt, word_dict, feature_dict, state_dict=None,
+                 shared=None):
         # Book-keeping.
         self.opt = opt
         self.word_dict = word_dict
@@ -30,8 +33,16 @@ class DocReaderModel(object):
         self.train_loss = AverageMeter()
 
         # Building network.
-        self.network = RnnDocReader(opt)
+        if shared:
+            self.network = shared['network']
+            # Accumulate our own gradients in the shared parameters
+            for p in self.network.parameters():
+                p.grad = None
+        else:
+            self.network = RnnDocReader(opt)
         if state_dict:
+            if opt['tune_partial'] > 0:
+                self._split_embedding(state_dict['network'])
             new_state = set(self.network.state_dict().keys())
             for k in list(state_dict['network'].keys()):
                 if not k in new_state:
@@ -50,6 +61,27 @@ class DocReaderModel(object):
         else:
             raise RuntimeError('Unsupported optimizer: %s' % opt['optimizer'])
 
+    def _split_embedding(self, network_state):
+        """Converts the embeddings of models saved before partially tuned
+        embeddings were split into trained and fixed tables.
+        """
+        if 'embedding.weight' not in network_state:
+            return
+        num_tuned = self.network.embedding.num_tuned
+        weight = network_state.pop('embedding.weight')
+        network_state.pop('fixed_embedding', None)
+        network_state['embedding.tuned.weight'] = weight[:num_tuned]
+        network_state['embedding.fixed'] = weight[num_tuned:]
+
+    def share(self, processes=False):
+        """Returns the network for a shared model. If it is shared with other
+        processes, its parameters are moved to shared memory first (so that
+        their updates are seen).
+        """
+        if processes:
+            self.network.share_memory()
+        return {'network': self.network}
+
     def set_embeddings(self):
         # Read word embeddings.
         if not self.opt.get('embedding_file'):
@@ -62,7 +94,8 @@ class DocReaderModel(object):
 
         # Sanity check dimensions
         new_size = embeddings.size()
-        old_size = self.network.embedding.weight.size()
+        old_size = (self.network.embedding.num_embeddings,
+                    self.network.embedding.embedding_dim)
         if new_size[1] != old_size[1]:
             raise RuntimeError('Embedding dimensions do not match.')
         if new_size[0] != old_size[0]:
@@ -71,14 +104,12 @@ class DocReaderModel(object):
                 (old_size[0], new_size[0])
             )
 
-        # Swap weights
-        self.network.embedding.weight.data = embeddings
-
-        # If partially tuning the embeddings, keep the old values
+        # Swap weights (if partially tuning the embeddings, only the tuned
+        # ones are trainable parameters, the others stay in a fixed buffer)
         if self.opt['tune_partial'] > 0:
-            if self.opt['tune_partial'] + 2 < embeddings.size(0):
-                fixed_embedding = embeddings[self.opt['tune_partial'] + 2:]
-                self.network.fixed_embedding = fixed_embedding
+            self.network.embedding.load(embeddings)
+        else:
+            self.network.embedding.weight.data = embeddings
 
     def update(self, ex):
         # Train mode
@@ -113,9 +144,6 @@ class DocReaderModel(object):
         self.optimizer.step()
         self.updates += 1
 
-        # Reset any partially fixed parameters (e.g. rare words)
-        self.reset_parameters()
-
     def predict(self, ex):
         # Eval mode
         self.network.eval()
@@ -134,29 +162,25 @@ class DocReaderModel(object):
         score_s = score_s.data.cpu()
         score_e = score_e.data.cpu()
 
-        # Get argmax text spans
+        # Get the best text spans (top_spans of them for each example)
         text = ex[-2]
         spans = ex[-1]
+        starts, ends, scores = decode_spans(
+            score_s, score_e, self.opt['max_len'],
+            self.opt.get('top_spans', 1), x1_mask=ex[2])
         predictions = []
-        max_len = self.opt['max_len'] or score_s.size(1)
-        for i in range(score_s.size(0)):
-            scores = torch.ger(score_s[i], score_e[i])
-            scores.triu_().tril_(max_len - 1)
-            scores = scores.numpy()
-            s_idx, e_idx = np.unravel_index(np.argmax(scores), scores.shape)
-            s_offset, e_offset = spans[i][s_idx][0], spans[i][e_idx][1]
-            predictions.append(text[i][s_offset:e_offset])
+        for i, (s_idxs, e_idxs, span_scores) in enumerate(zip(
+                starts.tolist(), ends.tolist(), scores.tolist())):
+            # the best span is always in the document, the next ones can be
+            # padding (-inf) for documents shorter than top_spans allows
+            predictions.append([
+                text[i][spans[i][s_idx][0]:spans[i][e_idx][1]]
+                for s_idx, e_idx, score in zip(s_idxs, e_idxs, span_scores)
+                if score > -float('inf')
+            ])
 
         return predictions
 
-    def reset_parameters(self):
-        # Reset fixed embeddings to original value
-        if self.opt['tune_partial'] > 0:
-            offset = self.opt['tune_partial'] + 2
-            if offset < self.network.embedding.weight.data.size(0):
-                self.network.embedding.weight.data[offset:] \
-                    = self.network.fixed_embedding
-
     def save(self, filename):
         params = {
             'state_dict': {
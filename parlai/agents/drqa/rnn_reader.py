@@ -18,23 +18,22 @@ class RnnDocReader(nn.Module):
         self.opt = opt
 
         # Word embeddings (+1 for padding)
-        self.embedding = nn.Embedding(opt['vocab_size'],
-                                      opt['embedding_dim'],
-                                      padding_idx=padding_idx)
+        if opt['tune_partial'] > 0:
+            # ...only training the (+2 for NULL and UNK) most frequent ones
+            self.embedding = layers.PartialEmbedding(opt['vocab_size'],
+                                                     opt['embedding_dim'],
+                                                     opt['tune_partial'] + 2,
+                                                     padding_idx=padding_idx)
+        else:
+            self.embedding = nn.Embedding(opt['vocab_size'],
+                                          opt['embedding_dim'],
+                                          padding_idx=padding_idx)
 
         # ...(maybe) keep them fixed
         if opt['fix_embeddings']:
             for p in self.embedding.parameters():
                 p.requires_grad = False
 
-        # Register a buffer to (maybe) fill later for keeping *some* fixed
-        if opt['tune_partial'] > 0:
-            buffer_size = torch.Size((
-                opt['vocab_size'] - opt['tune_partial'] - 2,
-                opt['embedding_dim']
-            ))
-            self.register_buffer('fixed_embedding', torch.Tensor(buffer_size))
-
         # Projection for attention weighted question
         if opt['use_qemb']:
             self.qemb_match = layers.SeqAttnMatch(opt['embedding_dim'])
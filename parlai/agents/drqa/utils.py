@@ -3,10 +3,13 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
+import numpy as np
+import os
 import torch
-import time
 import unicodedata
-from collections import Counter
+from collections import defaultdict
+from parlai.core.collate import Collator
+from parlai.core.mapped_file import MappedFormat, stable_hash
 
 
 # ------------------------------------------------------------------------------
@@ -18,22 +21,136 @@ def normalize_text(text):
     return unicodedata.normalize('NFD', text)
 
 
+class EmbeddingStore(object):
+    """Binary, memory-mapped copy of a text file of pretrained word vectors
+    (such as GloVe), so that the text is only parsed once. The copy is
+    written next to the text file, and rebuilt when the text file changes.
+
+    Words are normalized and hashed, and vectors are looked up by hash, so
+    only the rows of the words asked for are read from disk.
+
+    After a fixed-size header, the file contains these sections:
+
+    - ``vectors``: float32 matrix of the vectors, one row per line of the file
+    - ``hashes``: sorted uint64 hashes of every distinct word
+    - ``rows``: int64 row of the vector of each hash (the last one in the file
+      for repeated words)
+    - ``dim``: the int64 dimension of the vectors
+    """
+
+    FORMAT = MappedFormat(b'PEMB', 2, ('vectors', 'hashes', 'rows', 'dim'))
+
+    def __init__(self, embedding_file):
+        self.embedding_file = embedding_file
+        self.path = embedding_file + '.emb'
+        src_stat = os.stat(embedding_file)
+        if not self.FORMAT.is_current(self.path, src_stat):
+            self._compile(src_stat)
+        self._open()
+        # word => whether it has a vector, for repeated membership tests
+        self.known = {}
+
+    def _compile(self, src_stat):
+        """Parses the text file and writes the binary file. The vectors are
+        written as they are parsed.
+        """
+        print('[ Compiling embeddings: ' + self.path + ' ]')
+        rows = {}
+        dim = [0]
+
+        def vectors():
+            with open(self.embedding_file) as read:
+                for i, line in enumerate(read):
+                    parsed = line.rstrip().split(' ')
+                    if i == 0:
+                        dim[0] = len(parsed) - 1
+                    assert(len(parsed) == dim[0] + 1)
+                    rows[stable_hash(normalize_text(parsed[0]))] = i
+                    yield np.array(parsed[1:], dtype=np.float32).tobytes()
+
+        # the sections after the vectors are only built once they are parsed
+        def hashes():
+            yield np.array(sorted(rows), dtype=np.uint64).tobytes()
+
+        def row_ids():
+            yield np.array([rows[h] for h in sorted(rows)],
+                           dtype=np.int64).tobytes()
+
+        def dims():
+            yield np.array(dim, dtype=np.int64).tobytes()
+
+        self.FORMAT.write(self.path, src_stat,
+                          [vectors(), hashes(), row_ids(), dims()])
+
+    def _open(self):
+        """Memory-maps the binary file and sets up views on its sections."""
+        data = self.FORMAT.open(self.path)
+        self.mmap = data.mmap
+        self.dim = int(data.section(3)[0])
+        self.vectors = data.section(0, np.float32).reshape(
+            -1, max(self.dim, 1))
+        self.hashes = data.section(1, np.uint64)
+        self.rows = data.section(2, np.int64)
+
+    def __getstate__(self):
+        """Pickles the file paths only (the mmap can not be pickled), so that
+        dictionaries holding a store can be saved with a model.
+        """
+        return {'embedding_file': self.embedding_file, 'path': self.path}
+
+    def __setstate__(self, state):
+        if os.path.isfile(state['embedding_file']):
+            self.__init__(state['embedding_file'])
+        else:
+            # the binary copy can still be used without the text file
+            self.__dict__.update(state)
+            self._open()
+            self.known = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, word):
+        found = self.known.get(word)
+        if found is None:
+            found = self.lookup([word])[0] >= 0
+            self.known[word] = found
+        return found
+
+    def lookup(self, words):
+        """Returns the int64 array of the rows of ``vectors`` which hold the
+        vectors of the (already normalized) words, with -1 for words which
+        have none.
+        """
+        hashes = np.fromiter((stable_hash(w) for w in words), dtype=np.uint64,
+                             count=len(words))
+        if len(self.hashes) == 0:
+            return np.full(len(words), -1, dtype=np.int64)
+        idx = np.searchsorted(self.hashes, hashes)
+        idx[idx == len(self.hashes)] = 0
+        return np.where(self.hashes[idx] == hashes, self.rows[idx], -1)
+
+
 def load_embeddings(opt, word_dict):
-    """Initialize embeddings from file of pretrained vectors."""
+    """Initialize embeddings from file of pretrained vectors. Only the vectors
+    of words in the dictionary are read, from the ``EmbeddingStore`` of the
+    file.
+    """
     embeddings = torch.Tensor(len(word_dict), opt['embedding_dim'])
     embeddings.normal_(0, 1)
 
     # Fill in embeddings
     if not opt.get('embedding_file'):
         raise RuntimeError('Tried to load embeddings with no embedding file.')
-    with open(opt['embedding_file']) as f:
-        for line in f:
-            parsed = line.rstrip().split(' ')
-            assert(len(parsed) == opt['embedding_dim'] + 1)
-            w = normalize_text(parsed[0])
-            if w in word_dict:
-                vec = torch.Tensor([float(i) for i in parsed[1:]])
-                embeddings[word_dict[w]].copy_(vec)
+    store = EmbeddingStore(opt['embedding_file'])
+    if store.dim != opt['embedding_dim']:
+        raise RuntimeError('Embedding dimensions do not match.')
+    words = [word_dict[i] for i in range(len(word_dict))]
+    rows = store.lookup(words)
+    found = np.flatnonzero(rows >= 0)
+    # gather the rows with one fancy index, which only touches their pages
+    embeddings[torch.from_numpy(found)] = torch.from_numpy(
+        store.vectors[rows[found]])
 
     # Zero NULL token
     embeddings[word_dict['__NULL__']].fill_(0)
@@ -68,37 +185,40 @@ def vectorize(opt, ex, word_dict, feature_dict):
     question = torch.LongTensor([word_dict[w] for w in ex['question']])
 
     # Create extra features vector
-    features = torch.zeros(len(ex['document']), len(feature_dict))
+    features = np.zeros((len(ex['document']), len(feature_dict)),
+                        dtype=np.float32)
+    doc_uncased = [w.lower() for w in ex['document']]
 
     # f_{exact_match}
     if opt['use_in_question']:
-        q_words_cased = set([w for w in ex['question']])
-        q_words_uncased = set([w.lower() for w in ex['question']])
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
+        q_words_cased = set(ex['question'])
+        q_words_uncased = set(w.lower() for w in ex['question'])
+        features[:, feature_dict['in_question']] = np.fromiter(
+            (w in q_words_cased for w in ex['document']), dtype=bool,
+            count=len(features))
+        features[:, feature_dict['in_question_uncased']] = np.fromiter(
+            (w in q_words_uncased for w in doc_uncased), dtype=bool,
+            count=len(features))
 
     # f_{tf}
-    if opt['use_tf']:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
+    if opt['use_tf'] and len(features) > 0:
+        _words, inverse, counts = np.unique(
+            doc_uncased, return_inverse=True, return_counts=True)
+        features[:, feature_dict['tf']] = counts[inverse] * 1.0 / len(features)
 
-    if opt['use_time'] > 0:
+    if opt['use_time'] > 0 and len(features) > 0:
         # Counting from the end, each (full-stop terminated) sentence gets
-        # its own time identitfier.
-        sent_idx = 0
-        def _full_stop(w):
-            return w in {'.', '?', '!'}
-        for i, w in reversed(list(enumerate(ex['document']))):
-            sent_idx = sent_idx + 1 if _full_stop(w) else max(sent_idx, 1)
-            if sent_idx < opt['use_time']:
-                features[i][feature_dict['time=T%d' % sent_idx]] = 1.0
-            else:
-                features[i][feature_dict['time>=T%d' % opt['use_time']]] = 1.0
+        # its own time identitfier: the number of full stops from each token
+        # to the end, plus one if the last sentence has no full stop, with
+        # all those from T=use_time together.
+        full_stops = np.fromiter((w in {'.', '?', '!'} for w in ex['document']),
+                                 dtype=np.int64, count=len(features))
+        sent_idx = np.cumsum(full_stops[::-1])[::-1] + 1 - full_stops[-1]
+        sent_idx = np.minimum(sent_idx, opt['use_time'])
+        # time=T1 ... time=T<use_time - 1>, time>=T<use_time> are consecutive
+        first = feature_dict['time>=T%d' % opt['use_time']] - opt['use_time'] + 1
+        features[np.arange(len(features)), first + sent_idx - 1] = 1.0
+    features = torch.from_numpy(features)
 
     # Maybe return without target
     if ex['target'] is None:
@@ -111,8 +231,74 @@ def vectorize(opt, ex, word_dict, feature_dict):
     return document, features, question, start, end
 
 
-def batchify(batch, null=0, cuda=False):
-    """Collate inputs into batches."""
+def find_spans(document, answers):
+    """Returns the (start, end) token spans of every occurrence of each of the
+    tokenized answers in the tokenized document, answer by answer. Spans
+    ending on the last token of the document are left out.
+    """
+    # Hash the n-grams of the document once for each answer length, so that
+    # each answer is found with a lookup instead of being compared at every
+    # position of the document.
+    ngrams = {}
+    spans = []
+    for answer in answers:
+        answer = tuple(answer)
+        n = len(answer)
+        if n == 0:
+            continue
+        if n not in ngrams:
+            ngrams[n] = defaultdict(list)
+            for i in range(len(document) - n):
+                ngrams[n][tuple(document[i:i + n])].append(i)
+        spans.extend((i, i + n - 1) for i in ngrams[n].get(answer, ()))
+    return spans
+
+
+def decode_spans(score_s, score_e, max_len=None, top_k=1, x1_mask=None):
+    """Finds the top_k (start, end) spans of each example of the batch, by the
+    product of their start and end scores, among spans of at most max_len
+    tokens (or any length if not given). If the document padding mask x1_mask
+    (1 for padding) is given, spans running into the padding are left out.
+
+    Only the band of valid spans is scored, as a (batch * len * max_len)
+    tensor of the span starting at each token for each span length, instead
+    of the full (len * len) outer product for each example.
+
+    Returns (batch * k) tensors of the start and end indices and the scores
+    of the spans, best first, where k is top_k or the number of spans if
+    there are fewer. Examples with fewer valid spans than that (because of
+    padding) get spans with a score of -inf after their valid ones.
+    """
+    batchsize, doc_len = score_s.size()
+    max_len = min(max_len or doc_len, doc_len)
+
+    # band[b][i][l] = score_s[b][i] * score_e[b][i + l] (-inf past the end)
+    padding = score_e.new(batchsize, max_len - 1).zero_()
+    ends = torch.cat([score_e, padding], 1).unfold(1, max_len, 1)
+    band = score_s.unsqueeze(2) * ends
+    past_end = (torch.arange(0, doc_len).unsqueeze(1) +
+                torch.arange(0, max_len).unsqueeze(0)).ge(doc_len).byte()
+    if band.is_cuda:
+        past_end = past_end.cuda()
+    band.masked_fill_(past_end.unsqueeze(0).expand_as(band), -float('inf'))
+    if x1_mask is not None:
+        # padding is at the end, so a span runs into it iff its end does
+        x1_mask = x1_mask.byte()
+        ones = x1_mask.new(batchsize, max_len - 1).fill_(1)
+        padded = torch.cat([x1_mask, ones], 1).unfold(1, max_len, 1)
+        padded = padded.cuda() if band.is_cuda else padded.cpu()
+        band.masked_fill_(padded, -float('inf'))
+
+    num_spans = doc_len * max_len - max_len * (max_len - 1) // 2
+    scores, idx = band.view(batchsize, -1).topk(min(top_k, num_spans), 1)
+    starts = idx // max_len
+    return starts, starts + idx % max_len, scores
+
+
+def batchify(batch, null=0, cuda=False, collator=None):
+    """Collate inputs into batches. If a ``Collator`` is given, the batch is
+    built in its buffers, and is only valid until the next call.
+    """
     NUM_INPUTS = 3
     NUM_TARGETS = 2
     NUM_EXTRA = 2
@@ -124,23 +310,19 @@ def batchify(batch, null=0, cuda=False):
     text = [ex[-2] for ex in batch]
     spans = [ex[-1] for ex in batch]
 
-    # Batch documents and features
-    max_length = max([d.size(0) for d in docs])
-    x1 = torch.LongTensor(len(docs), max_length).fill_(null)
-    x1_mask = torch.ByteTensor(len(docs), max_length).fill_(1)
-    x1_f = torch.zeros(len(docs), max_length, features[0].size(1))
-    for i, d in enumerate(docs):
-        x1[i, :d.size(0)].copy_(d)
-        x1_mask[i, :d.size(0)].fill_(0)
-        x1_f[i, :d.size(0)].copy_(features[i])
+    if collator is None:
+        collator = Collator()
+
+    # Batch documents and features (masks are 1 for padding)
+    x1, _lengths, mask = collator.pad('x1', docs, null=null)
+    x1 = torch.from_numpy(x1)
+    x1_mask = torch.from_numpy(np.logical_not(mask).view(np.uint8))
+    x1_f = torch.from_numpy(collator.pad('x1_f', features, dtype=np.float32)[0])
 
     # Batch questions
-    max_length = max([q.size(0) for q in questions])
-    x2 = torch.LongTensor(len(questions), max_length).fill_(null)
-    x2_mask = torch.ByteTensor(len(questions), max_length).fill_(1)
-    for i, q in enumerate(questions):
-        x2[i, :q.size(0)].copy_(q)
-        x2_mask[i, :q.size(0)].fill_(0)
+    x2, _lengths, mask = collator.pad('x2', questions, null=null)
+    x2 = torch.from_numpy(x2)
+    x2_mask = torch.from_numpy(np.logical_not(mask).view(np.uint8))
 
     # Pin memory if cuda
     if cuda:
@@ -19,6 +19,11 @@ import math
 import random
 from collections.abc import Sequence
 import heapq
+import numpy as np
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
 
 from parlai.core.agents import Agent
 from parlai.core.params import ParlaiParser
@@ -40,6 +45,12 @@ class MaxPriorityQueue(Sequence):
     def __getitem__(self, key):
         return sorted(self.lst)[key][1]
 
+    def __iter__(self):
+        return (v for _, v in sorted(self.lst))
+
+    def __reversed__(self):
+        return (v for _, v in sorted(self.lst, reverse=True))
+
     def __len__(self):
         return len(self.lst)
 
@@ -95,6 +106,140 @@ def rank_candidates(query_rep, cands, length_penalty):
         return res
 
 
+class CandidateIndex(object):
+    """Inverted index from words to the candidates containing them, so that
+    ranking a (large, fixed) set of candidates only looks at the candidates
+    sharing a word with the query. Gives the same ranking as
+    ``rank_candidates`` over the candidates in the same order.
+
+    Teachers add the labels of each example to their fixed set of candidates
+    (and remove them again for the next one), so the index can also rank a
+    set which differs from its own by a few ``removed`` and ``added``
+    candidates, which are scored like ``rank_candidates`` does. Added
+    candidates are looked at after those of the index, so when more than ``k``
+    candidates have the same (e.g. zero) score, the ones of the index are
+    kept, instead of the first ones in the order of the whole set.
+    """
+
+    def __init__(self, cands):
+        # candidates this index was built for, to compare later sets with
+        self.cands = frozenset(cands)
+        self.cand_list = list(cands)
+        self.positions = {c: i for i, c in enumerate(self.cand_list)}
+        self.postings = {}
+        self.norms = []
+        for i, c in enumerate(self.cand_list):
+            used = set(c.lower().split(' '))
+            for w in used:
+                self.postings.setdefault(w, []).append(i)
+            self.norms.append(math.sqrt(len(used)))
+
+    def rank(self, query_rep, length_penalty, k=100, removed=(), added=()):
+        """ Rank candidates given representation of query, leaving out the
+        ``removed`` candidates of the index and ranking the ``added`` ones
+        after all of those of the index.
+        """
+        skip = set(self.positions[c] for c in removed)
+        counts = {}
+        for w in query_rep['words']:
+            for i in self.postings.get(w, ()):
+                counts[i] = counts.get(i, 0) + 1
+        qnorm = query_rep['norm']
+
+        def score(i):
+            return counts.get(i, 0) / math.pow(self.norms[i] * qnorm,
+                                               length_penalty)
+
+        mpq = MaxPriorityQueue(k)
+        # the first k candidates fill the queue whatever their score, but
+        # after that only candidates with a word in common can replace them
+        last = -1
+        for i in range(len(self.cand_list)):
+            if len(mpq) == k:
+                break
+            if i not in skip:
+                mpq.add(self.cand_list[i], score(i))
+                last = i
+        for i in sorted(i for i in counts if i > last and i not in skip):
+            mpq.add(self.cand_list[i], score(i))
+        for c in added:
+            mpq.add(c, score_match(query_rep, c, length_penalty))
+        return list(reversed(mpq))
+
+
+class TfidfCandidateMatrix(object):
+    """Sparse (candidates x words) matrix over a set of candidates, weighted so
+    that multiplying it with the word counts of a batch of queries scores
+    every candidate for every query at once.
+    The score of a candidate is the sum of the weights of the query words it
+    contains, divided by ``(sqrt(num_cand_words) * sqrt(num_query_words)) **
+    length_penalty``.
+    """
+
+    def __init__(self, cands, length_penalty):
+        self.cands = frozenset(cands)
+        self.cand_list = list(cands)
+        self.positions = {c: i for i, c in enumerate(self.cand_list)}
+        self.length_penalty = length_penalty
+        self.vocab = {}
+        rows, cols, lengths = [], [], []
+        for i, c in enumerate(self.cand_list):
+            used = set(c.lower().split(' '))
+            for w in used:
+                rows.append(i)
+                cols.append(self.vocab.setdefault(w, len(self.vocab)))
+            lengths.append(len(used))
+        norms = np.power(np.sqrt(lengths), -length_penalty)
+        self.matrix = sp.csr_matrix(
+            (norms[rows], (rows, cols)),
+            shape=(len(self.cand_list), len(self.vocab)))
+        self.weighted = None
+
+    def set_weights(self, weights):
+        """Set the weight of each word of the vocab (a vector ordered like
+        ``self.vocab``).
+        """
+        self.weighted = (self.matrix @ sp.diags(weights)).tocsr()
+
+    def scores(self, queries):
+        """Returns the (candidates x queries) array of the score of every
+        candidate for each of the queries (a list of strings).
+        """
+        rows, cols, vals = [], [], []
+        for j, query in enumerate(queries):
+            words = query.lower().split(' ')
+            qnorm = math.pow(math.sqrt(len(words)), -self.length_penalty)
+            for w in set(words):
+                if w in self.vocab:
+                    rows.append(self.vocab[w])
+                    cols.append(j)
+                    vals.append(qnorm)
+        q = sp.csr_matrix((vals, (rows, cols)),
+                          shape=(len(self.vocab), len(queries)))
+        return (self.weighted @ q).toarray()
+
+    def rank(self, queries, k=100, removed=(), added=None):
+        """ Rank candidates for each of the queries (a list of strings),
+        leaving out the ``removed`` candidates and adding the candidates of
+        the ``added`` matrix after those of this one.
+        """
+        scores = self.scores(queries)
+        cand_list = self.cand_list
+        if removed:
+            scores[[self.positions[c] for c in removed]] = -np.inf
+        if added is not None:
+            scores = np.concatenate([scores, added.scores(queries)])
+            cand_list = cand_list + added.cand_list
+        k = min(k, len(cand_list) - len(removed))
+        ranked = []
+        for j in range(len(queries)):
+            top = np.argpartition(-scores[:, j], k - 1)[:k]
+            # sort by score, breaking ties by position in the candidates
+            top = top[np.lexsort((top, -scores[top, j]))]
+            ranked.append([cand_list[i] for i in top])
+        return ranked
+
+
 class IrBaselineAgent(Agent):
 
     @staticmethod
@@ -103,6 +248,16 @@ class IrBaselineAgent(Agent):
         parser.add_argument(
             '-lp', '--length_penalty', default=0.5,
             help='length penalty for responses')
+        parser.add_argument(
+            '--tfidf', type='bool', default=False,
+            help='score candidates with a sparse matrix product, weighting ' +
+                 'words by their dictionary frequency (requires scipy)')
+        parser.add_argument(
+            '--idf_refresh', type=float, default=0.1,
+            help='with --tfidf, recompute the word weights once the ' +
+                 'dictionary has had this fraction more updates than when ' +
+                 'they were last computed (0 recomputes them after every ' +
+                 'update)')
 
     def __init__(self, opt, shared=None):
         super().__init__(opt)
@@ -110,6 +265,18 @@ class IrBaselineAgent(Agent):
         self.length_penalty = float(opt['length_penalty'])
         self.dictionary = DictionaryAgent(opt)
         self.opt = opt
+        self.cand_index = None
+        # fixed candidates sent by the teacher which the index was built for
+        self.cand_source = None
+        self.tfidf = opt.get('tfidf', False)
+        if self.tfidf and sp is None:
+            raise ModuleNotFoundError('Need to install scipy to use --tfidf')
+        self.idf_refresh = opt.get('idf_refresh', 0.1)
+        self.idf = None
+        # number of examples added to the dictionary, in total and when the
+        # word weights were last computed
+        self.dict_updates = 0
+        self.idf_updates = 0
 
     def observe(self, obs):
         self.observation = obs
@@ -119,21 +286,132 @@ class IrBaselineAgent(Agent):
     def act(self):
         if self.opt.get('datatype', '').startswith('train'):
             self.dictionary.act()
+            self.dict_updates += 1
+        return self.rank_batch([self.observation])[0]
+
+    def batch_act(self, observations):
+        if self.opt.get('datatype', '').startswith('train'):
+            for obs in observations:
+                self.dictionary.observe(obs)
+                self.dictionary.act()
+            self.dict_updates += len(observations)
+        return self.rank_batch(observations)
+
+    def rank_batch(self, observations):
+        """Reply to each observation with its label candidates ranked by
+        similarity to its text. Observations sharing the same candidates are
+        ranked together.
+        """
+        replies = [{'id': self.getID()} for _ in observations]
+        groups = {}
+        for i, obs in enumerate(observations):
+            if 'label_candidates' in obs and len(obs['label_candidates']) > 0:
+                cands = obs['label_candidates']
+                groups.setdefault(id(cands), (obs, []))[1].append(i)
+            else:
+                replies[i]['text'] = "I don't know."
+
+        for obs, idxs in groups.values():
+            queries = [observations[i]['text'] for i in idxs]
+            ranking = self.rank(queries, obs['label_candidates'],
+                                fixed=obs.get('label_candidates_fixed'),
+                                added=obs.get('label_candidates_added', ()))
+            for i, ranked in zip(idxs, ranking):
+                replies[i]['text_candidates'] = ranked
+                replies[i]['text'] = ranked[0]
+        return replies
+
+    def rank(self, queries, cands, fixed=None, added=()):
+        """Returns the ranked candidates for each of the queries. If the
+        candidates are the ``fixed`` set of the teacher (which it never
+        modifies) with the ``added`` labels, only those are looked at besides
+        the index of the fixed set.
+        """
+        removed, added = self.candidate_changes(cands, fixed, added)
+        if self.tfidf:
+            self.update_weights()
+            extra = None
+            if added:
+                extra = TfidfCandidateMatrix(added, self.length_penalty)
+                extra.set_weights(self.word_weights(extra.vocab))
+            return self.cand_index.rank(queries, removed=removed,
+                                        added=extra)
+        return [self.cand_index.rank(self.build_query_representation(q),
+                                     self.length_penalty,
+                                     removed=removed, added=added)
+                for q in queries]
+
+    def candidate_changes(self, cands, fixed=None, added=()):
+        """Returns the candidates of the current index which are not in
+        ``cands``, and those of ``cands`` which are not in the index.
 
-        obs = self.observation
-        reply = {}
-        reply['id'] = self.getID()
-
-        # Rank candidates
-        if 'label_candidates' in obs and len(obs['label_candidates']) > 0:
-            rep = self.build_query_representation(obs['text'])
-            reply['text_candidates'] = (
-                rank_candidates(rep, obs['label_candidates'],
-                                self.length_penalty))
-            reply['text'] = reply['text_candidates'][0]
+        If the teacher sent its ``fixed`` candidates and the ``added`` ones,
+        the index is (re)built for the fixed ones if it is not already for
+        them, and only ``added`` differs. Otherwise both sets are compared,
+        and the index is (re)built for ``cands`` first if there is none yet,
+        or if ``cands`` has changed too much to keep using it.
+        """
+        if fixed is not None:
+            if self.cand_index is None or self.cand_source is not fixed:
+                self.build_index(fixed)
+                self.cand_source = fixed
+            return (), list(added)
+        index = self.cand_index
+        if index is not None:
+            if isinstance(cands, (set, frozenset)):
+                # teachers edit their set of candidates in place (adding the
+                # labels of each example), so compare the contents
+                removed = index.cands - cands
+                added = list(cands - index.cands)
+                if len(removed) + len(added) <= len(index.cand_list) // 2:
+                    return removed, added
+            elif len(cands) == len(index.cand_list) and all(
+                    a == b for a, b in zip(cands, index.cand_list)):
+                return (), ()
+        self.build_index(cands)
+        self.cand_source = None
+        return (), ()
+
+    def build_index(self, cands):
+        """Builds the index (or the tf-idf matrix) of the candidates."""
+        if self.tfidf:
+            self.cand_index = TfidfCandidateMatrix(cands, self.length_penalty)
         else:
-            reply['text'] = "I don't know."
-        return reply
+            self.cand_index = CandidateIndex(cands)
+
+    def update_weights(self):
+        """Compute the weight of each word in the dictionary, the first time
+        and then once the dictionary has been updated ``idf_refresh`` times
+        more than when they were last computed (so only a logarithmic number
+        of times while training), and apply them to the candidate matrix if
+        they changed or the matrix is new.
+        """
+        if (self.idf is None or self.dict_updates >
+                self.idf_updates * (1 + self.idf_refresh)):
+            freqs = self.dictionary.freqs()
+            ind2tok = self.dictionary.ind2tok
+            self.idf = 1.0 / (1.0 + np.log1p(np.array(
+                [freqs.get(ind2tok[i], 0) for i in range(len(ind2tok))],
+                dtype=float)))
+            self.idf_updates = self.dict_updates
+            self.cand_index.weighted = None
+        if self.cand_index.weighted is None:
+            self.cand_index.set_weights(
+                self.word_weights(self.cand_index.vocab))
+
+    def word_weights(self, vocab):
+        """Returns the weights of the words of a candidate matrix vocab: the
+        idf of the words of the dictionary, and 1 for the others (including
+        words added to the dictionary since the weights were computed, until
+        the next time).
+        """
+        weights = np.ones(len(vocab))
+        tok2ind = self.dictionary.tok2ind
+        for w, col in vocab.items():
+            i = tok2ind.get(w)
+            if i is not None and i < len(self.idf):
+                weights[col] = self.idf[i]
+        return weights
 
     def save(self, fname=None):
         fname = self.opt.get('model_file', None) if fname is None else fname
@@ -142,6 +420,7 @@ class IrBaselineAgent(Agent):
 
     def load(self, fname):
         self.dictionary.load(fname + '.dict')
+        self.idf = None
 
     def build_query_representation(self, query):
         """ Build representation of query, e.g. words or n-grams """
@@ -149,14 +428,13 @@ class IrBaselineAgent(Agent):
         rep['words'] = {}
         words = query.lower().split(' ')
         rw = rep['words']
-        used = {}
+        freqs = self.dictionary.freqs()
         for w in words:
-            if len(self.dictionary.freqs()) > 0:
-                rw[w] = 1.0 / (1.0 + math.log(1.0 + self.dictionary.freqs()[w]))
+            if len(freqs) > 0:
+                # use get so unknown words aren't added to the dictionary
+                rw[w] = 1.0 / (1.0 + math.log(1.0 + freqs.get(w, 0)))
             else:
                 if w not in stopwords:
                     rw[w] = 1
-            used[w] = True
-        norm = len(used)
         rep['norm'] = math.sqrt(len(words))
         return rep
@@ -5,13 +5,17 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from parlai.core.agents import Agent
+from parlai.core.collate import Collator
 from parlai.core.dict import DictionaryAgent
+from parlai.core.worlds import limit_hogwild_threads
 
+from multiprocessing import Value
 from torch.autograd import Variable
 from torch import optim
 import torch.nn as nn
 import torch
 import copy
+import numpy as np
 import os
 import random
 
@@ -42,6 +46,9 @@ class Seq2seqAgent(Agent):
             help='disable GPUs even if available')
         agent.add_argument('--gpu', type=int, default=-1,
             help='which GPU device to use')
+        agent.add_argument('--beam-size', type=int, default=1,
+            help='number of hypotheses kept by beam search when producing ' +
+                 'predictions, 1 means greedy decoding')
 
     def __init__(self, opt, shared=None):
         # initialize defaults first
@@ -57,21 +64,9 @@ class Seq2seqAgent(Agent):
                 opt = self.override_opt(new_opt)
 
             self.dict = DictionaryAgent(opt)
-            self.id = 'Seq2Seq'
-            # we use END markers to break input and output and end our output
-            self.END = self.dict.end_token
-            self.observation = {'text': self.END, 'episode_done': True}
-            self.END_TENSOR = torch.LongTensor(self.dict.parse(self.END))
-
-            # store important params directly
             hsz = opt['hiddensize']
-            self.hidden_size = hsz
-            self.num_layers = opt['numlayers']
-            self.learning_rate = opt['learningrate']
-            self.longest_label = 1
 
             # set up modules
-            self.criterion = nn.NLLLoss()
             # lookup table stores word embeddings
             self.lt = nn.Embedding(len(self.dict), hsz, padding_idx=0,
                                    scale_grad_by_freq=True)
@@ -81,31 +76,69 @@ class Seq2seqAgent(Agent):
             self.decoder = nn.GRU(hsz, hsz, opt['numlayers'])
             # linear layer helps us produce outputs from final decoder state
             self.h2o = nn.Linear(hsz, len(self.dict))
-            # droput on the linear layer helps us generalize
-            self.dropout = nn.Dropout(opt['dropout'])
-            # softmax maps output scores to probabilities
-            self.softmax = nn.LogSoftmax()
-
-            # set up optims for each module
-            lr = opt['learningrate']
-            self.optims = {
-                'lt': optim.SGD(self.lt.parameters(), lr=lr),
-                'encoder': optim.SGD(self.encoder.parameters(), lr=lr),
-                'decoder': optim.SGD(self.decoder.parameters(), lr=lr),
-                'h2o': optim.SGD(self.h2o.parameters(), lr=lr),
-            }
+            # longest label we've ever seen, kept where hogwild copies see it
+            self.longest_label = Value('i', 1)
 
             if hasattr(self, 'states'):
                 # set loaded states if applicable
                 self.set_states(self.states)
-
-            # check for cuda
-            self.use_cuda = not opt.get('no_cuda') and torch.cuda.is_available()
-            if self.use_cuda:
-                print('[ Using CUDA ]')
-                torch.cuda.set_device(opt['gpu'])
-            if self.use_cuda:
-                self.cuda()
+        else:
+            # use the same dictionary and modules as the original agent. the
+            # module parameters are in shared memory, so hogwild copies of this
+            # agent all update the same model (without locking)
+            self.dict = shared['dict']
+            self.lt = shared['lt']
+            self.encoder = shared['encoder']
+            self.decoder = shared['decoder']
+            self.h2o = shared['h2o']
+            self.longest_label = shared['longest_label']
+            for module in (self.lt, self.encoder, self.decoder, self.h2o):
+                for param in module.parameters():
+                    # but each copy accumulates its own gradients
+                    param.grad = None
+            limit_hogwild_threads(opt)
+
+        self.id = 'Seq2Seq'
+        # we use END markers to break input and output and end our output
+        self.END = self.dict.end_token
+        self.observation = {'text': self.END, 'episode_done': True}
+        self.END_TENSOR = torch.LongTensor(self.dict.parse(self.END))
+        self.END_VEC = np.array(self.dict.parse(self.END))
+        self.END_IDX = int(self.END_VEC[0])
+        # pads batches of token ids into reusable buffers
+        self.collator = Collator()
+
+        # store important params directly
+        self.hidden_size = opt['hiddensize']
+        self.num_layers = opt['numlayers']
+        self.learning_rate = opt['learningrate']
+        self.beam_size = opt.get('beam_size', 1)
+
+        self.criterion = nn.NLLLoss()
+        # droput on the linear layer helps us generalize
+        self.dropout = nn.Dropout(opt['dropout'])
+        # softmax maps output scores to probabilities
+        self.softmax = nn.LogSoftmax()
+
+        # set up optims for each module
+        lr = opt['learningrate']
+        self.optims = {
+            'lt': optim.SGD(self.lt.parameters(), lr=lr),
+            'encoder': optim.SGD(self.encoder.parameters(), lr=lr),
+            'decoder': optim.SGD(self.decoder.parameters(), lr=lr),
+            'h2o': optim.SGD(self.h2o.parameters(), lr=lr),
+        }
+
+        # check for cuda
+        self.use_cuda = not opt.get('no_cuda') and torch.cuda.is_available()
+        if self.use_cuda:
+            if opt.get('numthreads', 1) > 1:
+                raise RuntimeError('numthreads > 1 is only supported on CPU, '
+                                   'use --no-cuda.')
+            print('[ Using CUDA ]')
+            torch.cuda.set_device(opt['gpu'])
+        if self.use_cuda:
+            self.cuda()
 
         self.episode_done = True
 
@@ -120,9 +153,33 @@ class Seq2seqAgent(Agent):
             self.opt[k] = v
         return self.opt
 
+    def share(self):
+        """Share the dictionary and the modules (in shared memory if there are
+        several hogwild processes).
+        """
+        shared = super().share()
+        shared['dict'] = self.dict
+        for name in ('lt', 'encoder', 'decoder', 'h2o'):
+            module = getattr(self, name)
+            if self.opt.get('numthreads', 1) > 1:
+                module.share_memory()
+            shared[name] = module
+        shared['longest_label'] = self.longest_label
+        return shared
+
     def parse(self, text):
         return torch.LongTensor(self.dict.txt2vec(text))
 
+    def parse_ex(self, ex, field='text', idx=None):
+        """Returns the token ids of the text (or the label at ``idx``) of the
+        example, using the ids sent by the teacher if available.
+        """
+        vec = ex.get(field + '_vec')
+        if vec is not None:
+            return vec if idx is None else vec[idx]
+        text = ex[field] if idx is None else ex[field][idx]
+        return self.dict.txt2vec(text)
+
     def v2t(self, vec):
         return self.dict.vec2txt(vec)
 
@@ -148,6 +205,100 @@ class Seq2seqAgent(Agent):
         _max_score, idx = scores.max(1)
         return idx, scores
 
+    def greedy_search(self, xes, hn, batchsize):
+        """Produces the most likely token at each step, until every example
+        in the batch has produced END or the longest label has been reached.
+        Returns the ``batchsize x steps`` tensor of produced token ids.
+        """
+        ids = []
+        done = None
+        for _ in range(self.longest_label.value):
+            output, hn = self.decoder(xes, hn)
+            preds, _scores = self.hidden_to_idx(output, dropout=False)
+            preds = preds.view(batchsize, 1)
+            ids.append(preds)
+            ended = preds.view(-1).eq(self.END_IDX)
+            done = ended if done is None else done | ended
+            if done.data.all():
+                break
+            xes = self.lt(preds.t())
+        return torch.cat(ids, 1)
+
+    def beam_search(self, xes, hn, batchsize):
+        """Keeps the ``beam_size`` most likely sequences of each example,
+        running the decoder over all the hypotheses of the batch at once, until
+        they have all produced END or the longest label has been reached.
+        Returns the ``batchsize x steps`` tensor of the token ids of the best
+        hypothesis of each example, and the ``batchsize`` tensor of their
+        log-probabilities.
+        """
+        beam = self.beam_size
+        hyps = batchsize * beam
+        # each example starts with beam copies of its encoding, and every
+        # hypothesis with the same END input
+        hn = hn.unsqueeze(2).expand(hn.size(0), batchsize, beam, hn.size(2))
+        hn = hn.contiguous().view(hn.size(0), hyps, hn.size(3))
+        xes = xes.narrow(1, 0, 1).expand(1, hyps, xes.size(2))
+
+        # only the first copy is expanded at the first step, so that the
+        # beam does not fill up with copies of the same hypothesis
+        scores = xes.data.new(batchsize, beam).fill_(-float('inf'))
+        scores[:, 0] = 0
+        scores = Variable(scores)
+        # finished hypotheses only keep producing END at no cost (any other
+        # token costs too much to be kept, without the nans of -inf * 0)
+        end_scores = xes.data.new(1, len(self.dict)).fill_(-1e20)
+        end_scores[0, self.END_IDX] = 0
+        end_scores = Variable(end_scores)
+        # offset of each example's first hypothesis among all of them
+        offsets = torch.arange(0, hyps, beam).long().view(batchsize, 1)
+        if self.use_cuda:
+            offsets = offsets.cuda()
+        offsets = Variable(offsets)
+
+        ids = None
+        done = None
+        for _ in range(self.longest_label.value):
+            output, hn = self.decoder(xes, hn)
+            token_scores = self.softmax(self.h2o(output.squeeze(0)))
+            if done is not None:
+                finished = done.view(hyps, 1).type_as(token_scores)
+                token_scores = (finished * end_scores +
+                                (1 - finished) * token_scores)
+            # best continuations of all hypotheses of each example
+            token_scores = scores.view(hyps, 1) + token_scores
+            scores, best = token_scores.view(batchsize, -1).topk(beam, 1)
+            origins = best // len(self.dict)
+            preds = best - origins * len(self.dict)
+
+            # reorder the hypotheses to follow the ones they continue
+            flat_origins = (origins + offsets).view(-1)
+            hn = hn.index_select(1, flat_origins)
+            if ids is None:
+                ids = preds.unsqueeze(2)
+                done = preds.eq(self.END_IDX)
+            else:
+                ids = ids.view(hyps, -1).index_select(0, flat_origins)
+                ids = torch.cat([ids.view(batchsize, beam, -1),
+                                 preds.unsqueeze(2)], 2)
+                done = done.gather(1, origins) | preds.eq(self.END_IDX)
+            if done.data.all():
+                break
+            xes = self.lt(preds.view(1, hyps))
+        # the hypotheses are sorted by score, so the best one comes first
+        return ids[:, 0, :], scores[:, 0]
+
+    def ids_to_lines(self, ids):
+        """Converts a tensor of token ids produced by the decoder into the
+        list of tokens of each example, stopping at its first END.
+        """
+        lines = []
+        for line in ids.data.cpu().tolist():
+            if self.END_IDX in line:
+                line = line[:line.index(self.END_IDX)]
+            lines.append([self.dict[idx] for idx in line])
+        return lines
+
     def zero_grad(self):
         for optimizer in self.optims.values():
             optimizer.zero_grad()
@@ -176,6 +327,11 @@ class Seq2seqAgent(Agent):
             # recall what was said in that example
             prev_dialogue = self.observation['text']
             observation['text'] = prev_dialogue + '\n' + observation['text']
+            if 'text_vec' in observation and 'text_vec' in self.observation:
+                observation['text_vec'] = np.concatenate(
+                    (self.observation['text_vec'], observation['text_vec']))
+            else:
+                observation.pop('text_vec', None)
         self.observation = observation
         self.episode_done = observation['episode_done']
         return observation
@@ -202,47 +358,38 @@ class Seq2seqAgent(Agent):
         if ys is not None:
             # update the model based on the labels
             self.zero_grad()
-            loss = 0
             # keep track of longest label we've ever seen
-            self.longest_label = max(self.longest_label, ys.size(1))
-            for i in range(ys.size(1)):
-                output, hn = self.decoder(xes, hn)
-                preds, scores = self.hidden_to_idx(output, dropout=True)
-                y = ys.select(1, i)
-                loss += self.criterion(scores, y)
-                # use the true token as the next input instead of predicted
-                # this produces a biased prediction but better training
-                xes = self.lt(y).unsqueeze(0)
-                for b in range(batchsize):
-                    # convert the output scores to tokens
-                    token = self.v2t([preds.data[b][0]])
-                    output_lines[b].append(token)
-
+            self.longest_label.value = max(self.longest_label.value,
+                                           ys.size(1))
+            # use the true tokens as the inputs instead of predicted ones
+            # (this produces a biased prediction but better training), so the
+            # decoder can run over the whole label sequence in a single call:
+            # its inputs are END followed by every token of the label but last
+            if ys.size(1) > 1:
+                y_in = self.lt(ys.narrow(1, 0, ys.size(1) - 1))
+                xes = torch.cat([xes, y_in.transpose(0, 1)], 0)
+            output, hn = self.decoder(xes, hn)
+            # score every step of every example at once
+            scores = self.h2o(output.view(-1, output.size(2)))
+            scores = self.softmax(self.dropout(scores))
+            y = ys.t().contiguous().view(-1)
+            # the criterion averages over steps too, while the loss is the
+            # sum of the loss of each step
+            loss = self.criterion(scores, y) * ys.size(1)
             loss.backward()
             self.update_params()
+
+            # convert the output scores to tokens
+            _max_score, preds = scores.max(1)
+            preds = preds.view(ys.size(1), batchsize).t().data.cpu().tolist()
+            output_lines = [[self.dict[idx] for idx in line] for line in preds]
         else:
             # just produce a prediction without training the model
-            done = [False for _ in range(batchsize)]
-            total_done = 0
-            max_len = 0
-
-            while(total_done < batchsize) and max_len < self.longest_label:
-                # keep producing tokens until we hit END or max length for each
-                # example in the batch
-                output, hn = self.decoder(xes, hn)
-                preds, scores = self.hidden_to_idx(output, dropout=False)
-                xes = self.lt(preds.t())
-                max_len += 1
-                for b in range(batchsize):
-                    if not done[b]:
-                        # only add more tokens for examples that aren't done yet
-                        token = self.v2t(preds.data[b])
-                        if token == self.END:
-                            # if we produced END, we're done
-                            done[b] = True
-                            total_done += 1
-                        else:
-                            output_lines[b].append(token)
+            if self.beam_size > 1:
+                ids, _scores = self.beam_search(xes, hn, batchsize)
+            else:
+                ids = self.greedy_search(xes, hn, batchsize)
+            output_lines = self.ids_to_lines(ids)
             if random.random() < 0.1:
                 print('prediction:', ' '.join(output_lines[0]))
 
@@ -257,16 +404,10 @@ class Seq2seqAgent(Agent):
         valid_inds = [i for i, ex in enumerate(observations) if 'text' in ex]
 
         # set up the input tensors
-        batchsize = len(exs)
         # tokenize the text
-        parsed = [self.parse(ex['text']) for ex in exs]
-        max_x_len = max([len(x) for x in parsed])
-        xs = torch.LongTensor(batchsize, max_x_len).fill_(0)
+        parsed = [self.parse_ex(ex) for ex in exs]
         # pack the data to the right side of the tensor for this model
-        for i, x in enumerate(parsed):
-            offset = max_x_len - len(x)
-            for j, idx in enumerate(x):
-                xs[i][j + offset] = idx
+        xs = torch.from_numpy(self.collator.pad('xs', parsed, left=True)[0])
         if self.use_cuda:
             xs = xs.cuda(async=True)
         xs = Variable(xs)
@@ -276,13 +417,12 @@ class Seq2seqAgent(Agent):
         if 'labels' in exs[0]:
             # randomly select one of the labels to update on, if multiple
             # append END to each label
-            labels = [random.choice(ex['labels']) + ' ' + self.END for ex in exs]
-            parsed = [self.parse(y) for y in labels]
-            max_y_len = max(len(y) for y in parsed)
-            ys = torch.LongTensor(batchsize, max_y_len).fill_(0)
-            for i, y in enumerate(parsed):
-                for j, idx in enumerate(y):
-                    ys[i][j] = idx
+            parsed = []
+            for ex in exs:
+                label = self.parse_ex(ex, 'labels',
+                                      random.randrange(len(ex['labels'])))
+                parsed.append(np.concatenate((label, self.END_VEC)))
+            ys = torch.from_numpy(self.collator.pad('ys', parsed)[0])
             if self.use_cuda:
                 ys = ys.cuda(async=True)
             ys = Variable(ys)
@@ -327,7 +467,7 @@ class Seq2seqAgent(Agent):
             model['encoder'] = self.encoder.state_dict()
             model['decoder'] = self.decoder.state_dict()
             model['h2o'] = self.h2o.state_dict()
-            model['longest_label'] = self.longest_label
+            model['longest_label'] = self.longest_label.value
             model['opt'] = self.opt
 
             with open(path, 'wb') as write:
@@ -346,4 +486,4 @@ class Seq2seqAgent(Agent):
         self.encoder.load_state_dict(states['encoder'])
         self.decoder.load_state_dict(states['decoder'])
         self.h2o.load_state_dict(states['h2o'])
-        self.longest_label = states['longest_label']
+        self.longest_label.value = states['longest_label']
@@ -0,0 +1,110 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Provides utilities for collating lists of sequences (e.g. token ids, or
+per-token feature vectors) into padded batch matrices.
+
+``pad_sequences`` builds the padded matrix, the lengths and the mask of a list
+of sequences in a single vectorized pass, instead of writing them into the
+matrix one sequence (or one element) at a time.
+
+``Collator`` does the same into preallocated buffers which it reuses from one
+batch to the next, so that no memory has to be allocated per batch once the
+buffers have grown to the largest batch. The arrays it returns are only valid
+until the next call with the same name, so copy them if you need to keep them
+around.
+
+The results are numpy arrays: use ``torch.from_numpy`` to get tensors which
+share their memory.
+"""
+
+import numpy as np
+
+
+def _lengths_and_flat(seqs, dtype):
+    """Returns the lengths of the sequences and all of their elements
+    concatenated into a single array.
+    """
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64,
+                          count=len(seqs))
+    seqs = [np.asarray(s, dtype=dtype) for s in seqs]
+    if lengths.sum() == 0:
+        trailing = seqs[0].shape[1:] if len(seqs) > 0 else ()
+        return lengths, np.empty((0,) + trailing, dtype=dtype)
+    return lengths, np.concatenate([s for s in seqs if len(s) > 0])
+
+
+def _fill(out, mask, lengths, flat, null, left):
+    """Writes the elements of ``flat`` to the unmasked positions of ``out``
+    and ``null`` everywhere else.
+    """
+    positions = np.arange(out.shape[1])
+    if left:
+        np.greater_equal(positions, out.shape[1] - lengths[:, None], out=mask)
+    else:
+        np.less(positions, lengths[:, None], out=mask)
+    out.fill(null)
+    # boolean indexing visits the matrix in row-major order, which is the
+    # order of the elements of the concatenated sequences
+    out[mask] = flat
+
+
+def pad_sequences(seqs, null=0, left=False, dtype=np.int64):
+    """Pads a list of sequences into a matrix.
+
+    ``seqs`` is a list of sequences (lists, numpy arrays or tensors), which can
+    have trailing dimensions (e.g. a feature vector per token) as long as they
+    are the same for every sequence.
+    If ``left`` is set, the sequences are aligned to the right side of the
+    matrix, with the padding on the left.
+
+    Returns a tuple of ``(padded, lengths, mask)``: the padded
+    ``(len(seqs), max_len, ...)`` matrix, the length of each sequence, and a
+    boolean ``(len(seqs), max_len)`` matrix which is ``True`` for the elements
+    which are not padding.
+    """
+    lengths, flat = _lengths_and_flat(seqs, dtype)
+    max_len = int(lengths.max()) if len(lengths) > 0 else 0
+    out = np.empty((len(seqs), max_len) + flat.shape[1:], dtype=dtype)
+    mask = np.empty((len(seqs), max_len), dtype=bool)
+    _fill(out, mask, lengths, flat, null, left)
+    return out, lengths, mask
+
+
+class Collator(object):
+    """Pads lists of sequences into matrices like ``pad_sequences``, but into
+    buffers which are reused across calls. Each ``name`` gets its own buffers,
+    so for instance inputs and targets can be collated into ``'xs'`` and
+    ``'ys'`` and both stay valid together.
+    """
+
+    def __init__(self):
+        # name => flat buffer for the padded matrix, flat buffer for the mask
+        self.buffers = {}
+
+    def _buffer(self, name, shape, dtype):
+        """Returns a contiguous array of the given shape, backed by the buffer
+        for name. The buffer is grown to twice the needed size when too small,
+        so it settles quickly on the largest batches.
+        """
+        size = int(np.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(max(2 * size, 1), dtype=dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def pad(self, name, seqs, null=0, left=False, dtype=np.int64):
+        """Same as ``pad_sequences``, but writes into the buffers for
+        ``name``.
+        """
+        lengths, flat = _lengths_and_flat(seqs, dtype)
+        max_len = int(lengths.max()) if len(lengths) > 0 else 0
+        out = self._buffer(name, (len(seqs), max_len) + flat.shape[1:],
+                           np.dtype(dtype))
+        mask = self._buffer(name + '.mask', (len(seqs), max_len),
+                            np.dtype(bool))
+        _fill(out, mask, lengths, flat, null, left)
+        return out, lengths, mask
@@ -6,8 +6,13 @@
 
 from .agents import Teacher
 
+from .dict import DictionaryAgent
 from .image_featurizers import ImageLoader
+from .mapped_file import MappedFormat, stable_hash
+from .params import str2class
 from PIL import Image
+import hashlib
+import numpy as np
 import random
 import os
 import sys
@@ -24,7 +29,49 @@ class DialogTeacher(Teacher):
     - metrics tracking count of sent vs correctly answered queries
 
     If you have ``opt.numthreads > 1``, this also activates a shared memory
-    array for the data and lock-protected shared-memory metrics.
+    array for the data and shared-memory metrics, to which each process adds
+    its own results without locking (see ``Metrics``).
+
+    If ``opt['dialog_data']`` is set to ``'compiled'``, the data is compiled
+    into a memory-mapped binary file next to ``opt['datafile']`` the first time
+    the teacher is created, and read from that file afterwards (see
+    ``CompiledDialogData``). If it is set to ``'stream'``, the data is read
+    lazily from ``setup_data()`` every time it is needed instead, so that
+    datasets which do not fit in memory can be used (see ``StreamDialogData``).
+    If it is set to ``'indexed'``, episodes are read one at a time straight from
+    the data file through an index built by the teacher, for teachers which
+    implement ``index_episodes()`` and ``setup_episode()`` like
+    ``FbDialogTeacher`` (see ``IndexedDialogData``).
+
+    If ``opt['vec_cache']`` is set, the text (and, when training, the labels)
+    of each example are also sent as token ids from the dictionary in
+    ``opt['dict_file']`` in the ``text_vec`` and ``labels_vec`` fields, which
+    are only computed once for each version of the data and dictionary (see
+    ``VecCache``).
+
+    If ``opt['batch_sort']`` is set, episodes are sorted by the number of
+    tokens in their text and labels (counted once when the teacher is
+    created), and the teachers of a batch take neighbouring episodes in that
+    order, so the examples of each batch have similar lengths and need less
+    padding. When training, every teacher of the batch picks the same random
+    batch of neighbouring episodes each time, from a random sequence which is
+    different for each hogwild process (``opt['threadindex']``) and for each
+    epoch (each ``reset()``). The teachers of a batch move on
+    to the next batch together, once the longest episode (in entries) of the
+    batch is done: those whose episode is shorter send empty actions (no
+    text) until then.
+
+    If ``opt['batch_tokens']`` is set, batches of neighbouring episodes hold as
+    many episodes as fit that many tokens once padded to the longest one (and
+    at most ``opt['batchsize']``), instead of always ``opt['batchsize']``. The
+    teachers of the batch which have no episode in a small batch send an
+    empty action (no text) for that step.
+
+    If ``opt['context_ids']`` is set, examples whose text was given as a
+    ``(context, query)`` pair by ``setup_data()`` (see ``DialogData``) also
+    have a ``context_id`` field, which is the same for every example with the
+    same context, so agents can reuse the work they did on a context (e.g.
+    the encoding of a paragraph) for all of its queries.
 
     In order to subclass this class, you must implement ``setup_data()`` in your
     class (or subclass another class which does, like ``FbDialogTeacher``), which
@@ -46,11 +93,39 @@ class DialogTeacher(Teacher):
         # first initialize any shared objects
         self.random = self.datatype == 'train'
         if shared and shared.get('data'):
-            self.data = DialogData(opt, None, cands=self.label_candidates(),
-                                    shared=shared['data'].share())
+            data_class = type(shared['data'])
+            self.data = data_class(opt, None, cands=self.label_candidates(),
+                                   shared=shared['data'].share())
+        elif opt.get('dialog_data', 'memory') == 'compiled':
+            self.data = CompiledDialogData(opt, self.setup_data(opt['datafile']),
+                                           cands=self.label_candidates(),
+                                           path=self.compiled_data_path(opt))
+        elif opt.get('dialog_data', 'memory') == 'stream':
+            self.data = StreamDialogData(
+                opt, lambda: self.setup_data(opt['datafile']),
+                cands=self.label_candidates(),
+                path=self.data_count_path(opt))
+        elif opt.get('dialog_data', 'memory') == 'indexed':
+            if not hasattr(self, 'setup_episode'):
+                raise RuntimeError('--dialog-data indexed needs a teacher ' +
+                                   'which implements index_episodes() and ' +
+                                   'setup_episode() (e.g. FbDialogTeacher).')
+            num_episodes, num_entries = self.index_episodes(opt['datafile'])
+            self.data = IndexedDialogData(
+                opt, lambda i: self.setup_episode(opt['datafile'], i),
+                num_episodes, num_entries, cands=self.label_candidates())
         else:
             self.data = DialogData(opt, self.setup_data(opt['datafile']),
                                     cands=self.label_candidates())
+        self.stream = isinstance(self.data, StreamDialogData)
+
+        if shared and shared.get('vecs'):
+            self.vecs = VecCache(opt, None, shared=shared['vecs'].share())
+        elif opt.get('vec_cache'):
+            self.vecs = VecCache(opt, lambda: self.setup_data(opt['datafile']),
+                                 path=self.vec_cache_path(opt))
+        else:
+            self.vecs = None
 
         # for ordered data in batch mode (especially, for validation and
         # testing), each teacher in the batch gets a start index and a step
@@ -58,6 +133,42 @@ class DialogTeacher(Teacher):
         self.step_size = opt.get('batchsize', 1)
         self.data_offset = opt.get('batchindex', 0)
 
+        if shared and shared.get('batch_order') is not None:
+            self.batch_order = shared['batch_order']
+            self.batch_bounds = shared['batch_bounds']
+            self.batch_steps = shared['batch_steps']
+            self.batch_seed = shared['batch_seed']
+        elif opt.get('batch_sort') or opt.get('batch_tokens'):
+            if self.stream:
+                raise RuntimeError('--batch-sort and --batch-tokens need the ' +
+                                   'length of every episode up front, which ' +
+                                   'is not possible with --dialog-data stream.')
+            lengths = np.array(self.data.episode_lengths(), dtype=np.int64)
+            if opt.get('batch_sort'):
+                # shuffle first so that episodes of the same length end up in
+                # different batches from one run to the next
+                perm = np.random.permutation(len(lengths))
+                self.batch_order = perm[np.argsort(lengths[perm],
+                                                   kind='stable')]
+            else:
+                self.batch_order = np.arange(len(lengths))
+            self.batch_bounds = self.split_batches(
+                lengths[self.batch_order], opt.get('batch_tokens'))
+            # number of steps of each batch: the most entries of its episodes
+            sizes = np.array(self.data.episode_sizes(), dtype=np.int64)
+            if len(sizes) > 0:
+                self.batch_steps = np.maximum.reduceat(
+                    sizes[self.batch_order], self.batch_bounds[:-1]).tolist()
+            else:
+                # no data, so no batches
+                self.batch_steps = []
+            # seeds the random batches, drawn once and shared with the other
+            # teachers of the batch (and the hogwild processes)
+            self.batch_seed = random.randrange(1 << 31)
+        else:
+            self.batch_order = None
+        self.batch_epochs = 0
+
         self.reset()
 
     def reset(self):
@@ -67,8 +178,23 @@ class DialogTeacher(Teacher):
         self.lastY = None
         self.episode_idx = self.data_offset - self.step_size
         self.episode_done = True
+        if self.batch_order is not None:
+            self.batch_idx = -1
+            self.batch_step = 0
+            # all teachers of the batch draw the same random batches, but
+            # hogwild processes and epochs each draw their own
+            self.batch_random = random.Random('{}:{}:{}'.format(
+                self.batch_seed, self.opt.get('threadindex', 0),
+                self.batch_epochs))
+            self.batch_epochs += 1
         self.epochDone = False
-        if not self.random and self.data_offset >= self.data.num_episodes():
+        if self.stream:
+            # start reading from the beginning of the data again
+            self.data.reset()
+            if not self.random and self.data.next_episode is None:
+                # could have bigger batchsize then episodes... so nothing to do
+                self.epochDone = True
+        elif not self.random and self.data_offset >= self.data.num_episodes():
             # could have bigger batchsize then episodes... so nothing to do
             self.epochDone = True
 
@@ -86,8 +212,47 @@ class DialogTeacher(Teacher):
     def share(self):
         shared = super().share()
         shared['data'] = self.data
+        shared['vecs'] = self.vecs
+        shared['batch_order'] = self.batch_order
+        if self.batch_order is not None:
+            shared['batch_bounds'] = self.batch_bounds
+            shared['batch_steps'] = self.batch_steps
+            shared['batch_seed'] = self.batch_seed
         return shared
 
+    def compiled_data_path(self, opt):
+        """Returns the path of the compiled data file for this teacher. The
+        teacher class, task and datatype are hashed into the name, since
+        different teachers can read the same ``datafile`` differently.
+        """
+        key = '{}.{}:{}:{}'.format(type(self).__module__, type(self).__name__,
+                                   opt.get('task'),
+                                   opt['datatype'].split(':')[0])
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:8]
+        return '{}.{}.dialog'.format(opt['datafile'], digest)
+
+    def data_count_path(self, opt):
+        """Returns the path of the file which keeps the number of episodes and
+        entries of the data for ``StreamDialogData``.
+        """
+        return os.path.splitext(self.compiled_data_path(opt))[0] + '.count'
+
+    def vec_cache_path(self, opt):
+        """Returns the path of the token id cache for this teacher, which
+        depends on the dictionary and on how it tokenizes text.
+        """
+        if not opt.get('dict_file') or not os.path.isfile(opt['dict_file']):
+            raise RuntimeError('--vec-cache needs a dictionary, but ' +
+                               '--dict-file is not set to an existing file.')
+        key = hashlib.md5()
+        key.update(self.compiled_data_path(opt).encode('utf-8'))
+        with open(opt['dict_file'], 'rb') as read:
+            for chunk in iter(lambda: read.read(1 << 20), b''):
+                key.update(chunk)
+        for k in VecCache.TOKENIZER_OPTS:
+            key.update('{}={}'.format(k, opt.get(k)).encode('utf-8'))
+        return '{}.{}.vecs'.format(opt['datafile'], key.hexdigest()[:8])
+
     def label_candidates(self):
         """Returns ``None`` by default, but override this in children (such as
         ``FbDialogTeacher``) to load up candidate labels for every example.
@@ -101,7 +266,35 @@ class DialogTeacher(Teacher):
             self.lastY = None
         return observation
 
+    def batch_observe(self, teachers, observations):
+        """Process the observations of a batch of copies of this teacher (the
+        teachers of a ``BatchWorld``), which share its metrics, scoring them
+        together with ``Metrics.batch_update``.
+        """
+        if any(type(t) is not type(self) or t.metrics is not self.metrics
+               for t in teachers) or type(self).observe is not \
+                DialogTeacher.observe:
+            # e.g. different tasks, or a teacher with its own observe
+            return [t.observe(obs) for t, obs in zip(teachers, observations)]
+        scored = [i for i, t in enumerate(teachers) if t.lastY is not None]
+        if len(scored) > 0:
+            self.metrics.batch_update([observations[i] for i in scored],
+                                      [teachers[i].lastY for i in scored])
+            for i in scored:
+                teachers[i].lastY = None
+        return observations
+
     def next_example(self):
+        if self.stream:
+            # the stream keeps track of its own position in the data
+            action, epoch_done = self.data.get()
+            if self.random:
+                epoch_done = False
+            return action, epoch_done
+
+        if self.batch_order is not None:
+            return self.next_batch_example()
+
         num_eps = self.data.num_episodes()
         if self.episode_done:
             if self.random:
@@ -114,17 +307,90 @@ class DialogTeacher(Teacher):
         else:
             self.entry_idx += 1
 
-        action, epoch_done = self.data.get(self.episode_idx, self.entry_idx)
+        action, _end_of_data = self.data.get(self.episode_idx, self.entry_idx)
 
-        if self.random:
-            epoch_done = False
-        elif (self.episode_idx + self.step_size >= num_eps and
-                action['episode_done']):
-            # this is used for ordered data to check whether there's more data
-            epoch_done = True
+        # this is used for ordered data to check whether there's more data
+        epoch_done = (not self.random and action['episode_done'] and
+                      self.episode_idx + self.step_size >= num_eps)
 
         return action, epoch_done
 
+    def next_batch_example(self):
+        """Returns the next entry of this teacher's episode in the current
+        batch, or an empty action once the episode is done (or if the batch
+        has no episode for this teacher), moving on to the next batch once
+        all of the episodes of the batch are done. All the teachers of the
+        batch act once per step, so they move on together.
+        """
+        if self.batch_idx < 0 or (self.batch_step ==
+                                  self.batch_steps[self.batch_idx]):
+            # select this teacher's episode in the next batch
+            self.episode_idx = self.next_batch_episode()
+            self.batch_step = 0
+            self.entry_idx = -1
+            self.batch_episode_done = self.episode_idx is None
+        if self.batch_idx < 0:
+            # there are no batches (no data), so there is nothing to send
+            return {'episode_done': True}, not self.random
+        self.batch_step += 1
+        epoch_done = (self.batch_step == self.batch_steps[self.batch_idx] and
+                      self.last_batch())
+        if self.batch_episode_done:
+            return {'episode_done': True}, epoch_done
+        self.entry_idx += 1
+        action, _end_of_data = self.data.get(self.episode_idx, self.entry_idx)
+        self.batch_episode_done = action['episode_done']
+        return action, epoch_done
+
+    def split_batches(self, lengths, max_tokens=None):
+        """Splits episodes with the given lengths (in batch order) into
+        batches of neighbouring episodes, and returns the position of the
+        first episode of each batch followed by the number of episodes.
+        Batches hold ``batchsize`` episodes, or fewer if ``max_tokens`` is set
+        and more would not fit in that many tokens once padded. There are no
+        batches if there are no episodes.
+        """
+        if len(lengths) == 0:
+            return [0]
+        bounds = [0]
+        longest = 0
+        for i, length in enumerate(lengths.tolist()):
+            longest = max(longest, length)
+            size = i - bounds[-1] + 1
+            if size > 1 and (size > self.step_size or
+                             (max_tokens and longest * size > max_tokens)):
+                bounds.append(i)
+                longest = length
+        bounds.append(len(lengths))
+        return bounds
+
+    def next_batch_episode(self):
+        """Moves on to the next batch of episodes (a random one when
+        training), and returns the index of the episode of this teacher in
+        it, or ``None`` if the batch is too small to have one (or if there are
+        no batches at all). All the teachers of the batch draw from the same
+        random sequence, so they pick the same batch as long as they stay in
+        step.
+        """
+        num_batches = len(self.batch_bounds) - 1
+        if num_batches == 0:
+            # no data (e.g. an empty training set), so nothing to pick from
+            self.batch_idx = -1
+            return None
+        if self.random:
+            self.batch_idx = self.batch_random.randrange(num_batches)
+        else:
+            self.batch_idx = (self.batch_idx + 1) % num_batches
+        start = self.batch_bounds[self.batch_idx]
+        if start + self.data_offset >= self.batch_bounds[self.batch_idx + 1]:
+            return None
+        return int(self.batch_order[start + self.data_offset])
+
+    def last_batch(self):
+        """Whether the current batch is the last one of ordered data."""
+        return (not self.random and
+                self.batch_idx == len(self.batch_bounds) - 2)
+
     def act(self):
         """Send new dialog message."""
         if self.epochDone:
@@ -135,6 +401,8 @@ class DialogTeacher(Teacher):
         self.lastY = action.get('labels', None)
         if not self.datatype.startswith('train'):
             action.pop('labels', None)
+        if self.vecs is not None:
+            self.vecs.add_vecs(action)
         return action
 
     # Return transformed metrics showing total examples and accuracy if avail.
@@ -142,6 +410,32 @@ class DialogTeacher(Teacher):
         return self.metrics.report()
 
 
+def _full_text(text):
+    """Returns the text of an entry, joining the context and the query if it
+    is a ``(context, query)`` pair.
+    """
+    if type(text) is tuple:
+        return text[0] + '\n' + text[1]
+    return text
+
+
+def _context_id(context):
+    """Returns a 64-bit id of the context, stable across processes and across
+    the different ways of storing the data.
+    """
+    return stable_hash(context)
+
+
+def _num_tokens(text, labels=None):
+    """Counts the whitespace separated tokens of the text and of the longest
+    label.
+    """
+    num = 0 if text is None else len(_full_text(text).split())
+    if labels:
+        num += max(len(label.split()) for label in labels)
+    return num
+
+
 class DialogData(object):
     """Provides a data structure for accessing textual dialog data.
     This can be used whenever the dialog data is a fixed log of chats
@@ -157,7 +451,12 @@ class DialogData(object):
 
         Where
 
-        - ``x`` is a query and possibly context
+        - ``x`` is a query and possibly context. When many queries share the
+          same (long) context, like the questions about a paragraph in
+          reading comprehension, ``x`` can be a ``(context, query)`` tuple
+          instead: the context is then stored once for all of them, and the
+          text ``context + '\n' + query`` is only built when an entry is
+          returned
 
         ``...`` can contain additional fields, specifically
 
@@ -171,7 +470,11 @@ class DialogData(object):
 
     ``cands`` can be set to provide a list of candidate labels for every example
     in this dataset, which the agent can choose from (the correct answer
-    should be in this set).
+    should be in this set). The labels of an example which are not in it are
+    added to the ``label_candidates`` of that example. Such examples also have
+    ``label_candidates_fixed``, the set of the given candidates (which is never
+    modified, so agents can build an index of it once), and
+    ``label_candidates_added``, the labels added to it for that example.
 
 
     ``random`` tells the data class whether or not to visit episodes sequentially
@@ -182,22 +485,35 @@ class DialogData(object):
         # self.data is a list of episodes
         # each episode is a tuple of entries
         # each entry is a tuple of values for the action/observation table
-        self.opt = opt
+        self._setup_common(opt, cands, shared)
         if shared:
             self.data = shared.get('data', [])
+        else:
+            self.data = []
+            self._load(data_loader)
+
+    def _setup_common(self, opt, cands, shared):
+        """Sets up the members every data class has: the label candidates and
+        the image loader, taken from ``shared`` if set.
+        """
+        self.opt = opt
+        if shared:
             self.cands = shared.get('cands', None)
             self.image_loader = shared.get('image_loader', None)
         else:
             self.image_loader = ImageLoader(opt)
-            self.data = []
-            self._load(data_loader)
-            self.cands = None if cands == None else set(sys.intern(c) for c in cands)
+            self.cands = (None if cands is None
+                          else set(sys.intern(c) for c in cands))
         self.addedCands = []
         self.copied_cands = False
 
+    def _share_common(self):
+        """Returns the shared members set up by ``_setup_common()``."""
+        return {'cands': self.cands, 'image_loader': self.image_loader}
+
     def share(self):
-        shared = {'data': self.data, 'cands': self.cands,
-                'image_loader': self.image_loader}
+        shared = self._share_common()
+        shared['data'] = self.data
         return shared
 
     def __len__(self):
@@ -210,11 +526,18 @@ class DialogData(object):
         """Loads up data from an iterator over tuples described in the class
         docs.
         """
+        for episode in self._read_episodes(data_loader):
+            self.data.append(episode)
+
+    def _read_episodes(self, data_loader):
+        """Yields each episode from ``data_loader`` as a tuple of entries, with
+        every string interned and every entry checked for the right types.
+        """
         episode = []
         last_cands = None
         for entry, new in data_loader:
             if new and len(episode) > 0:
-                self.data.append(tuple(episode))
+                yield tuple(episode)
                 episode = []
                 last_cands = None
 
@@ -222,10 +545,15 @@ class DialogData(object):
             new_entry = []
             if len(entry) > 0:
                 # process text if available
-                if entry[0] is not None:
-                    new_entry.append(sys.intern(entry[0]))
-                else:
+                if entry[0] is None:
                     new_entry.append(None)
+                elif type(entry[0]) is tuple:
+                    if len(entry[0]) != 2:
+                        raise TypeError('Text must be a string or a ' +
+                                        '(context, query) tuple.')
+                    new_entry.append(tuple(sys.intern(e) for e in entry[0]))
+                else:
+                    new_entry.append(sys.intern(entry[0]))
                 if len(entry) > 1:
                     # process labels if available
                     if entry[1] is None:
@@ -263,23 +591,56 @@ class DialogData(object):
             episode.append(tuple(new_entry))
 
         if len(episode) > 0:
-            self.data.append(tuple(episode))
+            yield tuple(episode)
 
     def num_episodes(self):
         """Return number of episodes in the dataset."""
         return len(self.data)
 
+    def episode_lengths(self):
+        """Returns the number of (whitespace separated) tokens in the text and
+        labels of each episode.
+        """
+        return [sum(_num_tokens(*entry[:2]) for entry in episode if entry)
+                for episode in self.data]
+
+    def episode_sizes(self):
+        """Returns the number of entries of each episode."""
+        return [len(episode) for episode in self.data]
+
     def get(self, episode_idx, entry_idx=0):
         """Returns a specific entry from the dataset."""
         # first look up data
         episode = self.data[episode_idx]
-        entry = episode[entry_idx]
         episode_done = entry_idx == len(episode) - 1
         end_of_data = episode_done and episode_idx == len(self.data) - 1
 
         # now pack it in a action-observation dictionary
+        table = self.build_table(self._resolve_cands(episode, entry_idx))
+
+        # last entry in this episode
+        table['episode_done'] = episode_done
+        return table, end_of_data
+
+    def _resolve_cands(self, episode, entry_idx):
+        """Returns the entry at ``entry_idx``, replacing "same as last time"
+        with the label candidates stored earlier in the episode.
+        """
+        entry = episode[entry_idx]
+        if len(entry) > 3 and type(entry[3]) is str:
+            cands = next(e[3] for e in reversed(episode[:entry_idx])
+                         if len(e) > 3 and type(e[3]) is tuple)
+            entry = entry[:3] + (cands,) + entry[4:]
+        return entry
+
+    def build_table(self, entry):
+        """Packs an entry into an action-observation dictionary."""
         table = {}
-        if entry[0] is not None:
+        if type(entry[0]) is tuple:
+            table['text'] = _full_text(entry[0])
+            if self.opt.get('context_ids'):
+                table['context_id'] = _context_id(entry[0][0])
+        elif entry[0] is not None:
             table['text'] = entry[0]
         if len(entry) > 1:
             if entry[1] is not None:
@@ -305,16 +666,528 @@ class DialogData(object):
                 if label not in self.cands:
                     # add labels, queue them for removal next time
                     if not self.copied_cands:
+                        self.fixed_cands = self.cands
                         self.cands = self.cands.copy()
                         self.copied_cands = True
                     self.cands.add(label)
                     self.addedCands.append(label)
             table['label_candidates'] = self.cands
+            table['label_candidates_fixed'] = (
+                self.fixed_cands if self.copied_cands else self.cands)
+            table['label_candidates_added'] = tuple(self.addedCands)
 
         if 'labels' in table and 'label_candidates' in table:
             if table['labels'][0] not in table['label_candidates']:
                 raise RuntimeError('true label missing from candidate labels')
 
-        # last entry in this episode
+        return table
+
+
+class CompiledDialogData(DialogData):
+    """Provides the same interface as ``DialogData``, but keeps the data in a
+    compiled binary file which is read through ``mmap`` instead of being
+    loaded into python objects.
+
+    The file at ``path`` is built from ``data_loader`` the first time it is
+    needed, and reused as long as ``opt['datafile']`` keeps the same
+    modification time and size. Startup only has to read the header, and
+    every process reading the same dataset shares the same pages of the page
+    cache.
+
+    After a fixed-size header, the file contains these sections:
+
+    - ``episodes``: int64 index of the first entry of each episode, followed
+      by the total number of entries
+    - ``entries``: one int64 row per entry of ``(text, labels_start,
+      labels_end, reward, cands_start, cands_end, image, context)``, where
+      strings are ids in the string pool, ranges index into ``ids`` and -1
+      means ``None``. For ``(context, query)`` texts, ``text`` is the query
+    - ``ids``: int64 string ids of all labels and label candidates
+    - ``str_offsets``, ``str_data``: the utf-8 string pool, in which every
+      distinct string is stored once
+    """
+
+    FORMAT = MappedFormat(b'PDLG', 2, ('episodes', 'entries', 'ids',
+                                       'str_offsets', 'str_data'))
+    NUM_FIELDS = 8
+
+    def __init__(self, opt, data_loader, cands=None, shared=None, path=None):
+        self._setup_common(opt, cands, shared)
+        if shared:
+            self.path = shared['path']
+        else:
+            self.path = path
+            src_stat = os.stat(opt['datafile'])
+            if not self.FORMAT.is_current(self.path, src_stat):
+                self._compile(data_loader, src_stat)
+        self._open()
+
+    def share(self):
+        shared = self._share_common()
+        shared['path'] = self.path
+        return shared
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _compile(self, data_loader, src_stat):
+        """Builds the compiled file from the data loader."""
+        print('[compiling dialog data: ' + self.path + ']')
+        strings = {}
+
+        def str_id(s):
+            if s is None:
+                return -1
+            idx = strings.get(s)
+            if idx is None:
+                idx = len(strings)
+                strings[s] = idx
+            return idx
+
+        def add_ids(values):
+            start = len(ids)
+            ids.extend(str_id(v) for v in values)
+            return start, len(ids)
+
+        episodes = []
+        entries = []
+        ids = []
+        for episode in self._read_episodes(data_loader):
+            episodes.append(len(entries) // self.NUM_FIELDS)
+            last_cands = (-1, -1)
+            for entry in episode:
+                entry = entry + (None,) * (5 - len(entry))
+                labels = (-1, -1)
+                if entry[1] is not None:
+                    labels = add_ids(entry[1])
+                cands = (-1, -1)
+                if type(entry[3]) is str:
+                    # "same as last time", reuse the previous range
+                    cands = last_cands
+                elif entry[3] is not None:
+                    cands = add_ids(entry[3])
+                    last_cands = cands
+                context, text = None, entry[0]
+                if type(text) is tuple:
+                    context, text = text
+                entries.extend((str_id(text), labels[0], labels[1],
+                                str_id(entry[2]), cands[0], cands[1],
+                                str_id(entry[4]), str_id(context)))
+        episodes.append(len(entries) // self.NUM_FIELDS)
+
+        pool = [s.encode('utf-8') for s in strings]
+        str_offsets = np.zeros(len(pool) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in pool], out=str_offsets[1:])
+        sections = [
+            np.array(episodes, dtype=np.int64).tobytes(),
+            np.array(entries, dtype=np.int64).tobytes(),
+            np.array(ids, dtype=np.int64).tobytes(),
+            str_offsets.tobytes(),
+            b''.join(pool),
+        ]
+        self.FORMAT.write(self.path, src_stat, sections)
+
+    def _open(self):
+        """Memory-maps the compiled file and sets up views on its sections."""
+        data = self.FORMAT.open(self.path)
+        self.mmap = data.mmap
+        self.episodes = data.section(0)
+        self.entries = data.section(1).reshape(-1, self.NUM_FIELDS)
+        self.ids = data.section(2)
+        self.str_offsets = data.section(3)
+        # string offsets are relative to the start of the str_data section
+        self.str_base = data.offset(4)
+        self.last_cands = (None, None)
+
+    def _str(self, idx):
+        if idx < 0:
+            return None
+        start = self.str_base + int(self.str_offsets[idx])
+        end = self.str_base + int(self.str_offsets[idx + 1])
+        return self.mmap[start:end].decode('utf-8')
+
+    def _text(self, text, context):
+        """Returns the text, or the ``(context, query)`` pair if the entry
+        has a context.
+        """
+        if context < 0:
+            return self._str(text)
+        return self._str(context), self._str(text)
+
+    def _strs(self, start, end):
+        if start < 0:
+            return None
+        return tuple(self._str(int(i)) for i in self.ids[start:end])
+
+    def num_episodes(self):
+        """Return number of episodes in the dataset."""
+        return len(self.episodes) - 1
+
+    def episode_lengths(self):
+        """Returns the number of (whitespace separated) tokens in the text and
+        labels of each episode.
+        """
+        entry_lengths = [_num_tokens(self._text(text, context),
+                                     self._strs(start, end))
+                         for text, start, end, context in
+                         self.entries[:, [0, 1, 2, 7]].tolist()]
+        bounds = self.episodes.tolist()
+        return [sum(entry_lengths[bounds[i]:bounds[i + 1]])
+                for i in range(self.num_episodes())]
+
+    def episode_sizes(self):
+        """Returns the number of entries of each episode."""
+        return np.diff(self.episodes).tolist()
+
+    def get(self, episode_idx, entry_idx=0):
+        """Returns a specific entry from the dataset."""
+        first = int(self.episodes[episode_idx])
+        last = int(self.episodes[episode_idx + 1]) - 1
+        if first + entry_idx > last:
+            raise IndexError('entry index out of range')
+        text, l_start, l_end, reward, c_start, c_end, image, context = \
+            self.entries[first + entry_idx].tolist()
+        episode_done = first + entry_idx == last
+        end_of_data = episode_done and episode_idx == self.num_episodes() - 1
+
+        # candidates are often the same for a whole episode, so keep the last
+        # decoded set around instead of decoding it again
+        if self.last_cands[0] != (c_start, c_end):
+            self.last_cands = ((c_start, c_end), self._strs(c_start, c_end))
+        entry = (self._text(text, context), self._strs(l_start, l_end),
+                 self._str(reward), self.last_cands[1], self._str(image))
+
+        table = self.build_table(entry)
         table['episode_done'] = episode_done
         return table, end_of_data
+
+
+class StreamDialogData(DialogData):
+    """Provides access to the same data as ``DialogData``, but reads episodes
+    lazily from the data loader instead of loading them all up front, so only
+    a bounded number of episodes is ever held in memory.
+
+    ``data_loader`` is a function which returns a new iterator over the data
+    (in the format described in ``DialogData``) every time it is called. It is
+    called again whenever the data runs out.
+
+    When ``opt['datatype']`` is ``train``, episodes pass through a shuffle
+    buffer of ``opt['stream_buffer']`` episodes, so they come out in a random
+    order without the whole dataset being read first, and the stream never
+    ends. Otherwise episodes are read in order and each copy of the teacher in
+    a batch only returns every ``batchsize``-th episode, starting at its
+    ``batchindex``.
+
+    The number of episodes and entries (e.g. ``len()``, which
+    ``examples/train_model.py`` uses to know how many examples make an epoch)
+    can only be counted with a full pass over the data. If ``path`` is given,
+    the counts are saved there, and only counted again when
+    ``opt['datafile']`` changes.
+    """
+
+    # number of episodes and number of entries of the data
+    COUNT_FORMAT = MappedFormat(b'PCNT', 1, ('counts',))
+
+    def __init__(self, opt, data_loader, cands=None, shared=None, path=None):
+        self._setup_common(opt, cands, shared)
+        if shared:
+            self.data_loader = shared['data_loader']
+            self.length = shared['length']
+            self.path = shared.get('path', None)
+        else:
+            self.data_loader = data_loader
+            # counted on first use, and shared with the other copies
+            self.length = {}
+            self.path = path
+        self.random = opt['datatype'] == 'train'
+        self.buffer_size = opt.get('stream_buffer', 1000)
+        self.step_size = opt.get('batchsize', 1)
+        self.data_offset = opt.get('batchindex', 0)
+        self.episodes = None
+
+    def share(self):
+        shared = self._share_common()
+        shared['data_loader'] = self.data_loader
+        shared['length'] = self.length
+        shared['path'] = self.path
+        return shared
+
+    def __len__(self):
+        """Returns total number of entries available. This needs a full pass
+        over the data the first time it is called, unless the counts were
+        saved by an earlier run.
+        """
+        if 'entries' not in self.length:
+            self._count()
+        return self.length['entries']
+
+    def num_episodes(self):
+        """Return number of episodes in the dataset. This needs a full pass
+        over the data the first time it is called, unless the counts were
+        saved by an earlier run.
+        """
+        if 'episodes' not in self.length:
+            self._count()
+        return self.length['episodes']
+
+    def _count(self):
+        """Counts the episodes and entries, or reads them from ``path`` if
+        they were saved for the current version of the data file.
+        """
+        src_stat = None
+        if self.path is not None and os.path.isfile(self.opt['datafile']):
+            src_stat = os.stat(self.opt['datafile'])
+            if self.COUNT_FORMAT.is_current(self.path, src_stat):
+                counts = self.COUNT_FORMAT.open(self.path).section(0)
+                self.length['episodes'] = int(counts[0])
+                self.length['entries'] = int(counts[1])
+                return
+
+        num_episodes = 0
+        num_entries = 0
+        for episode in self._read_episodes(self.data_loader()):
+            num_episodes += 1
+            num_entries += len(episode)
+        self.length['episodes'] = num_episodes
+        self.length['entries'] = num_entries
+        if src_stat is not None:
+            counts = np.array([num_episodes, num_entries], dtype=np.int64)
+            try:
+                self.COUNT_FORMAT.write(self.path, src_stat,
+                                        [counts.tobytes()])
+            except OSError:
+                # (e.g. the data is in a read-only directory) count next time
+                pass
+
+    def _read_ordered(self):
+        """Yields this copy's share of the episodes, in order."""
+        for i, episode in enumerate(self._read_episodes(self.data_loader())):
+            if i % self.step_size == self.data_offset:
+                yield episode
+
+    def _read_shuffled(self):
+        """Yields episodes in a random order forever, keeping at most
+        ``buffer_size`` of them in memory.
+        """
+        buffer = []
+        while True:
+            for episode in self._read_episodes(self.data_loader()):
+                if len(buffer) < self.buffer_size:
+                    buffer.append(episode)
+                else:
+                    idx = random.randrange(len(buffer))
+                    yield buffer[idx]
+                    buffer[idx] = episode
+            if len(buffer) == 0:
+                # no data at all
+                return
+            # the data ran out, so empty the buffer before starting again
+            random.shuffle(buffer)
+            yield from buffer
+            buffer = []
+
+    def reset(self):
+        """Starts reading from the beginning of the data again."""
+        if self.random:
+            self.episodes = self._read_shuffled()
+        else:
+            self.episodes = self._read_ordered()
+        # read one episode ahead to know when we reach the end of the data
+        self.next_episode = next(self.episodes, None)
+        self.episode = None
+        self.entry_idx = 0
+
+    def get(self):
+        """Returns the next entry from the stream."""
+        if self.episodes is None:
+            self.reset()
+        if self.entry_idx == 0:
+            if self.next_episode is None:
+                raise RuntimeError('No more data in the stream, reset first.')
+            self.episode = self.next_episode
+            self.next_episode = next(self.episodes, None)
+        entry_idx = self.entry_idx
+        episode_done = entry_idx == len(self.episode) - 1
+        end_of_data = episode_done and self.next_episode is None
+        self.entry_idx = 0 if episode_done else entry_idx + 1
+
+        table = self.build_table(self._resolve_cands(self.episode, entry_idx))
+        table['episode_done'] = episode_done
+        return table, end_of_data
+
+
+class IndexedDialogData(DialogData):
+    """Provides the same interface as ``DialogData``, but loads episodes on
+    demand and only keeps the current one in memory.
+
+    ``episode_loader`` is a function which takes an episode index and returns
+    an iterator over the entries of just that episode, in the format described
+    in ``DialogData``. ``num_episodes`` and ``num_entries`` are the size of the
+    data, which the teacher usually reads from an index over its data file
+    (see ``FbDialogTeacher.index_episodes()``).
+    """
+
+    def __init__(self, opt, episode_loader, num_episodes=0, num_entries=0,
+                 cands=None, shared=None):
+        self._setup_common(opt, cands, shared)
+        if shared:
+            self.episode_loader = shared['episode_loader']
+            self.length = shared['length']
+        else:
+            self.episode_loader = episode_loader
+            self.length = (num_episodes, num_entries)
+        self.episode_idx = None
+        self.episode = None
+
+    def share(self):
+        shared = self._share_common()
+        shared['episode_loader'] = self.episode_loader
+        shared['length'] = self.length
+        return shared
+
+    def __len__(self):
+        return self.length[1]
+
+    def num_episodes(self):
+        """Return number of episodes in the dataset."""
+        return self.length[0]
+
+    def episode_lengths(self):
+        """Returns the number of (whitespace separated) tokens in the text and
+        labels of each episode, reading every episode from the data file once.
+        """
+        return [sum(_num_tokens(*entry[:2]) for entry, _new in
+                    self.episode_loader(i) if entry)
+                for i in range(self.num_episodes())]
+
+    def episode_sizes(self):
+        """Returns the number of entries of each episode, reading every
+        episode from the data file once.
+        """
+        return [sum(1 for _entry in self.episode_loader(i))
+                for i in range(self.num_episodes())]
+
+    def get(self, episode_idx, entry_idx=0):
+        """Returns a specific entry from the dataset."""
+        if episode_idx != self.episode_idx:
+            episodes = list(self._read_episodes(self.episode_loader(episode_idx)))
+            if len(episodes) != 1:
+                raise RuntimeError('Expected one episode at index {}, got {}.'
+                                   ' Is the index out of date?'.format(
+                                       episode_idx, len(episodes)))
+            self.episode_idx = episode_idx
+            self.episode = episodes[0]
+        episode_done = entry_idx == len(self.episode) - 1
+        end_of_data = episode_done and episode_idx == self.num_episodes() - 1
+
+        table = self.build_table(self._resolve_cands(self.episode, entry_idx))
+        table['episode_done'] = episode_done
+        return table, end_of_data
+
+
+class VecCache(object):
+    """Stores the token ids of every text and label of a dataset, so that they
+    only need to be computed once for each version of the data file and of the
+    dictionary instead of every time an agent sees an example.
+
+    The ids are computed with the dictionary in ``opt['dict_file']`` (of class
+    ``opt['dict_class']`` if set) the first time the cache is needed, and
+    saved to a file at ``path`` which is memory-mapped afterwards. The file is
+    rebuilt if ``opt['datafile']`` changes, while changes to the dictionary or
+    the tokenizer options lead to a different ``path`` (see
+    ``DialogTeacher.vec_cache_path``).
+
+    After a fixed-size header, the file contains these sections:
+
+    - ``hashes``: sorted uint64 hashes of every distinct string
+    - ``offsets``: int64 start of the ids of each string in ``tokens``,
+      followed by the total number of ids
+    - ``tokens``: int32 token ids of all the strings
+    """
+
+    FORMAT = MappedFormat(b'PVEC', 1, ('hashes', 'offsets', 'tokens'))
+    # dictionary options which change the ids given to a string
+    TOKENIZER_OPTS = ('dict_class', 'dict_tokenizer', 'dict_language',
+                      'dict_max_ngram_size', 'dict_nulltoken', 'dict_endtoken',
+                      'dict_unktoken', 'dict_starttoken')
+
+    def __init__(self, opt, data_loader, shared=None, path=None):
+        if shared:
+            self.path = shared['path']
+        else:
+            self.path = path
+            src_stat = os.stat(opt['datafile'])
+            if not self.FORMAT.is_current(self.path, src_stat):
+                self._compile(opt, data_loader(), src_stat)
+        self._open()
+
+    def share(self):
+        return {'path': self.path}
+
+    def _compile(self, opt, data_loader, src_stat):
+        """Tokenizes every distinct text and label from the data loader and
+        writes the cache file.
+        """
+        print('[building token id cache: ' + self.path + ']')
+        if opt.get('dict_class'):
+            dictionary = str2class(opt['dict_class'])(opt)
+        else:
+            dictionary = DictionaryAgent(opt)
+        vecs = {}
+
+        def add(text):
+            if text is not None:
+                h = stable_hash(text)
+                # (there are no collisions in practice, keep the first one)
+                if h not in vecs:
+                    vecs[h] = dictionary.txt2vec(text)
+
+        for entry, _new in data_loader:
+            if len(entry) > 0:
+                add(_full_text(entry[0]))
+            if len(entry) > 1 and entry[1] is not None:
+                for label in entry[1]:
+                    add(label)
+
+        hashes = sorted(vecs)
+        offsets = np.zeros(len(hashes) + 1, dtype=np.int64)
+        np.cumsum([len(vecs[h]) for h in hashes], out=offsets[1:])
+        tokens = np.fromiter((i for h in hashes for i in vecs[h]),
+                             dtype=np.int32, count=int(offsets[-1]))
+        sections = [
+            np.array(hashes, dtype=np.uint64).tobytes(),
+            offsets.tobytes(),
+            tokens.tobytes(),
+        ]
+        self.FORMAT.write(self.path, src_stat, sections)
+
+    def _open(self):
+        """Memory-maps the cache file and sets up views on its sections."""
+        data = self.FORMAT.open(self.path)
+        self.mmap = data.mmap
+        self.hashes = data.section(0, np.uint64)
+        self.offsets = data.section(1, np.int64)
+        self.tokens = data.section(2, np.int32)
+
+    def get(self, text):
+        """Returns the (read-only) int32 array of token ids of the text, or
+        ``None`` if the text is not part of the dataset.
+        """
+        h = np.uint64(stable_hash(text))
+        i = np.searchsorted(self.hashes, h)
+        if i == len(self.hashes) or self.hashes[i] != h:
+            return None
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def add_vecs(self, action):
+        """Adds ``text_vec`` and ``labels_vec`` to the action, for the fields
+        it has.
+        """
+        if action.get('text') is not None:
+            vec = self.get(action['text'])
+            if vec is not None:
+                action['text_vec'] = vec
+        if action.get('labels') is not None:
+            vecs = tuple(self.get(label) for label in action['labels'])
+            if all(vec is not None for vec in vecs):
+                action['labels_vec'] = vecs
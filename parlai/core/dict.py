@@ -6,7 +6,7 @@
 """Contains code for parsing and building a dictionary from text."""
 
 from .agents import Agent
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import copy
 import numpy as np
 import nltk
@@ -58,6 +58,9 @@ def find_ngrams(token_dict, text, n):
     return saved_tokens
 
 
+RETOK = re.compile(r"\w+(?=n't)|n't|'\w+|\.\.\.|--|\w+|[^\w\s]", re.UNICODE)
+
+
 class DictionaryAgent(Agent):
     """Builds and/or loads a dictionary.
 
@@ -74,6 +77,8 @@ class DictionaryAgent(Agent):
     default_end = '__END__'
     default_unk = '__UNK__'
     default_start = '__START__'
+    default_tokenizer = 'nltk'
+    default_cache_size = 100000
 
     @staticmethod
     def add_cmdline_args(argparser):
@@ -113,6 +118,17 @@ class DictionaryAgent(Agent):
         dictionary.add_argument(
             '--dict-maxexs', default=100000, type=int,
             help='max number of examples to build dict on')
+        dictionary.add_argument(
+            '--dict-tokenizer', default=DictionaryAgent.default_tokenizer,
+            choices=['nltk', 're'],
+            help='nltk uses the punkt sentence tokenizer and the treebank ' +
+                 'word tokenizer, re uses a much faster regular expression ' +
+                 'which approximates the treebank tokenization')
+        dictionary.add_argument(
+            '--dict-cache-size', default=DictionaryAgent.default_cache_size,
+            type=int,
+            help='number of recently vectorized strings to keep the token ' +
+                 'ids of, set to 0 to disable')
         return dictionary
 
     def __init__(self, opt, shared=None):
@@ -123,12 +139,20 @@ class DictionaryAgent(Agent):
         self.unk_token = opt['dict_unktoken']
         self.start_token = opt['dict_starttoken']
         self.max_ngram_size = opt['dict_max_ngram_size']
+        self.tokenizer = opt.get('dict_tokenizer',
+                                 DictionaryAgent.default_tokenizer)
+        self.cache_size = opt.get('dict_cache_size',
+                                  DictionaryAgent.default_cache_size)
 
         if shared:
             self.freq = shared.get('freq', {})
             self.tok2ind = shared.get('tok2ind', {})
             self.ind2tok = shared.get('ind2tok', {})
+            self.vec_cache = shared.get('vec_cache', OrderedDict())
         else:
+            # maps recently vectorized text to its token ids. each process
+            # has its own copy, so it is safe to use with hogwild.
+            self.vec_cache = OrderedDict()
             self.freq = defaultdict(int)
             self.tok2ind = {}
             self.ind2tok = {}
@@ -164,14 +188,16 @@ class DictionaryAgent(Agent):
 
 
         # initialize tokenizers
-        st_path = 'tokenizers/punkt/{0}.pickle'.format(opt['dict_language'])
-        try:
-            self.sent_tok = nltk.data.load(st_path)
-        except LookupError:
-            nltk.download('punkt')
-            self.sent_tok = nltk.data.load(st_path)
+        if self.tokenizer == 'nltk':
+            st_path = 'tokenizers/punkt/{0}.pickle'.format(
+                opt['dict_language'])
+            try:
+                self.sent_tok = nltk.data.load(st_path)
+            except LookupError:
+                nltk.download('punkt')
+                self.sent_tok = nltk.data.load(st_path)
 
-        self.word_tok = nltk.tokenize.treebank.TreebankWordTokenizer()
+            self.word_tok = nltk.tokenize.treebank.TreebankWordTokenizer()
 
         if not shared:
 
@@ -230,6 +256,7 @@ class DictionaryAgent(Agent):
             index = len(self.tok2ind)
             self.tok2ind[key] = index
             self.ind2tok[index] = key
+            self.clear_cache()
 
     def freqs(self):
         return self.freq
@@ -252,11 +279,47 @@ class DictionaryAgent(Agent):
                                       self.max_ngram_size)
         return word_tokens
 
+    def _re_tokenize(self, text, building=False):
+        """Uses a regular expression to split text into words and punctuation,
+        splitting off contractions like the Treebank tokenizer does.
+        """
+        text = text.replace('|', ' ' if building else ' __pipe__ ')
+        word_tokens = RETOK.findall(text)
+        if not building and self.max_ngram_size > 1:
+            word_tokens = find_ngrams(self.tok2ind, word_tokens,
+                                      self.max_ngram_size)
+        return word_tokens
+
     def tokenize(self, text, building=False):
         """Returns a sequence of tokens from the iterable."""
+        if self.tokenizer == 're':
+            return self._re_tokenize(text, building)
         return (token for sent in self._sent_tokenize(text, building)
                 for token in self._word_tokenize(sent, building))
 
+    def _text_to_ids(self, text):
+        """Returns the tuple of token ids of the text, remembering the ids of
+        the last ``cache_size`` strings since datasets repeat them a lot.
+        """
+        if self.cache_size <= 0:
+            return tuple(self[token] for token in self.tokenize(text))
+        ids = self.vec_cache.get(text)
+        if ids is None:
+            ids = tuple(self[token] for token in self.tokenize(text))
+            self.vec_cache[text] = ids
+            if len(self.vec_cache) > self.cache_size:
+                self.vec_cache.popitem(last=False)
+        else:
+            self.vec_cache.move_to_end(text)
+        return ids
+
+    def clear_cache(self):
+        """Forgets the cached token ids of texts. Must be called whenever
+        ``tok2ind`` changes, since ids (and ngrams) change when tokens are added
+        or the dictionary is reindexed.
+        """
+        self.vec_cache.clear()
+
     def add_to_dict(self, tokens):
         """ Builds dictionary from the list of provided tokens."""
         for token in tokens:
@@ -265,6 +328,7 @@ class DictionaryAgent(Agent):
                 index = len(self.tok2ind)
                 self.tok2ind[token] = index
                 self.ind2tok[index] = token
+                self.clear_cache()
 
     def remove_tail(self, min_freq):
         to_remove = []
@@ -277,6 +341,7 @@ class DictionaryAgent(Agent):
                 del self.ind2tok[idx]
         for token in to_remove:
             del self.freq[token]
+        self.clear_cache()
 
     def load(self, filename):
         """Load pre-existing dictionary in 'token[<TAB>count]' format.
@@ -294,6 +359,7 @@ class DictionaryAgent(Agent):
                     index = len(self.tok2ind)
                     self.tok2ind[token] = index
                     self.ind2tok[index] = token
+        self.clear_cache()
         print('[ num words =  %d ]' % len(self))
 
     def save(self, filename=None, append=False, sort=True):
@@ -331,6 +397,7 @@ class DictionaryAgent(Agent):
             new_ind2tok[i] = tok
         self.tok2ind = new_tok2ind
         self.ind2tok = new_ind2tok
+        self.clear_cache()
         return sorted_pairs
 
     def parse(self, txt_or_vec, vec_type=list):
@@ -353,12 +420,9 @@ class DictionaryAgent(Agent):
         ``vec_type`` is the type of the returned vector if the input is a string.
         """
         if vec_type == np.ndarray:
-            res = np.fromiter(
-                (self[token] for token in self.tokenize(str(text))),
-                np.int
-            )
+            res = np.fromiter(self._text_to_ids(str(text)), int)
         elif vec_type == list or vec_type == tuple or vec_type == set:
-            res = vec_type((self[token] for token in self.tokenize(str(text))))
+            res = vec_type(self._text_to_ids(str(text)))
         else:
             raise RuntimeError('Type {} not supported by dict'.format(vec_type))
         assert type(res) == vec_type
@@ -387,10 +451,19 @@ class DictionaryAgent(Agent):
         shared['freq'] = self.freq
         shared['tok2ind'] = self.tok2ind
         shared['ind2tok'] = self.ind2tok
+        shared['vec_cache'] = self.vec_cache
         shared['opt'] = self.opt
         shared['class'] = type(self)
         return shared
 
+    def __getstate__(self):
+        """Leaves the cached token ids out when pickled (e.g. when a model
+        saves its dictionary), since they are only a speedup.
+        """
+        state = self.__dict__.copy()
+        state['vec_cache'] = OrderedDict()
+        return state
+
     def shutdown(self):
         """Save on shutdown if ``save_path`` is set."""
         if hasattr(self, 'save_path'):
@@ -40,13 +40,23 @@ etc.
 """
 
 from .dialog_teacher import DialogTeacher
+from .mapped_file import MappedFormat
+
+import numpy as np
+import os
 
 
 class FbDialogTeacher(DialogTeacher):
     """Subclasses ``DialogTeacher`` for functionality and provides an implementation
     of ``setup_data()`` which iterates over datasets in the "fbdialog" format.
+
+    It also implements ``index_episodes()`` and ``setup_episode()``, which
+    ``DialogTeacher`` uses with ``--dialog-data indexed`` to read single
+    episodes straight from the data file.
     """
 
+    INDEX_FORMAT = MappedFormat(b'PFBI', 2, ('episodes',))
+
     def __init__(self, opt, shared=None):
         self.opt = opt
         self.cloze = opt.get('cloze', False)
@@ -127,74 +137,164 @@ class FbDialogTeacher(DialogTeacher):
             r: '1'
             c: ['hallway', 'kitchen', 'bathroom']
             new_episode = False (this is the second example in the episode)
+
+        Each ``x`` only holds the lines since the previous example of its
+        episode, so the data is stored in space linear in the size of the
+        file (not in the square of the episode lengths), and agents are sent
+        just the new lines at each step. Agents which need the whole episode
+        so far (like seq2seq and drqa) join the texts they observe until
+        ``episode_done``.
         """
         print("[loading fbdialog data:" + path + "]")
-        with open(path) as read:
-            start = True
-            x = ''
-            reward = None
-            dialog_index = 0
-            for line in read:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                # first, get conversation index -- '1' means start of episode
-                space_idx = line.find(' ')
-                conv_id = line[:space_idx]
-
-                # split line into constituent parts, if available:
-                # x<tab>y<tab>reward<tab>label_candidates
-                # where y, reward, and label_candidates are optional
-                split = line[space_idx + 1:].split('\t')
-
-                # remove empty items and strip each one
-                for i in range(len(split)):
-                    word = split[i].strip()
-                    if len(word) == 0:
-                        split[i] = ''
-                    else:
-                        split[i] = word
-                # Empty reward string same as None
-                if len(split) > 2 and split[2] == '':
-                    split[2] = None
-
-                # now check if we're at a new episode
-                if conv_id == '1':
-                    dialog_index += 1
-                    x = x.strip()
-                    if x:
-                        yield [x, None, reward], start
-                    start = True
-                    # start a new episode
-                    if self.cloze:
-                        x = 'Fill in the blank in the last sentence.\n{x}'.format(
-                            x=split[0]
-                        )
-                    else:
-                        x = split[0]
+        with open(path, encoding='utf-8') as read:
+            yield from self._parse_lines(read)
+
+    def _parse_lines(self, lines, flush=False):
+        """Parses fbdialog lines as described in ``setup_data()``. Unlabeled
+        lines at the end are only yielded if ``flush`` is set, which
+        ``setup_data()`` does when it sees the start of the next episode.
+        """
+        start = True
+        x = ''
+        reward = None
+        dialog_index = 0
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            # first, get conversation index -- '1' means start of episode
+            space_idx = line.find(' ')
+            conv_id = line[:space_idx]
+
+            # split line into constituent parts, if available:
+            # x<tab>y<tab>reward<tab>label_candidates
+            # where y, reward, and label_candidates are optional
+            split = line[space_idx + 1:].split('\t')
+
+            # remove empty items and strip each one
+            for i in range(len(split)):
+                word = split[i].strip()
+                if len(word) == 0:
+                    split[i] = ''
                 else:
-                    if x:
-                        # otherwise add current x to what we have so far
-                        x = '{x}\n{next_x}'.format(x=x, next_x=split[0])
-                    else:
-                        if len(split) > 2:
-                            reward = split[2]
-                        x = split[0]
-
-                if len(split) > 1 and split[1]:
-                    # only generate an example if we have a y
-                    split[0] = x
-                    # split labels
-                    split[1] = split[1].split('|')
-                    if len(split) > 3:
-                        # split label_candidates
-                        split[3] = split[3].split('|')
-                    if start:
-                        yield split, True
-                        start = False
-                    else:
-                        yield split, False
-                    # reset x in case there is unlabeled data still left
-                    x = ''
-                    reward = None
+                    split[i] = word
+            # Empty reward string same as None
+            if len(split) > 2 and split[2] == '':
+                split[2] = None
+
+            # now check if we're at a new episode
+            if conv_id == '1':
+                dialog_index += 1
+                x = x.strip()
+                if x:
+                    yield [x, None, reward], start
+                start = True
+                # start a new episode
+                if self.cloze:
+                    x = 'Fill in the blank in the last sentence.\n{x}'.format(
+                        x=split[0]
+                    )
+                else:
+                    x = split[0]
+            else:
+                if x:
+                    # otherwise add current x to what we have so far
+                    x = '{x}\n{next_x}'.format(x=x, next_x=split[0])
+                else:
+                    if len(split) > 2:
+                        reward = split[2]
+                    x = split[0]
+
+            if len(split) > 1 and split[1]:
+                # only generate an example if we have a y
+                split[0] = x
+                # split labels
+                split[1] = split[1].split('|')
+                if len(split) > 3:
+                    # split label_candidates
+                    split[3] = split[3].split('|')
+                if start:
+                    yield split, True
+                    start = False
+                else:
+                    yield split, False
+                # reset x in case there is unlabeled data still left
+                x = ''
+                reward = None
+
+        x = x.strip()
+        if flush and x:
+            yield [x, None, reward], start
+
+    def index_path(self, path):
+        """Returns the path of the episode index for the data file."""
+        return path + '.index'
+
+    def index_episodes(self, path):
+        """Loads the episode index of the data file, building it first if it
+        does not exist yet or the data file changed since it was built.
+
+        The index holds one row of ``(byte offset, number of lines, number
+        of examples)`` per episode, in the single ``episodes`` section of an
+        ``INDEX_FORMAT`` file. Returns the number of episodes and the total
+        number of examples.
+        """
+        index_path = self.index_path(path)
+        src_stat = os.stat(path)
+        if not self.INDEX_FORMAT.is_current(index_path, src_stat):
+            self._build_index(path, index_path, src_stat)
+        index = self.INDEX_FORMAT.open(index_path)
+        self.episode_index = index.section(0).reshape(-1, 3)
+        return (len(self.episode_index),
+                int(self.episode_index[:, 2].sum()))
+
+    def _build_index(self, path, index_path, src_stat):
+        """Scans the data file once, recording where each episode starts.
+        Follows the same rules as ``_parse_lines()`` to count the examples
+        of each episode, so that episodes which produce no examples are left
+        out of the index.
+        """
+        print('[indexing fbdialog data: ' + path + ']')
+        episodes = []
+        # offset, lines, labeled lines, unlabeled text after the last label
+        offset, num_lines, num_labeled, trailing = 0, 0, 0, False
+        pos = 0
+        with open(path, 'rb') as read:
+            for line in read:
+                stripped = line.strip()
+                if stripped:
+                    space_idx = stripped.find(b' ')
+                    new_episode = stripped[:space_idx] == b'1'
+                    if new_episode and num_lines > 0 and (
+                            num_labeled > 0 or trailing):
+                        episodes.append((offset, num_lines,
+                                         num_labeled + trailing))
+                        offset, num_lines, num_labeled, trailing = \
+                            pos, 0, 0, False
+                    split = stripped[space_idx + 1:].split(b'\t')
+                    if len(split) > 1 and split[1].strip():
+                        num_labeled += 1
+                        trailing = False
+                    elif split[0].strip() or (new_episode and self.cloze):
+                        trailing = True
+                num_lines += 1
+                pos += len(line)
+        # unlabeled lines at the very end of the file are never yielded
+        if num_labeled > 0:
+            episodes.append((offset, num_lines, num_labeled))
+        index = np.array(episodes, dtype=np.int64).reshape(-1, 3)
+        self.INDEX_FORMAT.write(index_path, src_stat, [index.tobytes()])
+
+    def setup_episode(self, path, episode_idx):
+        """Reads a single episode from the data file, using the index built by
+        ``index_episodes()`` to seek to it. Yields the same tuples as
+        ``setup_data()`` does for that episode.
+        """
+        offset, num_lines, _ = self.episode_index[episode_idx].tolist()
+        with open(path, encoding='utf-8') as read:
+            # the offset is in bytes, which utf-8 text files can seek to
+            read.seek(offset)
+            lines = [read.readline() for _ in range(num_lines)]
+        last = episode_idx == len(self.episode_index) - 1
+        yield from self._parse_lines(lines, flush=not last)
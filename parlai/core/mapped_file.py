@@ -0,0 +1,125 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Provides the binary file format of the data which is compiled once from a
+source file (e.g. a dataset or a file of word vectors) and then read through
+``mmap``, so that later runs only have to read a header, and every process
+reading the same file shares the same pages of the page cache.
+
+A file starts with a fixed-size header holding a magic string, a format
+version, the modification time and size of the source file it was compiled
+from (so it can be rebuilt when the source changes) and the offset and size
+of each of its sections, followed by the sections themselves, each of them
+8-byte aligned so they can be viewed as numpy arrays.
+"""
+
+import hashlib
+import mmap
+import numpy as np
+import os
+import struct
+
+
+def stable_hash(text):
+    """Returns a 64-bit hash of the string, which unlike ``hash()`` is the same
+    in every process.
+    """
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class MappedFormat(object):
+    """Describes one kind of compiled file: its ``magic`` string (4 bytes),
+    its ``version`` (to bump whenever the contents change) and the names of
+    its ``sections``.
+    """
+
+    def __init__(self, magic, version, sections):
+        self.magic = magic
+        self.version = version
+        self.sections = tuple(sections)
+        # magic, version, source mtime, source size, (offset, size) per section
+        self.header = struct.Struct('<4sIqq' + 'qq' * len(self.sections))
+
+    def read_header(self, read):
+        """Reads the header from the start of the file object, and returns it
+        as a tuple, or ``None`` if it is not a header of this format.
+        """
+        header = read.read(self.header.size)
+        if len(header) < self.header.size:
+            return None
+        header = self.header.unpack(header)
+        if header[0] != self.magic or header[1] != self.version:
+            return None
+        return header
+
+    def is_current(self, path, src_stat):
+        """Checks whether the file exists and was built from the version of
+        the source file with the given ``os.stat()``.
+        """
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as read:
+            header = self.read_header(read)
+        return (header is not None and header[2] == src_stat.st_mtime_ns
+                and header[3] == src_stat.st_size)
+
+    def write(self, path, src_stat, sections):
+        """Writes the file, to a temporary path first and then moved into
+        place, so other processes never see a partially written file.
+
+        ``sections`` holds the contents of each section, as bytes or as an
+        iterable of chunks of bytes, which is only iterated once the previous
+        sections are written (so a generator can stream a large section, and
+        the next ones can use what it computed).
+        """
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as write:
+            pos = self.header.size
+            layout = []
+            write.write(b'\0' * pos)
+            for data in sections:
+                # keep every section 8-byte aligned
+                padding = -pos % 8
+                write.write(b'\0' * padding)
+                pos += padding
+                start = pos
+                for chunk in ([data] if isinstance(data, bytes) else data):
+                    write.write(chunk)
+                    pos += len(chunk)
+                layout.extend((start, pos - start))
+            write.seek(0)
+            write.write(self.header.pack(self.magic, self.version,
+                                         src_stat.st_mtime_ns,
+                                         src_stat.st_size, *layout))
+        os.replace(tmp_path, path)
+
+    def open(self, path):
+        """Memory-maps the file, and returns it as a ``MappedFile``."""
+        with open(path, 'rb') as read:
+            header = self.read_header(read)
+            if header is None:
+                raise RuntimeError('Invalid compiled file: ' + path)
+            data = mmap.mmap(read.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedFile(data, header[4:])
+
+
+class MappedFile(object):
+    """A memory-mapped file opened by ``MappedFormat.open()``."""
+
+    def __init__(self, data, layout):
+        # the mmap itself, and (offset, size) of each section
+        self.mmap = data
+        self.layout = layout
+
+    def offset(self, i):
+        """Returns the offset of section ``i`` in the file."""
+        return self.layout[2 * i]
+
+    def section(self, i, dtype=np.int64):
+        """Returns a (read-only) numpy view of section ``i``."""
+        offset, size = self.layout[2 * i], self.layout[2 * i + 1]
+        return np.frombuffer(self.mmap, dtype=dtype, offset=offset,
+                             count=size // np.dtype(dtype).itemsize)
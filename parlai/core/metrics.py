@@ -4,34 +4,39 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 """Provides standard metric evaluations for dialog.
-Uses locking and shared memory when ``numthreads`` is set to >1 to share metrics
-between processes.
+Uses shared memory when ``numthreads`` is set to >1 to share metrics between
+processes: each process accumulates into its own row of a shared array without
+locking, and the rows are summed whenever the metrics are reported.
 """
 
-from parlai.core.thread_utils import SharedTable
 from parlai.core.utils import round_sigfigs
 from collections import Counter
+from functools import lru_cache
+from multiprocessing import RawArray, Value
 
+import ctypes
+import numpy as np
+import os
 import re
 import string
 
 
-def _normalize_answer(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
+re_art = re.compile(r'\b(a|an|the)\b')
+punc_table = str.maketrans('', '', string.punctuation)
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
+def _normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+    return ' '.join(re_art.sub(' ', s.lower().translate(punc_table)).split())
 
-    def lower(text):
-        return text.lower()
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+@lru_cache(maxsize=65536)
+def _normalize_label(label):
+    """Returns the normalized label and a Counter of its tokens. Labels are
+    seen again every epoch, so these are cached (don't modify the Counter).
+    """
+    normalized = _normalize_answer(label)
+    return normalized, Counter(normalized.split())
 
 
 def _exact_match(guess, answers):
@@ -40,27 +45,29 @@ def _exact_match(guess, answers):
         return False
     guess = _normalize_answer(guess)
     for a in answers:
-        if guess == _normalize_answer(a):
+        if guess == _normalize_label(a)[0]:
             return True
     return False
 
 
+def _f1(g_counts, a_counts):
+    """Return the F1 score between the token Counters of a guess and answer."""
+    common = g_counts & a_counts
+    num_same = sum(common.values())
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / sum(g_counts.values())
+    recall = 1.0 * num_same / sum(a_counts.values())
+    f1 = (2 * precision * recall) / (precision + recall)
+    return f1
+
+
 def _f1_score(guess, answers):
     """Return the max F1 score between the guess and any answer."""
-    def _score(g_tokens, a_tokens):
-        common = Counter(g_tokens) & Counter(a_tokens)
-        num_same = sum(common.values())
-        if num_same == 0:
-            return 0
-        precision = 1.0 * num_same / len(g_tokens)
-        recall = 1.0 * num_same / len(a_tokens)
-        f1 = (2 * precision * recall) / (precision + recall)
-        return f1
-
     if guess is None or answers is None:
         return 0
-    g_tokens = _normalize_answer(guess).split()
-    scores = [_score(g_tokens, _normalize_answer(a).split()) for a in answers]
+    g_counts = Counter(_normalize_answer(guess).split())
+    scores = [_f1(g_counts, _normalize_label(a)[1]) for a in answers]
     return max(scores)
 
 
@@ -68,15 +75,25 @@ class Metrics(object):
     """Class that maintains evaluation metrics over dialog."""
 
     def __init__(self, opt):
-        self.metrics = {}
-        self.metrics['cnt'] = 0
-        self.metrics['correct'] = 0
-        self.metrics['f1'] = 0.0
         self.eval_pr = [1, 5, 10, 50, 100]
+        self.keys = ['cnt', 'correct', 'f1']
         for k in self.eval_pr:
-            self.metrics['hits@' + str(k)] = 0
-        if opt.get('numthreads', 1) > 1:
-            self.metrics = SharedTable(self.metrics)
+            self.keys.append('hits@' + str(k))
+        self.key_idx = {k: i for i, k in enumerate(self.keys)}
+        self.hits_idx = [self.key_idx['hits@' + str(k)] for k in self.eval_pr]
+        numthreads = opt.get('numthreads', 1)
+        if numthreads > 1:
+            # one shard for each hogwild process, plus one for the main process
+            self.num_shards = numthreads + 1
+            self.shards = RawArray(ctypes.c_double,
+                                   self.num_shards * len(self.keys))
+            self.next_shard = Value('i', 0)
+            self.pid = None
+        else:
+            self.num_shards = 1
+            self.shards = None
+            self.metrics = np.zeros((1, len(self.keys)))
+            self.shard = self.metrics[0]
         self.datatype = opt.get('datatype', 'train')
 
     def __enter__(self):
@@ -86,20 +103,39 @@ class Metrics(object):
         pass
 
     def __str__(self):
-        return str(self.metrics)
+        return str(self._totals())
 
     def __repr__(self):
-        return repr(self.metrics)
-
-    def _lock(self):
-        if hasattr(self.metrics, 'get_lock'):
-            # use the shared_table's lock
-            return self.metrics.get_lock()
-        else:
-            # otherwise do nothing
-            return self
-
-    def update_ranking_metrics(self, observation, labels):
+        return repr(self._totals())
+
+    def _all_shards(self):
+        """Returns a (num_shards x num_keys) array viewing all of the shards."""
+        if self.shards is None:
+            return self.metrics
+        return np.frombuffer(self.shards).reshape(self.num_shards, -1)
+
+    def _get_shard(self):
+        """Returns the row of metrics owned by the current process, claiming
+        a free one the first time the process updates the metrics. Rows are
+        only ever written by their owner, so no locking is needed after that.
+        """
+        if self.shards is not None and self.pid != os.getpid():
+            with self.next_shard.get_lock():
+                idx = self.next_shard.value
+                self.next_shard.value += 1
+            if idx >= self.num_shards:
+                raise RuntimeError('More processes are updating metrics ' +
+                                   'than numthreads allows.')
+            self.shard = self._all_shards()[idx]
+            self.pid = os.getpid()
+        return self.shard
+
+    def _totals(self):
+        """Returns a dict of each metric summed over all of the shards."""
+        totals = self._all_shards().sum(axis=0)
+        return {k: totals[i].item() for i, k in enumerate(self.keys)}
+
+    def update_ranking_metrics(self, observation, labels, shard=None):
         text_cands = observation.get('text_candidates', None)
         if text_cands is None:
             text = observation.get('text', None)
@@ -122,31 +158,14 @@ class Metrics(object):
         # hits metric is 1 if cnts[k] > 0.
         # (other metrics such as p@k and r@k take
         # the value of cnt into account.)
-        with self._lock():
-            for k in self.eval_pr:
-                if cnts[k] > 0:
-                    self.metrics['hits@' + str(k)] += 1
-
+        if shard is None:
+            shard = self._get_shard()
+        for k, idx in zip(self.eval_pr, self.hits_idx):
+            if cnts[k] > 0:
+                shard[idx] += 1
 
     def update(self, observation, labels):
-        with self._lock():
-            self.metrics['cnt'] += 1
-
-        # Exact match metric.
-        correct = 0
-        prediction = observation.get('text', None)
-        if _exact_match(prediction, labels):
-            correct = 1
-        with self._lock():
-            self.metrics['correct'] += correct
-
-        # F1 metric.
-        f1 = _f1_score(prediction, labels)
-        with self._lock():
-            self.metrics['f1'] += f1
-
-        # Ranking metrics.
-        self.update_ranking_metrics(observation, labels)
+        correct = self._score(observation, labels, self._get_shard())
 
         # Return a dict containing the metrics for this specific example.
         # Metrics across all data is stored internally in the class, and
@@ -155,25 +174,59 @@ class Metrics(object):
         loss['correct'] = correct
         return loss
 
+    def batch_update(self, observations, labels):
+        """Update the metrics with a batch of replies (e.g. the replies to the
+        teachers of a ``BatchWorld``) and the labels of each example. The batch
+        is scored into an array of its own, and its totals are added to the
+        shard of this process at once. Returns the per-example losses.
+        """
+        scores = np.zeros((len(observations), len(self.keys)))
+        for row, observation, lbls in zip(scores, observations, labels):
+            self._score(observation, lbls, row)
+        self._get_shard()[:] += scores.sum(axis=0)
+        correct = scores[:, self.key_idx['correct']].astype(int).tolist()
+        return [{'correct': c} for c in correct]
+
+    def _score(self, observation, labels, row):
+        """Adds the metrics of a reply to an example with the given labels to
+        ``row`` (a shard, or a row of a batch), and returns whether the reply
+        was correct. The reply is normalized once for exact match and F1.
+        """
+        row[self.key_idx['cnt']] += 1
+
+        # Exact match metric.
+        correct = 0
+        prediction = observation.get('text', None)
+        if prediction is not None and labels is not None:
+            guess = _normalize_answer(prediction)
+            answers = [_normalize_label(a) for a in labels]
+            if any(guess == a for a, _counts in answers):
+                correct = 1
+            row[self.key_idx['correct']] += correct
+
+            # F1 metric.
+            g_counts = Counter(guess.split())
+            row[self.key_idx['f1']] += max(_f1(g_counts, counts)
+                                           for _a, counts in answers)
+
+        # Ranking metrics.
+        self.update_ranking_metrics(observation, labels, row)
+        return correct
+
     def report(self):
         # Report the metrics over all data seen so far.
+        metrics = self._totals()
+        cnt = int(metrics['cnt'])
         m = {}
-        m['total'] = self.metrics['cnt']
-        if self.metrics['cnt'] > 0:
-            m['accuracy'] = round_sigfigs(
-                self.metrics['correct'] / self.metrics['cnt'], 4)
-            m['f1'] = round_sigfigs(
-                self.metrics['f1'] / self.metrics['cnt'], 4)
+        m['total'] = cnt
+        if cnt > 0:
+            m['accuracy'] = round_sigfigs(metrics['correct'] / cnt, 4)
+            m['f1'] = round_sigfigs(metrics['f1'] / cnt, 4)
             m['hits@k'] = {}
             for k in self.eval_pr:
                 m['hits@k'][k] = round_sigfigs(
-                    self.metrics['hits@' + str(k)] / self.metrics['cnt'], 4)
+                    metrics['hits@' + str(k)] / cnt, 4)
         return m
 
     def clear(self):
-        with self._lock():
-            self.metrics['cnt'] = 0
-            self.metrics['correct'] = 0
-            self.metrics['f1'] = 0.0
-            for k in self.eval_pr:
-                self.metrics['hits@' + str(k)] = 0
+        self._all_shards().fill(0)
@@ -135,9 +135,46 @@ class ParlaiParser(argparse.ArgumentParser):
         parlai.add_argument(
             '-nt', '--numthreads', default=1, type=int,
             help='number of threads, e.g. for hogwild')
+        parlai.add_argument(
+            '--hogwild-chunk', default=16, type=int,
+            help='number of examples handed to a hogwild thread at a time')
         parlai.add_argument(
             '-bs', '--batchsize', default=1, type=int,
             help='batch size for minibatch training schemes')
+        parlai.add_argument(
+            '--batch-sort', type='bool', default=False,
+            help='give each batch episodes of similar length, to reduce ' +
+                 'padding (dialog teachers sort their episodes by length)')
+        parlai.add_argument(
+            '--batch-tokens', default=0, type=int,
+            help='if set, batches hold as many examples as fit this many ' +
+                 'tokens (text plus labels, padded to the longest example), ' +
+                 'up to --batchsize examples (dialog teachers only)')
+        parlai.add_argument(
+            '--dialog-data', default='memory',
+            choices=['memory', 'compiled', 'stream', 'indexed'],
+            help='how DialogTeacher stores its data. "memory" loads every ' +
+                 'episode into python objects, "compiled" builds a binary ' +
+                 'file next to the data file once and memory-maps it, ' +
+                 '"stream" reads the data lazily for datasets larger than ' +
+                 'RAM, "indexed" reads single episodes from the data file ' +
+                 'through an episode index (fbdialog teachers only).')
+        parlai.add_argument(
+            '--stream-buffer', default=1000, type=int,
+            help='number of episodes held in the shuffle buffer when ' +
+                 'training with --dialog-data stream')
+        parlai.add_argument(
+            '--context-ids', type='bool', default=False,
+            help='send a context_id with the examples of dialog teachers ' +
+                 'which share a context between queries (e.g. the ' +
+                 'paragraphs of squad), so agents can reuse the work done ' +
+                 'on each context')
+        parlai.add_argument(
+            '--vec-cache', type='bool', default=False,
+            help='attach text_vec and labels_vec (token ids from the ' +
+                 'dictionary in --dict-file) to the examples of dialog ' +
+                 'teachers. ids are computed once and cached in a file ' +
+                 'next to the data file.')
         self.add_parlai_data_path(parlai)
         self.add_task_args()
 
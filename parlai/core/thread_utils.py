@@ -5,7 +5,7 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 """Provides utilities useful for multiprocessing."""
 
-from multiprocessing import Lock, RawArray
+from multiprocessing import Lock, RLock, RawArray
 try:
     # python3
     from collections.abc import MutableMapping
@@ -13,6 +13,8 @@ except ImportError:
     # python2
     from collections import MutableMapping
 import ctypes
+import numpy as np
+import pickle
 import sys
 
 class SharedTable(MutableMapping):
@@ -148,3 +150,239 @@ class SharedTable(MutableMapping):
 
     def get_lock(self):
         return self.lock
+
+
+class GrowableSharedTable(MutableMapping):
+    """Provides a shared-memory table of integers or floats whose keys can be
+    added or removed at any time, including after the processes sharing it have
+    been forked.
+
+    All of the data lives in a single shared buffer, allocated once with room
+    for ``max_capacity`` keys. The table starts out using room for
+    ``capacity`` keys, and doubles that each time it fills up. Every doubling
+    brings the next region of the buffer into use (with the values, type codes
+    and directory of pickled keys of the new slots), so growing never copies
+    or moves what is already stored. Other processes see a new key the next
+    time they look up a key they don't know about. Slots of deleted keys are
+    not reused.
+
+    Use this class just like ``SharedTable``:
+
+    .. code-block:: python
+
+        tbl = GrowableSharedTable({'cnt': 0})
+        for i in range(10):
+            with tbl.get_lock():
+                tbl['cnt'] += 1
+    """
+
+    # type codes of the supported value types, zero marks an empty slot
+    types = {
+        int: 1,
+        float: 2
+    }
+
+    def __init__(self, init_dict=None, capacity=16, max_capacity=4096,
+                 key_bytes=64):
+        """Allocate the shared buffer with room for ``max_capacity`` keys
+        (``capacity`` times a power of two), which can use ``key_bytes`` bytes
+        each on average once pickled, and add the elements of the initial
+        dictionary if provided.
+        """
+        num_regions = 1
+        while capacity << (num_regions - 1) < max_capacity:
+            num_regions += 1
+        if capacity < 1 or capacity << (num_regions - 1) != max_capacity:
+            raise ValueError('max_capacity must be capacity times a power ' +
+                             'of two.')
+        self.min_capacity = capacity
+        self.key_bytes = key_bytes
+        # region 0 has room for capacity keys, and region i > 0 for
+        # capacity * 2 ** (i - 1), doubling the capacity of the table
+        self.region_sizes = [capacity] + [capacity << i
+                                          for i in range(num_regions - 1)]
+        self.region_offsets = []
+        # header with the number of keys added and the current capacity
+        offset = 16
+        for size in self.region_sizes:
+            self.region_offsets.append(offset)
+            # values and key end offsets (8 bytes per key each), type codes
+            # (1 byte per key) and the pickled keys, padded to 8 bytes
+            offset += (size * (17 + key_bytes) + 7) // 8 * 8
+        self.buffer = RawArray(ctypes.c_char, offset)
+        self.header = np.frombuffer(self.buffer, np.int64, 2)
+        self.header[1] = capacity
+        self.lock = RLock()
+        # views into each region of the buffer, made when first needed
+        self.regions = {}
+        # idx is dict of {key: slot} for the keys this process has seen
+        self.idx = {}
+        self.num_seen = 0
+        if init_dict:
+            for k, v in init_dict.items():
+                self[k] = v
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['header']
+        state['regions'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.header = np.frombuffer(self.buffer, np.int64, 2)
+
+    def capacity(self):
+        """Returns the number of keys the table has room for at the moment."""
+        return int(self.header[1])
+
+    def _locate(self, slot):
+        """Returns the views into the region holding the slot, and the
+        position of the slot in that region.
+        """
+        region = (slot // self.min_capacity).bit_length()
+        start = (self.min_capacity << region - 1) if region else 0
+        if region not in self.regions:
+            size = self.region_sizes[region]
+            offset = self.region_offsets[region]
+            buf = self.buffer
+            self.regions[region] = (
+                np.frombuffer(buf, np.int64, size, offset),
+                np.frombuffer(buf, np.float64, size, offset),
+                np.frombuffer(buf, np.int64, size, offset + size * 8),
+                np.frombuffer(buf, np.int8, size, offset + size * 16),
+                np.frombuffer(buf, np.uint8, size * self.key_bytes,
+                              offset + size * 17),
+            )
+        return self.regions[region], slot - start
+
+    def _code(self, slot):
+        (_ints, _floats, _key_ends, codes, _keys), pos = self._locate(slot)
+        return codes[pos]
+
+    def _sync(self):
+        """Read any keys other processes added to the directory."""
+        num_keys = int(self.header[0])
+        for slot in range(self.num_seen, num_keys):
+            (_ints, _floats, key_ends, _codes, keys), pos = self._locate(slot)
+            start = key_ends[pos - 1] if pos > 0 else 0
+            key = pickle.loads(keys[start:key_ends[pos]].tobytes())
+            self.idx[key] = slot
+        self.num_seen = num_keys
+
+    def _find(self, key):
+        """Returns the slot for the key, or None if key is not in the table."""
+        slot = self.idx.get(key)
+        if slot is None or self._code(slot) == 0:
+            # maybe another process added (or re-added) the key
+            self._sync()
+            slot = self.idx.get(key)
+            if slot is None or self._code(slot) == 0:
+                return None
+        return slot
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        self._sync()
+        return iter([k for k, slot in self.idx.items() if self._code(slot)])
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        """Returns shared value if key is available."""
+        slot = self._find(key)
+        if slot is None:
+            raise KeyError('Key "{}" not found in SharedTable'.format(key))
+        (ints, floats, _key_ends, codes, _keys), pos = self._locate(slot)
+        if codes[pos] == self.types[int]:
+            return int(ints[pos])
+        return float(floats[pos])
+
+    def __setitem__(self, key, value):
+        """If key is in table, update it. Otherwise, add the key to the
+        directory in the next free slot, doubling the capacity of the table
+        if it is full.
+        Raises an error if you try to change the type of the value stored for
+        that key--if you need to do this, you must delete the key first.
+        """
+        val_type = type(value)
+        if val_type not in self.types:
+            raise TypeError('GrowableSharedTable does not support type ' +
+                            str(val_type))
+        slot = self._find(key)
+        if slot is None:
+            with self.lock:
+                # check again now that no one else can add keys
+                slot = self._find(key)
+                if slot is None:
+                    slot = self._add_key(key)
+                    self._set_value(slot, value)
+                    (_i, _f, _e, codes, _k), pos = self._locate(slot)
+                    codes[pos] = self.types[val_type]
+                    # publish the key only once its slot is filled in
+                    self.header[0] += 1
+                    self.num_seen += 1
+                    return
+        code = self._code(slot)
+        if code != self.types[val_type]:
+            typ = int if code == self.types[int] else float
+            raise TypeError(('Cannot change stored type for {key} from ' +
+                             '{v1} to {v2}. You need to del the key first' +
+                             ' if you need to change value types.'
+                             ).format(key=key, v1=typ, v2=val_type))
+        self._set_value(slot, value)
+
+    def _add_key(self, key):
+        """Write the key into the next free slot of the directory, doubling
+        the capacity first if there is none.
+        """
+        slot = int(self.header[0])
+        if slot >= self.header[1]:
+            if slot >= self.min_capacity << len(self.region_sizes) - 1:
+                raise RuntimeError('GrowableSharedTable is full, create it ' +
+                                   'with a larger max_capacity.')
+            self.header[1] *= 2
+        (_ints, _floats, key_ends, _codes, keys), pos = self._locate(slot)
+        pickled = np.frombuffer(pickle.dumps(key), np.uint8)
+        start = key_ends[pos - 1] if pos > 0 else 0
+        end = start + len(pickled)
+        if end > len(keys):
+            raise RuntimeError('GrowableSharedTable has no space left for ' +
+                               'keys, create it with a larger key_bytes.')
+        keys[start:end] = pickled
+        key_ends[pos] = end
+        self.idx[key] = slot
+        return slot
+
+    def _set_value(self, slot, value):
+        (ints, floats, _key_ends, _codes, _keys), pos = self._locate(slot)
+        if type(value) == int:
+            ints[pos] = value
+        else:
+            floats[pos] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            slot = self._find(key)
+            if slot is None:
+                raise KeyError('Key "{}" not found in SharedTable'.format(key))
+            (_ints, _floats, _key_ends, codes, _keys), pos = self._locate(slot)
+            codes[pos] = 0
+            del self.idx[key]
+
+    def __str__(self):
+        """Returns simple dict representation of the mapping."""
+        return '{{{}}}'.format(
+            ', '.join('{k}: {v}'.format(k=k, v=self[k]) for k in self)
+        )
+
+    def __repr__(self):
+        """Returns the object type and memory location with the mapping."""
+        representation = super().__repr__()
+        return representation.replace('>', ': {}>'.format(str(self)))
+
+    def get_lock(self):
+        return self.lock
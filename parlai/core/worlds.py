@@ -46,8 +46,10 @@ import math
 import importlib
 import random
 
-from multiprocessing import Process, Value, Condition, Semaphore
+from multiprocessing import Process, Value, Condition, Queue
 from parlai.core.agents import _create_task_agents, create_agents_from_shared
+from parlai.core.thread_utils import GrowableSharedTable
+from parlai.core.utils import round_sigfigs
 from parlai.tasks.tasks import ids_to_tasks
 
 
@@ -514,11 +516,26 @@ def override_opts_in_shared(table, overrides):
     return table
 
 
+def limit_hogwild_threads(opt):
+    """Restricts torch to a single thread in hogwild processes (whose opt has a
+    ``threadindex``). The processes already use every core between them, and
+    letting each one spawn a thread per core as well oversubscribes the CPU.
+    Agents using torch call this when they are created from a shared copy.
+    """
+    if 'threadindex' in opt:
+        import torch
+        torch.set_num_threads(1)
+
+
 class BatchWorld(World):
     """Creates a separate world for each item in the batch, sharing
     the parameters for each.
     The underlying world(s) it is batching can be either ``DialogPartnerWorld``,
     ``MultiAgentWorld``, ``ExecutableWorld`` or ``MultiWorld``.
+
+    The report includes the ``padding`` of the batches given to agents which
+    implement ``batch_act``: the fraction of the padded batch matrices of their
+    input text which would be padding (see ``--batch-sort`` to reduce it).
     """
 
     def __init__(self, opt, world):
@@ -534,6 +551,10 @@ class BatchWorld(World):
             override_opts_in_shared(shared, {'batchindex': i})
             self.worlds.append(shared['world_class'](opt, None, shared))
         self.batch_observations = [ None ] * len(self.world.get_agents())
+        # tokens in the batches of text given to batch_act, and the size of
+        # these batches once padded to their longest text
+        self.text_tokens = 0
+        self.padded_tokens = 0
 
     def __iter__(self):
         return self
@@ -543,6 +564,7 @@ class BatchWorld(World):
             raise StopIteration()
 
     def batch_observe(self, index, batch_actions, index_acting):
+        batch_agents = []
         batch_observations = []
         for i, w in enumerate(self.worlds):
             agents = w.get_agents()
@@ -555,10 +577,19 @@ class BatchWorld(World):
             else:
                 if index == index_acting: return None # don't observe yourself talking
                 observation = validate(batch_actions[i])
-            observation = agents[index].observe(observation)
-            if observation is None:
-                raise ValueError('Agents should return what they observed.')
+            batch_agents.append(agents[index])
             batch_observations.append(observation)
+        if hasattr(batch_agents[0], 'batch_observe'):
+            # the agents observe the whole batch at once (e.g. teachers
+            # scoring all of the replies together)
+            batch_observations = batch_agents[0].batch_observe(
+                batch_agents, batch_observations)
+        else:
+            batch_observations = [agent.observe(observation) for
+                                  agent, observation in
+                                  zip(batch_agents, batch_observations)]
+        if any(observation is None for observation in batch_observations):
+            raise ValueError('Agents should return what they observed.')
         return batch_observations
 
     def batch_act(self, index, batch_observation):
@@ -567,6 +598,7 @@ class BatchWorld(World):
         a = self.world.get_agents()[index]
         if (batch_observation is not None and len(batch_observation) > 0 and
                 hasattr(a, 'batch_act')):
+            self.count_padding(batch_observation)
             batch_actions = a.batch_act(batch_observation)
             # Store the actions locally in each world.
             for i, w in enumerate(self.worlds):
@@ -582,6 +614,15 @@ class BatchWorld(World):
                 batch_actions.append(acts[index])
         return batch_actions
 
+    def count_padding(self, batch_observation):
+        """Adds the tokens of the text in the batch to the padding counts."""
+        lengths = [len(obs['text_vec']) if 'text_vec' in obs
+                   else len(obs['text'].split())
+                   for obs in batch_observation if 'text' in obs]
+        if len(lengths) > 0:
+            self.text_tokens += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+
     def parley(self):
         # Collect batch together for each agent, and do update.
         # Assumes DialogPartnerWorld, MultiAgentWorld, or MultiWorlds of them.
@@ -629,7 +670,11 @@ class BatchWorld(World):
         return True
 
     def report(self):
-        return self.world.report()
+        m = self.world.report()
+        if self.padded_tokens > 0:
+            m['padding'] = round_sigfigs(
+                1 - self.text_tokens / self.padded_tokens, 4)
+        return m
 
     def reset(self):
         for w in self.worlds:
@@ -637,6 +682,8 @@ class BatchWorld(World):
 
     def reset_metrics(self):
         self.world.reset_metrics()
+        self.text_tokens = 0
+        self.padded_tokens = 0
 
     def save_agents(self):
         # Because all worlds share the same parameters through sharing, saving
@@ -655,32 +702,44 @@ class HogwildProcess(Process):
     Each ``HogwildProcess`` contain its own unique ``World``.
     """
 
-    def __init__(self, tid, world, opt, agents, sem, fin, term, cnt):
+    def __init__(self, tid, world, opt, agents, queue, fin, term, cnt,
+                 stats):
         self.threadId = tid
         self.world_type = world
         self.opt = opt
         self.agent_shares = [a.share() for a in agents]
-        self.queued_items = sem
+        self.queued_chunks = queue
         self.epochDone = fin
         self.terminate = term
         self.cnt = cnt
+        self.stats = stats
         super().__init__()
 
     def run(self):
         """Runs normal parley loop for as many examples as this thread can get
-        ahold of via the semaphore ``queued_items``.
+        ahold of via the queue ``queued_chunks``. Examples are claimed a chunk
+        at a time, and reported as done once the whole chunk is processed.
         """
+        # let the agents of this process know which thread they are in (this
+        # runs in the child process, so the opts of the others are unchanged)
+        for shared in self.agent_shares:
+            override_opts_in_shared(shared, {'threadindex': self.threadId})
         shared_agents = create_agents_from_shared(self.agent_shares)
         world = self.world_type(self.opt, shared_agents)
 
         with world:
             while True:
-                self.queued_items.acquire()
-                if self.terminate.value:
+                num_parleys = self.queued_chunks.get()
+                if num_parleys is None or self.terminate.value:
                     break  # time to close
-                world.parley()
+                for _ in range(num_parleys):
+                    world.parley()
+                # this process adds its key to the stats the first time
+                key = 'exs/thread{}'.format(self.threadId)
+                with self.stats.get_lock():
+                    self.stats[key] = self.stats.get(key, 0) + num_parleys
                 with self.cnt.get_lock():
-                    self.cnt.value -= 1
+                    self.cnt.value -= num_parleys
                     if self.cnt.value == 0:
                         # let main thread know that all the examples are finished
                         with self.epochDone:
@@ -692,9 +751,10 @@ class HogwildWorld(World):
 
     Maintains a few shared objects to keep track of state:
 
-    - A Semaphore which represents queued examples to be processed. Every call
-      of parley increments this counter; every time a Process claims an
-      example, it decrements this counter.
+    - A Queue of chunks of examples to be processed. Calls to parley are
+      collected into chunks of ``opt['hogwild_chunk']`` examples before being
+      queued, and every time a Process claims a chunk, it processes all of its
+      examples before reporting them as done.
 
     - A Condition variable which notifies when there are no more queued
       examples.
@@ -702,24 +762,31 @@ class HogwildWorld(World):
     - A boolean Value which represents whether the inner worlds should shutdown.
 
     - An integer Value which contains the number of unprocessed examples queued
-      (acquiring the semaphore only claims them--this counter is decremented
-      once the processing is complete).
+      (claiming a chunk from the queue does not change it--this counter is
+      decremented once the processing of the chunk is complete).
+
+    - A ``GrowableSharedTable`` of stats, to which the threads add their own
+      entries while they run (the number of examples each one processed),
+      included in the report under ``threads``.
     """
 
     def __init__(self, world_class, opt, agents):
         self.inner_world = world_class(opt, agents)
 
-        self.queued_items = Semaphore(0)  # counts num exs to be processed
+        self.queued_chunks = Queue()  # chunks of exs to be processed
         self.epochDone = Condition()  # notifies when exs are finished
         self.terminate = Value('b', False)  # tells threads when to shut down
         self.cnt = Value('i', 0)  # number of exs that remain to be processed
+        self.stats = GrowableSharedTable()  # stats added by the threads
+        self.chunk_size = max(opt.get('hogwild_chunk', 1), 1)
+        self.pending = 0  # number of exs not queued yet
 
         self.threads = []
         for i in range(opt['numthreads']):
             self.threads.append(HogwildProcess(i, world_class, opt,
-                                               agents, self.queued_items,
+                                               agents, self.queued_chunks,
                                                self.epochDone, self.terminate,
-                                               self.cnt))
+                                               self.cnt, self.stats))
         for t in self.threads:
             t.start()
 
@@ -735,33 +802,50 @@ class HogwildWorld(World):
         return False
 
     def parley(self):
-        """Queue one item to be processed."""
-        with self.cnt.get_lock():
-            self.cnt.value += 1
-        self.queued_items.release()
+        """Queue one item to be processed. Items are handed to the threads a
+        chunk at a time.
+        """
+        self.pending += 1
+        if self.pending >= self.chunk_size:
+            self._queue_pending()
+
+    def _queue_pending(self):
+        """Queue any items which are not part of a full chunk yet."""
+        if self.pending > 0:
+            with self.cnt.get_lock():
+                self.cnt.value += self.pending
+            self.queued_chunks.put(self.pending)
+            self.pending = 0
 
     def getID(self):
         return self.inner_world.getID()
 
     def report(self):
-        return self.inner_world.report()
+        m = self.inner_world.report()
+        if m is not None and len(self.stats) > 0:
+            m['threads'] = dict(self.stats)
+        return m
 
     def save_agents(self):
         self.inner_world.save_agents()
 
     def synchronize(self):
         """Sync barrier: will wait until all queued examples are processed."""
+        self._queue_pending()
         with self.epochDone:
             self.epochDone.wait_for(lambda: self.cnt.value == 0)
 
     def shutdown(self):
-        """Set shutdown flag and wake threads up to close themselves"""
+        """Finish the queued examples (including those of a partial chunk),
+        then set shutdown flag and wake threads up to close themselves.
+        """
+        self.synchronize()
         # set shutdown flag
         with self.terminate.get_lock():
             self.terminate.value = True
-        # wake up each thread by queueing fake examples
+        # wake up each thread by queueing a stop message
         for _ in self.threads:
-            self.queued_items.release()
+            self.queued_chunks.put(None)
         # wait for threads to close
         for t in self.threads:
             t.join()
@@ -80,7 +80,8 @@ class DefaultTeacher(DialogTeacher):
     requires it to define an iterator over its data `setup_data` in order to
     inherit basic metrics, a default `act` function, and enables
     Hogwild training with shared memory with no extra work.
-    For SQuAD, this does not efficiently store the paragraphs in memory.
+    Each paragraph is yielded as the context of its questions, so it is only
+    stored once (and sent with a ``context_id`` if ``--context-ids`` is set).
     """
 
     def __init__(self, opt, shared=None):
@@ -107,4 +108,4 @@ class DefaultTeacher(DialogTeacher):
                     question = qa['question']
                     answers = (a['text'] for a in qa['answers'])
                     context = paragraph['context']
-                    yield (context + '\n' + question, answers), True
+                    yield ((context, question), answers), True
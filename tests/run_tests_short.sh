@@ -9,7 +9,14 @@
 set -e # stop if any tests fail
 python3 test_init.py
 python3 test_import.py
+python3 test_collate.py
+python3 test_dialog_data.py
 python3 test_dict.py
+python3 test_drqa_utils.py
+python3 test_hogwild.py
+python3 test_ir_baseline.py
+python3 test_metrics.py
+python3 test_seq2seq.py
 python3 test_tasklist.py
 python3 test_threadutils.py
 python3 test_utils.py
@@ -0,0 +1,46 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.collate import Collator, pad_sequences
+import numpy as np
+import unittest
+
+
+class TestCollate(unittest.TestCase):
+    """Make sure sequences are padded correctly."""
+
+    def test_pad_sequences(self):
+        seqs = [[1, 2, 3], [4], [], [5, 6]]
+        padded, lengths, mask = pad_sequences(seqs, null=-1)
+        assert padded.tolist() == [[1, 2, 3], [4, -1, -1], [-1, -1, -1],
+                                   [5, 6, -1]]
+        assert lengths.tolist() == [3, 1, 0, 2]
+        assert mask.sum(1).tolist() == [3, 1, 0, 2]
+
+        padded, lengths, mask = pad_sequences(seqs, left=True)
+        assert padded.tolist() == [[1, 2, 3], [0, 0, 4], [0, 0, 0],
+                                   [0, 5, 6]]
+        assert mask[1].tolist() == [False, False, True]
+
+    def test_trailing_dims(self):
+        seqs = [np.ones((2, 3)), np.full((1, 3), 2.0)]
+        padded, _, _ = pad_sequences(seqs, dtype=np.float32)
+        assert padded.shape == (2, 2, 3) and padded.dtype == np.float32
+        assert padded[1].tolist() == [[2.0] * 3, [0.0] * 3]
+
+    def test_collator_reuses_buffers(self):
+        collator = Collator()
+        xs, _, _ = collator.pad('xs', [[1, 2, 3], [4, 5, 6]])
+        ys, _, _ = collator.pad('ys', [[7]])
+        assert xs.tolist() == [[1, 2, 3], [4, 5, 6]] and ys.tolist() == [[7]]
+        buf = collator.buffers['xs']
+        xs, _, _ = collator.pad('xs', [[1], [2, 3]], left=True)
+        assert xs.tolist() == [[0, 1], [2, 3]]
+        assert xs.flags['C_CONTIGUOUS']
+        assert collator.buffers['xs'] is buf
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,459 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.agents import Agent
+from parlai.core.dialog_teacher import DialogTeacher
+from parlai.core.dict import DictionaryAgent
+from parlai.core.fbdialog_teacher import FbDialogTeacher
+from parlai.core.params import ParlaiParser
+from parlai.core.worlds import BatchWorld, DialogPartnerWorld
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ToyTeacher(DialogTeacher):
+    """Teacher with a few small episodes covering every field."""
+
+    def setup_data(self, path):
+        cands = ['kitchen', 'hallway', 'garden']
+        yield ('Where is Sam?', ['kitchen'], '1', cands), True
+        yield ('Where is Pat?', ['hallway'], None, cands), False
+        yield ('Hi there', ['Hello!', 'Hey.']), True
+        yield ('No labels here',), True
+        yield ('Where is Kim?', ['garden'], '0', ['garden', 'attic']), True
+
+
+class CountingTeacher(ToyTeacher):
+    """Counts how many times the data is read."""
+
+    data_reads = 0
+
+    def setup_data(self, path):
+        self.data_reads += 1
+        yield from super().setup_data(path)
+
+
+class ContextTeacher(DialogTeacher):
+    """Teacher with several questions about each of two paragraphs."""
+
+    def setup_data(self, path):
+        paragraphs = ['Sam is in the kitchen. Pat is in the hallway.',
+                      'Kim went to the garden.']
+        yield ((paragraphs[0], 'Where is Sam?'), ['kitchen']), True
+        yield ((paragraphs[0], 'Where is Pat?'), ['hallway']), True
+        yield ((paragraphs[1], 'Where did Kim go?'), ['garden']), True
+        yield ('No context here', ['ok']), True
+
+
+class LengthTeacher(DialogTeacher):
+    """Teacher with single-entry episodes of many different lengths."""
+
+    def setup_data(self, path):
+        for i in [7, 3, 12, 1, 9, 3, 5, 11, 2, 8, 6, 4, 10]:
+            yield (' '.join(['word'] * i), [str(i)]), True
+
+
+class ThreeAgent(Agent):
+    """Always replies 3, which is right for some of the LengthTeacher data."""
+
+    def act(self):
+        return {'id': 'three', 'text': '3'}
+
+
+class EmptyTeacher(DialogTeacher):
+    """Teacher without any data."""
+
+    def setup_data(self, path):
+        return iter(())
+
+
+class EpisodeTeacher(DialogTeacher):
+    """Teacher with episodes of many different numbers of entries."""
+
+    def setup_data(self, path):
+        for n in [5, 2, 8, 3, 6, 1]:
+            for j in range(n):
+                yield ('e{} {}'.format(n, j), ['x']), j == 0
+
+
+FBDIALOG = """1 Sam went to the kitchen.
+2 Pat gave Sam the milk.
+3 Where is the milk?\tkitchen\t1\thallway|kitchen|bathroom
+4 Sam went to the hallway
+5 Where is the milk?\thallway\t1\thallway|kitchen|bathroom
+6 Pat went to the garden.
+1 Kim is in the attic.
+2 Lee is in the cellar.
+1 José went to the café.
+2 Where is José?\tcafé
+
+1 Hi how's it going?\tIt's going great.
+2 Oh cool!\tTell me about yours.
+3 This is never yielded.
+"""
+
+
+class TestDialogData(unittest.TestCase):
+    """Check the different ways DialogTeacher can store its data."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, 'toy.txt')
+        with open(self.datafile, 'w') as write:
+            write.write('toy data\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _opt(self, dialog_data):
+        return {
+            'task': 'toy',
+            'datatype': 'valid',
+            'datafile': self.datafile,
+            'dialog_data': dialog_data,
+        }
+
+    def _all_entries(self, data):
+        entries = []
+        for i in range(data.num_episodes()):
+            j = 0
+            while True:
+                table, end_of_data = data.get(i, j)
+                entries.append((table, end_of_data))
+                if table['episode_done']:
+                    break
+                j += 1
+        return entries
+
+    def test_compiled_matches_memory(self):
+        memory = ToyTeacher(self._opt('memory'))
+        compiled = ToyTeacher(self._opt('compiled'))
+        assert compiled.data.num_episodes() == memory.data.num_episodes()
+        assert len(compiled.data) == len(memory.data)
+        for (m, m_end), (c, c_end) in zip(self._all_entries(memory.data),
+                                          self._all_entries(compiled.data)):
+            assert m_end == c_end
+            assert m == c
+        # repeated candidates are not stored twice, but still returned
+        table, _ = compiled.data.get(0, 1)
+        assert table['label_candidates'] == ('kitchen', 'hallway', 'garden')
+
+    def test_compiled_reuse_and_share(self):
+        opt = self._opt('compiled')
+        teacher = ToyTeacher(opt)
+        path = teacher.compiled_data_path(opt)
+        assert os.path.isfile(path)
+        mtime = os.stat(path).st_mtime_ns
+
+        # second teacher reads the existing file instead of compiling again
+        ToyTeacher(opt)
+        assert os.stat(path).st_mtime_ns == mtime
+
+        # shared teachers read through the same file
+        shared = ToyTeacher(opt, teacher.share())
+        assert type(shared.data) == type(teacher.data)
+        assert (self._all_entries(shared.data) ==
+                self._all_entries(teacher.data))
+
+        # changing the source data invalidates the compiled file
+        with open(self.datafile, 'a') as write:
+            write.write('more toy data\n')
+        ToyTeacher(opt)
+        assert os.stat(path).st_mtime_ns != mtime
+
+    def test_stream_ordered(self):
+        memory = ToyTeacher(self._opt('memory'))
+        expected = [table for table, _ in self._all_entries(memory.data)]
+
+        opt = self._opt('stream')
+        opt['batchsize'] = 2
+        teachers = []
+        for i in range(2):
+            opt['batchindex'] = i
+            teachers.append(ToyTeacher(opt, teachers[0].share() if i else None))
+        assert len(teachers[1]) == len(memory)
+
+        # each copy reads every other episode, and together they see all data
+        seen = []
+        for teacher in teachers:
+            for _ in range(2):
+                while not teacher.epoch_done():
+                    action = teacher.act()
+                    del action['id']
+                    seen.append(action)
+                teacher.reset()
+        assert len(seen) == 2 * len(expected)
+        for table in expected:
+            table.pop('labels', None)
+            assert table in seen
+
+    def test_stream_count_cache(self):
+        opt = self._opt('stream')
+        # (the stream itself starts reading the data when the teacher starts)
+        teacher = CountingTeacher(opt)
+        reads = teacher.data_reads
+        assert len(teacher) == 5 and teacher.data.num_episodes() == 4
+        assert teacher.data_reads == reads + 1
+        assert os.path.isfile(teacher.data_count_path(opt))
+
+        # the counts are read back instead of reading all the data again
+        teacher = CountingTeacher(opt)
+        assert len(teacher) == 5 and teacher.data.num_episodes() == 4
+        assert teacher.data_reads == reads
+
+        # until the data file changes
+        with open(self.datafile, 'a') as write:
+            write.write('more toy data\n')
+        teacher = CountingTeacher(opt)
+        assert len(teacher) == 5
+        assert teacher.data_reads == reads + 1
+
+    def test_stream_shuffled(self):
+        opt = self._opt('stream')
+        opt['datatype'] = 'train'
+        opt['stream_buffer'] = 2
+        teacher = ToyTeacher(opt)
+        texts = set()
+        for _ in range(50):
+            action = teacher.act()
+            assert not teacher.epoch_done()
+            texts.add(action['text'])
+        assert len(texts) == len(teacher)
+
+    def test_shared_context(self):
+        expected = ['Sam is in the kitchen. Pat is in the hallway.\n' +
+                    'Where is Sam?',
+                    'Sam is in the kitchen. Pat is in the hallway.\n' +
+                    'Where is Pat?',
+                    'Kim went to the garden.\nWhere did Kim go?',
+                    'No context here']
+        for dialog_data in ['memory', 'compiled', 'stream']:
+            opt = self._opt(dialog_data)
+            opt['context_ids'] = True
+            teacher = ContextTeacher(opt)
+            actions = [teacher.act() for _ in range(4)]
+            assert [a['text'] for a in actions] == expected
+            ids = [a.get('context_id') for a in actions]
+            assert ids[0] == ids[1] and ids[1] != ids[2] and ids[3] is None
+
+            # ids are the same for every way of storing the data
+            if dialog_data == 'memory':
+                memory_ids = ids
+            assert ids == memory_ids
+
+        # the context is only stored once
+        memory = ContextTeacher(self._opt('memory'))
+        first, second = memory.data.data[0][0][0], memory.data.data[1][0][0]
+        assert first[0] is second[0]
+        assert 'context_id' not in memory.act()
+
+    def _batch_teachers(self, opt, teacher_class):
+        teachers = []
+        for i in range(opt['batchsize']):
+            opt['batchindex'] = i
+            shared = teachers[0].share() if i else None
+            teachers.append(teacher_class(opt, shared))
+        return teachers
+
+    def test_batch_sort(self):
+        opt = self._opt('compiled')
+        opt['batch_sort'] = True
+        opt['batchsize'] = 4
+        teachers = self._batch_teachers(opt, LengthTeacher)
+
+        # each step of the batch gets the next four shortest episodes
+        batches = []
+        while not all(t.epoch_done() for t in teachers):
+            batch = [t.act() for t in teachers]
+            batches.append([len(a['text'].split()) for a in batch
+                            if 'text' in a])
+        assert batches == [[1, 2, 3, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12]]
+
+        # when training, the teachers pick the same random batches
+        opt['datatype'] = 'train'
+        teachers = self._batch_teachers(opt, LengthTeacher)
+        for _ in range(20):
+            lengths = [len(a['text'].split()) for a in
+                       (t.act() for t in teachers) if 'text' in a]
+            assert max(lengths) - min(lengths) <= 3
+
+    def test_batch_sort_random_order(self):
+        opt = self._opt('memory')
+        opt['batch_sort'] = True
+        opt['batchsize'] = 4
+        opt['datatype'] = 'train'
+
+        def first_lengths(teachers, num_batches=20):
+            lengths = []
+            for _ in range(num_batches):
+                lengths.append(len(teachers[0].act()['text'].split()))
+            return lengths
+
+        # hogwild processes and epochs each get their own random batches
+        teachers = self._batch_teachers(opt, LengthTeacher)
+        shared = teachers[0].share()
+        first_epoch = first_lengths(teachers)
+        for t in teachers:
+            t.reset()
+        assert first_lengths(teachers) != first_epoch
+        opt['batchindex'] = 0
+        assert first_lengths([LengthTeacher(opt, shared)]) == first_epoch
+        opt['threadindex'] = 1
+        assert first_lengths([LengthTeacher(opt, shared)]) != first_epoch
+
+    def test_batch_sort_empty(self):
+        opt = self._opt('memory')
+        opt['batch_sort'] = True
+        opt['batchsize'] = 2
+        teachers = self._batch_teachers(opt, EmptyTeacher)
+        assert all(t.epoch_done() for t in teachers)
+
+        # there is nothing to draw random batches from when training either
+        opt['datatype'] = 'train'
+        teachers = self._batch_teachers(opt, EmptyTeacher)
+        for t in teachers:
+            assert 'text' not in t.act()
+
+    def test_batch_world_metrics(self):
+        def report(batchsize):
+            opt = self._opt('memory')
+            opt['batchsize'] = batchsize
+            world = DialogPartnerWorld(opt, [LengthTeacher(opt), ThreeAgent(opt)])
+            if batchsize > 1:
+                world = BatchWorld(opt, world)
+            while not world.epoch_done():
+                world.parley()
+            return world.report()
+
+        # the teachers of the batch score the replies together, with the same
+        # totals as one teacher scoring them one at a time
+        single = report(1)
+        assert single['total'] == 13
+        assert 0 < single['accuracy'] < 1
+        assert report(4) == single
+
+    def test_batch_tokens(self):
+        opt = self._opt('memory')
+        opt['batch_sort'] = True
+        opt['batch_tokens'] = 24
+        opt['batchsize'] = 8
+        teachers = self._batch_teachers(opt, LengthTeacher)
+
+        # batches hold as many episodes as fit 24 tokens (with their label)
+        # once padded, and the other teachers send empty actions
+        batches = []
+        while not all(t.epoch_done() for t in teachers):
+            batch = [t.act() for t in teachers]
+            batches.append([len(a['text'].split()) for a in batch
+                            if 'text' in a])
+        assert batches == [[1, 2, 3, 3], [4, 5, 6], [7, 8], [9, 10], [11], [12]]
+
+    def test_batch_sort_episodes(self):
+        opt = self._opt('compiled')
+        opt['batch_sort'] = True
+        opt['batchsize'] = 2
+        teachers = self._batch_teachers(opt, EpisodeTeacher)
+
+        # the teachers move on to the next batch together, once its longest
+        # episode is done, and send empty actions in the meantime
+        steps = []
+        while not all(t.epoch_done() for t in teachers):
+            steps.append([a['text'] for a in (t.act() for t in teachers)
+                          if 'text' in a])
+        expected = []
+        for batch in [(1, 2), (3, 5), (6, 8)]:
+            for j in range(max(batch)):
+                expected.append(['e{} {}'.format(n, j) for n in batch
+                                 if j < n])
+        assert steps == expected
+
+        # the same holds for the random batches when training
+        opt['datatype'] = 'train'
+        teachers = self._batch_teachers(opt, EpisodeTeacher)
+        for _ in range(100):
+            episodes = set(a['text'].split()[0] for a in
+                           (t.act() for t in teachers) if 'text' in a)
+            assert any(episodes <= set(batch) for batch in
+                       [{'e1', 'e2'}, {'e3', 'e5'}, {'e6', 'e8'}])
+
+    def test_fbdialog_deltas(self):
+        with open(self.datafile, 'w', encoding='utf-8') as write:
+            write.write(FBDIALOG)
+        teacher = FbDialogTeacher(self._opt('memory'))
+
+        # each entry only stores the lines since the previous example
+        texts = [entry[0] for episode in teacher.data.data
+                 for entry in episode]
+        assert texts[:3] == ['Sam went to the kitchen.\nPat gave Sam the ' +
+                             'milk.\nWhere is the milk?',
+                             'Sam went to the hallway\nWhere is the milk?',
+                             'Pat went to the garden.']
+        lines = [line.split(' ', 1)[1].split('\t')[0]
+                 for line in FBDIALOG.splitlines()[:-1] if line]
+        assert sum(len(t) for t in texts) <= sum(len(l) + 1 for l in lines)
+
+    def test_fbdialog_indexed(self):
+        with open(self.datafile, 'w', encoding='utf-8') as write:
+            write.write(FBDIALOG)
+        memory = FbDialogTeacher(self._opt('memory'))
+        indexed = FbDialogTeacher(self._opt('indexed'))
+        assert indexed.data.num_episodes() == memory.data.num_episodes()
+        assert len(indexed) == len(memory)
+        assert (self._all_entries(indexed.data) ==
+                self._all_entries(memory.data))
+
+        # the index is reused until the data file changes
+        path = indexed.index_path(self.datafile)
+        mtime = os.stat(path).st_mtime_ns
+        FbDialogTeacher(self._opt('indexed'))
+        assert os.stat(path).st_mtime_ns == mtime
+        with open(self.datafile, 'a') as write:
+            write.write('1 One more?\tyes\n')
+        indexed = FbDialogTeacher(self._opt('indexed'))
+        assert os.stat(path).st_mtime_ns != mtime
+        assert indexed.data.num_episodes() == memory.data.num_episodes() + 1
+
+    def test_vec_cache(self):
+        argparser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args(['--dict-tokenizer', 're'])
+        opt.update(self._opt('memory'))
+        opt['datatype'] = 'train'
+        opt['dict_file'] = os.path.join(self.tmpdir, 'toy.dict')
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict(['Where', 'is', 'Sam', '?', 'kitchen'])
+        dictionary.save(opt['dict_file'])
+        dictionary = DictionaryAgent(opt)
+
+        opt['vec_cache'] = True
+        teacher = ToyTeacher(opt)
+        path = teacher.vec_cache_path(opt)
+        assert os.path.isfile(path)
+        shared = ToyTeacher(opt, teacher.share())
+        for t in (teacher, shared):
+            for _ in range(10):
+                action = t.act()
+                if 'text' in action:
+                    assert (action['text_vec'].tolist() ==
+                            dictionary.txt2vec(action['text']))
+                for label, vec in zip(action.get('labels', ()),
+                                      action.get('labels_vec', ())):
+                    assert vec.tolist() == dictionary.txt2vec(label)
+
+        # labels are not sent when evaluating, so neither are their ids
+        opt['datatype'] = 'valid'
+        action = ToyTeacher(opt).act()
+        assert 'text_vec' in action and 'labels_vec' not in action
+
+        # a different dictionary gets its own cache
+        dictionary.add_to_dict(['Pat'])
+        dictionary.save(opt['dict_file'])
+        assert teacher.vec_cache_path(opt) != path
+
+
+if __name__ == '__main__':
+    unittest.main()
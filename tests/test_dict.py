@@ -59,6 +59,69 @@ class TestDictionary(unittest.TestCase):
         assert vec[0] == num_builtin
         assert vec[1] == num_builtin + 1
 
+    def test_re_tokenizer_cache(self):
+        """Check the regular expression tokenizer and the token id cache."""
+        from parlai.core.dict import DictionaryAgent
+        from parlai.core.params import ParlaiParser
+
+        argparser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args(['--dict-tokenizer', 're',
+                                    '--dict-cache-size', '2'])
+        dictionary = DictionaryAgent(opt)
+        assert (list(dictionary.tokenize("Sam doesn't like Pat's cat... no?"))
+                == ['Sam', 'does', "n't", 'like', 'Pat', "'s", 'cat', '...',
+                    'no', '?'])
+        assert (list(dictionary.tokenize('a|b', building=True)) ==
+                ['a', 'b'])
+        assert (list(dictionary.tokenize('a|b')) == ['a', '__pipe__', 'b'])
+
+        unk = dictionary[dictionary.unk_token]
+        assert dictionary.txt2vec('hello world') == [unk, unk]
+        dictionary.observe({'text': 'hello world'})
+        dictionary.act()
+        # new tokens invalidate the cached ids
+        vec = dictionary.txt2vec('hello world')
+        assert vec == [dictionary['hello'], dictionary['world']]
+        assert dictionary.txt2vec('hello world', tuple) == tuple(vec)
+        dictionary.txt2vec('hello')
+        dictionary.txt2vec('world')
+        assert len(dictionary.vec_cache) == 2
+        assert 'hello world' not in dictionary.vec_cache
+
+    def test_cache_cleared_on_reindex(self):
+        """Sorting or loading the dictionary changes the ids, which must not
+        be served from the token id cache afterwards.
+        """
+        from parlai.core.dict import DictionaryAgent
+        from parlai.core.params import ParlaiParser
+        import os
+        import tempfile
+
+        argparser = ParlaiParser()
+        DictionaryAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args(['--dict-tokenizer', 're'])
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict(['a', 'b', 'b', 'c', 'c', 'c'])
+
+        def fresh(text):
+            return [dictionary[t] for t in dictionary.tokenize(text)]
+
+        before = dictionary.txt2vec('a b c')
+        assert before == fresh('a b c')
+        dictionary.sort()
+        after = dictionary.txt2vec('a b c')
+        assert after != before and after == fresh('a b c')
+
+        dictionary.txt2vec('a d')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dict')
+            with open(path, 'w') as write:
+                write.write('d\t5\n')
+            dictionary.load(path)
+        assert dictionary.txt2vec('a d') == fresh('a d')
+        assert dictionary['d'] != dictionary[dictionary.unk_token]
+
 
 if __name__ == '__main__':
     unittest.main()
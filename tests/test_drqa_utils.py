@@ -0,0 +1,136 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.agents.drqa.utils import build_feature_dict, decode_spans
+from parlai.agents.drqa.utils import find_spans, vectorize
+import os
+import shutil
+import tempfile
+import torch
+import unittest
+
+
+class TestDrqaUtils(unittest.TestCase):
+    """Check the input and output utilities of the DrQA agent against
+    straightforward versions.
+    """
+
+    def _best_spans(self, score_s, score_e, length, max_len):
+        """Scores every span of the first length tokens, best first."""
+        spans = [(score_s[i] * score_e[j], i, j) for i in range(length)
+                 for j in range(i, min(i + max_len, length))]
+        return sorted(spans, reverse=True)
+
+    def test_decode_spans(self):
+        torch.manual_seed(0)
+        lengths = [7, 4, 1]
+        score_s = torch.rand(len(lengths), 7)
+        score_e = torch.rand(len(lengths), 7)
+        x1_mask = torch.ByteTensor(
+            [[i >= length for i in range(7)] for length in lengths])
+        for max_len in (1, 3, None):
+            starts, ends, scores = decode_spans(score_s, score_e, max_len,
+                                                top_k=5, x1_mask=x1_mask)
+            assert starts.size() == (len(lengths), 5)
+            for b, length in enumerate(lengths):
+                best = self._best_spans(score_s[b].tolist(),
+                                        score_e[b].tolist(), length,
+                                        max_len or 7)[:5]
+                found = list(zip(scores[b].tolist(), starts[b].tolist(),
+                                 ends[b].tolist()))
+                assert [s[1:] for s in found[:len(best)]] == \
+                    [s[1:] for s in best]
+                for (score, _, _), (expected, _, _) in zip(found, best):
+                    assert abs(score - expected) < 1e-6
+                # the spans after the valid ones are marked with -inf
+                assert all(s[0] == -float('inf') for s in found[len(best):])
+
+    def test_decode_spans_ignores_padding(self):
+        # the padding gets the best scores, but must never be predicted
+        score_s = torch.Tensor([[0.1, 0.2, 0.9, 0.5]])
+        score_e = torch.Tensor([[0.3, 0.1, 0.8, 0.9]])
+        x1_mask = torch.ByteTensor([[0, 0, 1, 1]])
+        starts, ends, _ = decode_spans(score_s, score_e, x1_mask=x1_mask)
+        assert (starts.tolist(), ends.tolist()) == ([[0]], [[0]])
+        starts, ends, _ = decode_spans(score_s, score_e)
+        assert (starts.tolist(), ends.tolist()) == ([[2]], [[3]])
+
+    def test_find_spans(self):
+        document = ['a', 'b', 'c', 'a', 'b', 'c', '.']
+        spans = find_spans(document, [['a', 'b'], ['c'], ['.'], [],
+                                      ['b', 'c', 'a'], ['x']])
+        # spans ending on the last token are left out
+        assert spans == [(0, 1), (3, 4), (2, 2), (5, 5), (1, 3)]
+
+    def test_vectorize(self):
+        opt = {'use_in_question': True, 'use_tf': True, 'use_time': 2}
+        feature_dict = build_feature_dict(opt)
+        document = ['The', 'cat', 'sat', '.', 'the', 'dog']
+        question = ['the', 'Dog']
+        words = ['the', 'Dog', 'The', 'cat', 'sat', '.', 'dog']
+        word_dict = {w: i for i, w in enumerate(words)}
+        ex = {'document': document, 'question': question, 'target': (1, 2)}
+        doc, features, q, start, end = vectorize(opt, ex, word_dict,
+                                                  feature_dict)
+        assert doc.tolist() == [2, 3, 4, 5, 0, 6]
+        assert q.tolist() == [0, 1]
+        assert (start.tolist(), end.tolist()) == ([1], [2])
+
+        def column(name):
+            return features[:, feature_dict[name]].tolist()
+
+        assert column('in_question') == [0, 0, 0, 0, 1, 0]
+        assert column('in_question_uncased') == [1, 0, 0, 0, 1, 1]
+        assert [round(f * 6) for f in column('tf')] == [2, 1, 1, 1, 2, 1]
+        # the last sentence is T1, the ones before it are all >=T2
+        assert column('time=T1') == [0, 0, 0, 0, 1, 1]
+        assert column('time>=T2') == [1, 1, 1, 1, 0, 0]
+
+        ex['target'] = None
+        assert len(vectorize(opt, ex, word_dict, feature_dict)) == 3
+
+    def test_save_with_embedding_file(self):
+        """Models whose dictionary indexes an embedding file can be saved and
+        loaded again, without the caches of the dictionary.
+        """
+        from parlai.agents.drqa.drqa import DrqaAgent
+        from parlai.core.params import ParlaiParser
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            embedding_file = os.path.join(tmpdir, 'emb.txt')
+            with open(embedding_file, 'w') as write:
+                write.write('the 0.1 0.2 0.3\ncat 0.4 0.5 0.6\n')
+            model_file = os.path.join(tmpdir, 'model')
+
+            argparser = ParlaiParser()
+            DrqaAgent.add_cmdline_args(argparser)
+            opt = argparser.parse_args([
+                '--embedding_file', embedding_file, '--embedding_dim', '3',
+                '--model_file', model_file, '--no_cuda', 'True',
+                '--hidden_size', '4', '--doc_layers', '1',
+                '--question_layers', '1'], print_args=False)
+            agent = DrqaAgent(opt)
+            agent.word_dict.add_to_dict(['the', 'dog', 'cat'])
+            agent.word_dict.tokenize_with_spans('the cat', cache=True)
+            agent.word_dict.parse('the cat')
+            agent.save()
+            assert os.path.isfile(model_file)
+
+            loaded = DrqaAgent(opt)
+            word_dict = loaded.word_dict
+            assert 'cat' in word_dict and 'dog' not in word_dict
+            assert 'the' in word_dict.embedding_words
+            assert 'dog' not in word_dict.embedding_words
+            assert len(word_dict.tokenize_cache) == 0
+            assert len(word_dict.vec_cache) == 0
+            for k, v in agent.model.network.state_dict().items():
+                assert torch.equal(v, loaded.model.network.state_dict()[k])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.agents import Agent
+from parlai.core.worlds import HogwildWorld, World
+from multiprocessing import Value
+import unittest
+
+
+class CountAgent(Agent):
+    """Holds a counter shared by all of its copies."""
+
+    def __init__(self, opt, shared=None):
+        super().__init__(opt, shared)
+        self.count = shared['count'] if shared else Value('i', 0)
+
+    def share(self):
+        shared = super().share()
+        shared['count'] = self.count
+        return shared
+
+
+class CountWorld(World):
+    """Counts its parleys in the counter of its agent."""
+
+    def __init__(self, opt, agents=None, shared=None):
+        super().__init__(opt, agents, shared)
+        self.agents = agents
+
+    def parley(self):
+        count = self.agents[0].count
+        with count.get_lock():
+            count.value += 1
+
+    def report(self):
+        return {}
+
+
+class TestHogwildWorld(unittest.TestCase):
+    """Check that every parley is processed by the threads."""
+
+    def _run(self, num_parleys, chunk_size, sync):
+        opt = {'task': 'count', 'numthreads': 2, 'hogwild_chunk': chunk_size}
+        agent = CountAgent(opt)
+        world = HogwildWorld(CountWorld, opt, [agent])
+        for _ in range(num_parleys):
+            world.parley()
+        if sync:
+            world.synchronize()
+        world.shutdown()
+        # the threads add their own stats while they run
+        stats = world.report()['threads']
+        assert set(stats) <= {'exs/thread0', 'exs/thread1'}
+        assert sum(stats.values()) == num_parleys
+        return agent.count.value
+
+    def test_partial_chunk(self):
+        # 10 parleys in chunks of 4 leave a partial chunk of 2 at the end
+        assert self._run(10, 4, sync=True) == 10
+        assert self._run(10, 4, sync=False) == 10
+        assert self._run(3, 5, sync=False) == 3
+        assert self._run(8, 4, sync=False) == 8
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from parlai.agents.ir_baseline.ir_baseline import IrBaselineAgent
+from parlai.agents.ir_baseline.ir_baseline import rank_candidates
+from parlai.core.fbdialog_teacher import FbDialogTeacher
+from parlai.core.params import ParlaiParser
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+
+PLACES = ['kitchen', 'hallway', 'bathroom', 'garden', 'office', 'bedroom',
+          'cellar', 'attic']
+NAMES = ['Sam', 'Pat', 'Kim', 'Lee']
+
+
+def _data():
+    """Returns fbdialog lines whose labels are mostly missing from the
+    candidates file, so the teacher adds them to its candidates.
+    """
+    lines = []
+    for i, name in enumerate(NAMES * 3):
+        place = PLACES[(3 * i) % len(PLACES)]
+        lines.append('1 {} went to the {} .'.format(name, place))
+        lines.append('2 where is the {} ?\tthe {} {}'.format(
+            name.lower(), place, i))
+    return '\n'.join(lines) + '\n'
+
+
+def _cands():
+    cands = []
+    for place in PLACES:
+        cands.append('the ' + place)
+        cands.append('a {} with a view'.format(place))
+        cands.append('where is the ' + place)
+    return '\n'.join(cands) + '\n'
+
+
+class TestIrBaseline(unittest.TestCase):
+    """Check that the cached candidate indexes rank like a scan of the
+    candidates.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, 'data.txt')
+        with open(self.datafile, 'w') as write:
+            write.write(_data())
+        self.cands_datafile = os.path.join(self.tmpdir, 'cands.txt')
+        with open(self.cands_datafile, 'w') as write:
+            write.write(_cands())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _opt(self, args=()):
+        argparser = ParlaiParser()
+        IrBaselineAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args(['--dict-tokenizer', 're'] + list(args))
+        opt.update({
+            'task': 'toy',
+            'datatype': 'valid',
+            'datafile': self.datafile,
+            'cands_datafile': self.cands_datafile,
+            'batchsize': 2,
+        })
+        return opt
+
+    def _teachers(self, opt):
+        """Two copies of the teacher, like in a batch, which each add the
+        labels of their examples to their own copy of the candidates.
+        """
+        teachers = []
+        for i in range(2):
+            opt['batchindex'] = i
+            shared = teachers[0].share() if i else None
+            teachers.append(FbDialogTeacher(opt, shared))
+        return teachers
+
+    def test_rank_matches_scan(self):
+        opt = self._opt()
+        agent = IrBaselineAgent(opt)
+        teachers = self._teachers(opt)
+        index = None
+        for _ in range(len(NAMES) * 3 // 2):
+            for teacher in teachers:
+                action = teacher.act()
+                cands = action['label_candidates']
+                assert teacher.lastY[0] in cands
+                assert cands == (action['label_candidates_fixed'] |
+                                 set(action['label_candidates_added']))
+                query_rep = agent.build_query_representation(action['text'])
+                expected = rank_candidates(query_rep, cands,
+                                           agent.length_penalty)
+                # with the changes sent by the teacher
+                ranked = agent.rank_batch([action])[0]['text_candidates']
+                assert ranked == expected
+                # the index of the fixed candidates is built only once
+                index = index or agent.cand_index
+                assert agent.cand_index is index
+                # and without them, comparing the candidates with the index
+                assert agent.rank([action['text']], cands)[0] == expected
+
+    def test_added_candidates_on_ties(self):
+        agent = IrBaselineAgent(self._opt())
+        fixed = {'the kitchen', 'the garden', 'the attic'}
+        added = ['the hallway']
+        query_rep = agent.build_query_representation('where is it')
+        agent.rank(['where is it'], fixed | set(added), fixed=fixed,
+                   added=added)
+        # every candidate scores 0: the added one is left out once the fixed
+        # ones fill the top k
+        ranked = agent.cand_index.rank(query_rep, agent.length_penalty,
+                                       added=added)
+        assert sorted(ranked) == sorted(fixed | set(added))
+        ranked = agent.cand_index.rank(query_rep, agent.length_penalty, k=3,
+                                       added=added)
+        assert sorted(ranked) == sorted(fixed)
+
+    def _tfidf_score(self, agent, query, cand):
+        """Scores a candidate the way --tfidf does, one word at a time."""
+        words = query.lower().split(' ')
+        used = set(cand.lower().split(' '))
+        score = 0
+        for w in set(words) & used:
+            i = agent.dictionary.tok2ind.get(w)
+            if i is not None and i < len(agent.idf):
+                score += agent.idf[i]
+            else:
+                score += 1
+        norm = math.sqrt(len(used)) * math.sqrt(len(words))
+        return score / math.pow(norm, agent.length_penalty)
+
+    def test_tfidf_matches_scan(self):
+        opt = self._opt(['--tfidf', 'true'])
+        agent = IrBaselineAgent(opt)
+        agent.dictionary.add_to_dict(['the', 'the', 'the', 'is', 'kitchen'])
+        teachers = self._teachers(opt)
+        index = None
+        for _ in range(len(NAMES) * 3 // 2):
+            actions = [t.act() for t in teachers]
+            for action in actions:
+                cands = action['label_candidates']
+                ranked = agent.rank_batch([action])[0]['text_candidates']
+                assert sorted(ranked) == sorted(cands)
+                scores = [self._tfidf_score(agent, action['text'], c)
+                          for c in ranked]
+                assert scores == sorted(scores, reverse=True)
+                assert abs(scores[0] - max(
+                    self._tfidf_score(agent, action['text'], c)
+                    for c in cands)) < 1e-9
+                index = index or agent.cand_index
+                assert agent.cand_index is index
+
+    def test_idf_refresh(self):
+        opt = self._opt(['--tfidf', 'true'])
+        opt['datatype'] = 'train'
+        agent = IrBaselineAgent(opt)
+        teacher = self._teachers(opt)[0]
+        refreshes = set()
+        for _ in range(500):
+            agent.observe(teacher.act())
+            agent.act()
+            refreshes.add(agent.idf_updates)
+        # weights are recomputed about log(500) / log(1.1) times, not 500
+        assert len(refreshes) < 100
+        assert agent.dict_updates == 500
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.metrics import Metrics, _normalize_answer, _exact_match, \
+    _f1_score
+from multiprocessing import Process
+import unittest
+
+
+def update_metrics(metrics, num_updates):
+    for i in range(num_updates):
+        metrics.update({'text': 'yes', 'text_candidates': ['no', 'yes']},
+                       ['yes'] if i % 2 == 0 else ['no'])
+
+
+class TestMetrics(unittest.TestCase):
+    """Make sure metrics are accumulated correctly."""
+
+    def test_report(self):
+        metrics = Metrics({})
+        update_metrics(metrics, 4)
+        report = metrics.report()
+        assert report['total'] == 4
+        assert report['accuracy'] == 0.5
+        assert report['f1'] == 0.5
+        assert report['hits@k'][1] == 0.5
+        assert report['hits@k'][5] == 1
+        metrics.clear()
+        assert metrics.report() == {'total': 0}
+
+    def test_normalization(self):
+        assert _normalize_answer(' The  cat, sat on a MAT! ') == 'cat sat on mat'
+        assert _exact_match('An apple.', ['pear', 'apple'])
+        assert _f1_score('the red apple', ['apple', 'red pear']) == 2 / 3
+
+    def test_batch_update(self):
+        observations = [{'text': 'yes'}, {'text': 'No!'}, {'text': 'maybe',
+                        'text_candidates': ['no', 'maybe', 'yes']}]
+        labels = [['yes'], ['no'], ['yes']]
+        single = Metrics({})
+        for obs, lbls in zip(observations, labels):
+            single.update(obs, lbls)
+        batch = Metrics({'numthreads': 2})
+        losses = batch.batch_update(observations, labels)
+        assert [l['correct'] for l in losses] == [1, 1, 0]
+        assert batch.report() == single.report()
+
+    def test_shared_across_processes(self):
+        numthreads = 4
+        metrics = Metrics({'numthreads': numthreads})
+        procs = [Process(target=update_metrics, args=(metrics, 100))
+                 for _ in range(numthreads)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        # the main process gets a shard of its own
+        update_metrics(metrics, 100)
+        report = metrics.report()
+        assert report['total'] == 500
+        assert report['accuracy'] == 0.5
+        assert report['hits@k'][10] == 1
+
+        metrics.clear()
+        assert metrics.report() == {'total': 0}
+
+
+if __name__ == '__main__':
+    unittest.main()
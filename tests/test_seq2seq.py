@@ -0,0 +1,90 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.agents.seq2seq.seq2seq import Seq2seqAgent
+from parlai.core.params import ParlaiParser
+from torch.autograd import Variable
+import os
+import shutil
+import tempfile
+import torch
+import unittest
+
+
+class TestSeq2seqDecoding(unittest.TestCase):
+    """Check the beam search of the seq2seq agent against greedy search and
+    against the scores of the sequences it finds.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        dict_file = os.path.join(self.tmpdir, 'dict')
+        with open(dict_file, 'w') as write:
+            for i in range(12):
+                write.write('word%d\t1\n' % i)
+        argparser = ParlaiParser()
+        Seq2seqAgent.add_cmdline_args(argparser)
+        self.opt = argparser.parse_args([
+            '--no-cuda', '-hs', '16', '-nl', '1', '--dict-tokenizer', 're',
+            '--dict-file', dict_file], print_args=False)
+        torch.manual_seed(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _encode(self, agent, xs):
+        """Returns the decoder inputs and states of the encoded inputs, as
+        Seq2seqAgent.predict does.
+        """
+        batchsize = xs.size(0)
+        h0 = agent.init_zeros(batchsize)
+        _output, hn = agent.encoder(agent.lt(xs).t(), h0)
+        xe = agent.lt(Variable(agent.END_TENSOR)).unsqueeze(1)
+        return xe.expand(xe.size(0), batchsize, xe.size(2)), hn
+
+    def _inputs(self, agent, batchsize=4, length=5):
+        return Variable(torch.LongTensor(batchsize, length).random_(
+            0, len(agent.dict)))
+
+    def test_beam_size_one_is_greedy(self):
+        agent = Seq2seqAgent(self.opt)
+        agent.longest_label.value = 6
+        agent.beam_size = 1
+        xs = self._inputs(agent)
+        greedy = agent.greedy_search(*self._encode(agent, xs), xs.size(0))
+        beam, _scores = agent.beam_search(*self._encode(agent, xs),
+                                          xs.size(0))
+        assert agent.ids_to_lines(beam) == agent.ids_to_lines(greedy)
+
+    def test_finished_hypotheses_keep_scores(self):
+        agent = Seq2seqAgent(self.opt)
+        agent.longest_label.value = 6
+        agent.beam_size = 3
+        # make END likely, so that hypotheses finish before the last step
+        agent.h2o.bias.data.zero_()
+        agent.h2o.bias.data[agent.END_IDX] = 2
+        xs = self._inputs(agent)
+        ids, scores = agent.beam_search(*self._encode(agent, xs), xs.size(0))
+        ids = ids.data.tolist()
+        assert any(line.index(agent.END_IDX) < len(line) - 1 for line in ids
+                   if agent.END_IDX in line)
+
+        # the score of each best hypothesis is the log-probability of its
+        # tokens up to its first END, nothing after it
+        for b, line in enumerate(ids):
+            if agent.END_IDX in line:
+                line = line[:line.index(agent.END_IDX) + 1]
+            xes, hn = self._encode(agent, xs[b:b + 1])
+            expected = 0
+            for idx in line:
+                output, hn = agent.decoder(xes, hn)
+                _preds, token_scores = agent.hidden_to_idx(output)
+                expected += token_scores.data[0, idx]
+                xes = agent.lt(Variable(torch.LongTensor([[idx]])))
+            assert abs(scores.data[b] - expected) < 1e-4
+
+
+if __name__ == '__main__':
+    unittest.main()
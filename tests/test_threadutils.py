@@ -3,8 +3,8 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
-from parlai.core.thread_utils import SharedTable
-from multiprocessing import Process
+from parlai.core.thread_utils import SharedTable, GrowableSharedTable
+from multiprocessing import Process, Event
 import unittest
 import random
 import time
@@ -79,5 +79,108 @@ class TestSharedTable(unittest.TestCase):
         assert st['cnt'] == 250
 
 
+class TestGrowableSharedTable(unittest.TestCase):
+    """Make sure keys can be added and removed across processes."""
+
+    def test_get_set_del(self):
+        st = GrowableSharedTable({'a': 0, 'b': 1.0, 2: 2})
+        assert st['a'] == 0 and st['b'] == 1.0 and st[2] == 2
+        assert type(st['b']) == float
+        try:
+            st['key']
+            assert False, 'did not fail on nonexistent key'
+        except KeyError:
+            pass
+
+        st['key'] = 1
+        st['key'] += 1
+        assert st['key'] == 2
+
+        try:
+            st['key'] = 2.1
+            assert False, 'cannot change type of value for set keys'
+        except TypeError:
+            pass
+        try:
+            st['str'] = 'hello'
+            assert False, 'strings are not supported'
+        except TypeError:
+            pass
+
+        del st['key']
+        assert 'key' not in st, 'key should have been removed from table'
+        st['key'] = 0.5
+        assert st['key'] == 0.5
+        assert set(st.keys()) == {'a', 'b', 2, 'key'}
+        assert len(st) == 4
+
+    def test_doubling(self):
+        st = GrowableSharedTable(capacity=2, max_capacity=8)
+        capacities = []
+        for i in range(8):
+            st[i] = i * 10
+            capacities.append(st.capacity())
+        assert capacities == [2, 2, 4, 4, 8, 8, 8, 8]
+        # growing keeps what was stored before
+        assert [st[i] for i in range(8)] == [i * 10 for i in range(8)]
+        try:
+            st['full'] = 1
+            assert False, 'table should be full'
+        except RuntimeError:
+            pass
+        try:
+            GrowableSharedTable(capacity=2, max_capacity=6)
+            assert False, 'max_capacity must be a doubling of capacity'
+        except ValueError:
+            pass
+
+    def test_keys_added_after_fork(self):
+        st = GrowableSharedTable({'cnt': 0}, capacity=1)
+        added = Event()
+
+        def child():
+            # the table doubles to make room for this key
+            with st.get_lock():
+                st['child'] = 1.5
+            added.wait()
+            # the parent added this key after the process started
+            with st.get_lock():
+                st['parent'] += 1
+            del st['cnt']
+
+        proc = Process(target=child)
+        proc.start()
+        while 'child' not in st:
+            time.sleep(0.01)
+        st['parent'] = 1
+        added.set()
+        proc.join()
+        assert proc.exitcode == 0
+        assert st.capacity() == 4
+        assert st['child'] == 1.5
+        assert st['parent'] == 2
+        assert 'cnt' not in st
+
+    def test_concurrent_access(self):
+        st = GrowableSharedTable(capacity=4)
+
+        def inc():
+            for i in range(50):
+                with st.get_lock():
+                    st['cnt'] = st.get('cnt', 0) + 1
+                    st['key' + str(i)] = i
+
+        threads = []
+        for _ in range(5):  # numthreads
+            threads.append(Process(target=inc))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert st['cnt'] == 250
+        assert len(st) == 51
+        assert st.capacity() == 64
+
+
 if __name__ == '__main__':
     unittest.main()